@@ -1,6 +1,28 @@
+import importlib
+
 from bytes32.version import __version__
 
-from bytes32.validity import check_validity
-from bytes32.winnability.language_agent import check_winnability
-from bytes32.compliance import check_compliance
-from bytes32.alignment import check_alignment
+
+# The checks are imported on first use, so that e.g. `from bytes32 import check_validity`
+# doesn't load the LLM dependencies.
+_LAZY_ATTRIBUTES = {
+    "check_validity": "bytes32.validity",
+    "check_winnability": "bytes32.winnability.language_agent",
+    "check_compliance": "bytes32.compliance",
+    "check_alignment": "bytes32.alignment",
+}
+
+__all__ = ["__version__", *_LAZY_ATTRIBUTES]
+
+
+def __getattr__(name):
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    value = getattr(importlib.import_module(_LAZY_ATTRIBUTES[name]), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRIBUTES))
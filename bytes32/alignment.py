@@ -1,42 +1,97 @@
 import itertools
 import os
+import ast
+import asyncio
+import re
 import sys
 import json
+import time
+import math
 import random
-import importlib
-from collections import defaultdict
+import timeit
+import multiprocessing
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from termcolor import colored
 
 from tqdm import tqdm
 
 from bytes32.utils import batched
-from bytes32.utils import llm_gpt, stream_llm_gpt
+from bytes32.utils import async_llm_gpt, async_llm_logprobs, count_tokens
+from bytes32.cache import TRANSIENT_ERROR
+from bytes32.sandbox import GameError, GameTimeBudgetError, load_game, get_sandbox_limits
+from bytes32.profiling import start_profiler
+from bytes32.sampling import StratifiedSampler
+from bytes32.fingerprint import game_fingerprint, TranspositionTable
+from bytes32.validity import snapshot_game, restore_game, kill_workers
 
 
 NEGATIVE_RESPONSE_PHRASES = ["you can't", "you cannot", "not possible", "impossible", "error", "invalid"]
+NEGATIVE_RESPONSE_PATTERN = re.compile("|".join(re.escape(phrase) for phrase in NEGATIVE_RESPONSE_PHRASES), re.IGNORECASE)
 
-# Base prompt for Alignment Check
-BASE_PROMPT_ALIGNMENT = """For each text-game playthrough below, I would like you to describe whether the game engine (i.e. the observations it returns in response to actions) are physically accurate models of the world, or whether they don't make sense.
+# Representation of a game object returned by a sandboxed game (see bytes32.sandbox), holding the object's class
+OBJECT_REPR_PATTERN = re.compile(r"^<(?:[\w.-]+\.)?(\w+) object at 0x[0-9a-fA-F]+>$")
+
+# Words separating the objects of an action, e.g. "put apple in fridge"
+PREPOSITIONS = {"in", "into", "on", "onto", "to", "from", "with", "at", "under", "inside", "using", "through"}
+
+# Fields of an evaluation, to salvage them from malformed JSON
+IDX_PATTERN = re.compile(r'idx"?\s*:\s*"?(\d+)')
+EVALUATION_PATTERN = re.compile(r'evaluation"?\s*:\s*"?(yes|no|error)', re.IGNORECASE)
+JUSTIFICATION_PATTERN = re.compile(r'short_justification"?\s*:\s*"(.*?)"?\s*}?\s*$')
+OBJECT_SEPARATOR = re.compile(r'(?<=\})\s*,?\s*(?=\{)')
+
+# Tokens set aside for the evaluation of each playthrough, when packing playthroughs into prompts
+ALIGNMENT_RESPONSE_TOKENS = 60
+
+# What makes the observations of a playthrough physically accurate, for the Alignment Check prompts
+ALIGNMENT_CRITERIA = """For each text-game playthrough below, I would like you to describe whether the game engine (i.e. the observations it returns in response to actions) are physically accurate models of the world, or whether they don't make sense.
 An example of not making sense would be being able to take an action from a container (like a fridge) without having opened it first. In addition, if an action produces an error from the game, then it automatically fails to accurately model the world and does not make sense.
 Please restrict your evaluation only to the short playthrough, and the specific actions chosen, without speculating about other actions.
-Note: Objects can be manipulated by the agent without first being explicitly picked up, as long as they are in the environment, and readily accessible (e.g. not in a closed container).
+Note: Objects can be manipulated by the agent without first being explicitly picked up, as long as they are in the environment, and readily accessible (e.g. not in a closed container)."""
+
+# Base prompt for Alignment Check
+BASE_PROMPT_ALIGNMENT = ALIGNMENT_CRITERIA + """
 The evaluation should be binary ("yes" or "no"), except in the cases where the code generated an error, when the evaluation should be "error".
 Here is an example output format: {"idx: 0, "evaluation":"no", "short_justification": "could take an object (banana) from the closed fridge without having to first open the fridge"}"""
 
+# Prompt of the logprob Alignment Check, asking for a single-token verdict
+BASE_PROMPT_ALIGNMENT_VERDICT = ALIGNMENT_CRITERIA + """
+Answer with a single word: "yes" if the observations make sense, "no" if they don't, or "error" if the code generated an error."""
+
+# Possible verdicts of the logprob Alignment Check
+ALIGNMENT_VERDICTS = ("yes", "no", "error")
+
 
 # Class for the pathcrawler
 class Pathcrawler():
     # Constructor
-    def __init__(self, GameClass, tqdm_desc="Crawling paths", error_strategy="raise", random_seed=0, shuffle_random_seed=0):
+    def __init__(self, GameClass, tqdm_desc="Crawling paths", error_strategy="raise", random_seed=0, shuffle_random_seed=0,
+                 prune_duplicate_states=False):
         self.tqdm_desc = tqdm_desc
         self.error_strategy = error_strategy
         self.randomSeed = random_seed
+        self.shuffleRandomSeed = shuffle_random_seed
         self.r = random.Random()
         self.r.seed(shuffle_random_seed)   # may use a different random seed to shuffle possible actions
 
         self.GameClass = GameClass
         self.numPathsCrawled = 0
         self.pbar = None
+        self.cancelled = None           # Optional callable telling the crawl to stop early
+
+        # Timings deciding whether to branch from game snapshots or to replay the actions (see shouldSnapshot)
+        self.calibrated = False
+        self.replayTime = 0
+        self.restoreTime = 0
+        self.stepTime = 0
+        self.numStepsTimed = 0
+
+        # States already expanded by the crawl, to avoid expanding them again when reached through another path.
+        self.seenStates = TranspositionTable() if prune_duplicate_states else None
+
+        # Classes of the objects each action applies to, taken from the possible actions (see canonical_playthrough)
+        self.actionClasses = {}
 
     def getGameTaskDescription(self):
         # Initialize the game
@@ -44,8 +99,10 @@ class Pathcrawler():
         return game.getTaskDescription()
 
     # Pack the game state into a dictionary
+    # `crashed` marks the state recorded for an action crashing the game, with error_strategy "fail"
+    # `objectClasses` are the classes of the objects the action taken applies to, None if unknown
     def packGameState(self, actionStrTaken: str, observationStr: str,
-                      numSteps: int, score: int, gameOver: bool, gameWon: bool):
+                      numSteps: int, score: int, gameOver: bool, gameWon: bool, crashed: bool = False, objectClasses=None):
 
         packed = {
             "actionStrTaken": actionStrTaken,
@@ -54,17 +111,39 @@ class Pathcrawler():
             "score": score,
             "gameOver": gameOver,
             "gameWon": gameWon,
+            "crashed": crashed,
+            "objectClasses": objectClasses,
             #"possibleActions": game.generatePossibleActions().keys(),
         }
 
         return packed
 
+    # Remember the classes of the objects each of the possible actions applies to
+    # An action string may stand for several actions (a list of their arguments), whose classes must then agree.
+    def recordActionClasses(self, possibleActions):
+        for actionStr, actionArgs in possibleActions.items():
+            if not isinstance(actionArgs, (list, tuple)):
+                continue
+
+            if actionArgs and all(isinstance(args, (list, tuple)) for args in actionArgs):
+                candidates = actionArgs
+            else:
+                candidates = [actionArgs]
+
+            classes = {tuple(cls for cls in map(_object_class, args) if cls is not None) for args in candidates}
+            self.actionClasses[actionStr] = list(classes.pop()) if len(classes) == 1 else None
+
     # Run the game, using a specific series of actions
     def run(self, actionStrList:list):
+        out, game = self.play(actionStrList)
+        return out, game.generatePossibleActions().keys()
+
+    # Run the game, using a specific series of actions, and also return the game in its final state
+    def play(self, actionStrList:list):
         out = []
         # Initialize the game
         game = self.GameClass(randomSeed = self.randomSeed)
-        game.generatePossibleActions()
+        self.recordActionClasses(game.generatePossibleActions())
 
         # Initial observation
         out.append(self.packGameState(actionStrTaken = "",
@@ -74,56 +153,75 @@ class Pathcrawler():
                                       gameOver=game.gameOver,
                                       gameWon=game.gameWon))
 
-        # Run the actions in the game
+        # Run the actions in the game, generating the possible actions after each one as the game's main loop does
         for actionStr in actionStrList:
-            try:
-                game.step(actionStr)
-                out.append(self.packGameState(actionStrTaken=actionStr,
-                                            observationStr=game.observationStr,
-                                            numSteps=game.numSteps,
-                                            score=game.score,
-                                            gameOver=game.gameOver,
-                                            gameWon=game.gameWon))
-            except Exception as e:
-                # Raise the error to the outer loop, causing the entire game to be skipped
-                if self.error_strategy == "raise":
-                    raise e
-
-                # Skip the current action and don't add it to the output
-                elif self.error_strategy == "skip":
-                    continue
-
-                # Treat the error as a failed / unimplemented action
-                elif self.error_strategy == "fail":
-                    out.append(self.packGameState(actionStrTaken=actionStr,
-                                                  observationStr=f"ERROR: {e}",
-                                                  numSteps=game.numSteps,
-                                                  score=game.score,
-                                                  gameOver=True,
-                                                  gameWon=False))
-                else:
-                    raise ValueError(f"Invalid error strategy: {self.error_strategy}")
+            gameState = self.stepGame(game, actionStr)
+            if gameState is not None:
+                out.append(gameState)
+            self.recordActionClasses(game.generatePossibleActions())
 
         # Also store final state
         #out.append(self.packGameState(game, ""))
 
-        return out, game.generatePossibleActions().keys()
-
-    # Crawl the game
-    def crawl(self, maxDepth:int = 3, maxPathsToCrawl:int = 1000, maxCrawlsPerAction:int = 10, actionsSoFar:list = []):
-        # Initialize the progress bar if it isn't already initialized
-        if self.pbar is None:
-            self.pbar = tqdm(total=maxPathsToCrawl, desc=self.tqdm_desc, file=sys.stdout)
-
-        out = []
-
-        # If we have reached the maximum depth, or the maximum number of paths to crawl, return
-        if (maxDepth < 0) or (self.numPathsCrawled >= maxPathsToCrawl):
-            return out
-
-        # Run the game with the current actions, to get the list of possible next actions from this node
-        _, possibleActions = self.run([])
+        return out, game
 
+    # Run one action in the game, and return the packed game state (or None if the action is skipped because of an error)
+    def stepGame(self, game, actionStr:str):
+        try:
+            startTime = time.perf_counter()
+            game.step(actionStr)
+            self.stepTime += time.perf_counter() - startTime
+            self.numStepsTimed += 1
+            return self.packGameState(actionStrTaken=actionStr,
+                                      observationStr=game.observationStr,
+                                      numSteps=game.numSteps,
+                                      score=game.score,
+                                      gameOver=game.gameOver,
+                                      gameWon=game.gameWon,
+                                      objectClasses=self.actionClasses.get(actionStr))
+        except TimeoutError:
+            # The game is stuck, no point in crawling it any further.
+            raise
+        except Exception as e:
+            # Raise the error to the outer loop, causing the entire game to be skipped
+            if self.error_strategy == "raise":
+                raise e
+
+            # Skip the current action and don't add it to the output
+            elif self.error_strategy == "skip":
+                return None
+
+            # Treat the error as a failed / unimplemented action
+            elif self.error_strategy == "fail":
+                return self.packGameState(actionStrTaken=actionStr,
+                                          observationStr=f"ERROR: {e}",
+                                          numSteps=game.numSteps,
+                                          score=game.score,
+                                          gameOver=True,
+                                          gameWon=False,
+                                          crashed=True,
+                                          objectClasses=self.actionClasses.get(actionStr))
+            else:
+                raise ValueError(f"Invalid error strategy: {self.error_strategy}")
+
+    # Measure how long it takes to initialize the game, and to restore it from a snapshot. Returns the snapshot.
+    def calibrate(self, game, numRuns:int = 5):
+        self.calibrated = True
+        snapshot = snapshot_game(game)
+        if snapshot is None:
+            return None
+
+        self.replayTime = min(timeit.repeat(lambda: self.play([]), number=1, repeat=numRuns))
+        self.restoreTime = min(timeit.repeat(lambda: restore_game(snapshot), number=1, repeat=numRuns))
+        return snapshot
+
+    # Whether restoring a snapshot of a state is faster than replaying the actions leading to it.
+    def shouldSnapshot(self, numActions:int):
+        meanStepTime = self.stepTime / max(self.numStepsTimed, 1)
+        return self.restoreTime < self.replayTime + numActions * meanStepTime
+
+    # Shuffle the possible actions, and keep at most maxCrawlsPerAction+1 actions starting with each action verb
+    def sampleActions(self, possibleActions, maxCrawlsPerAction:int):
         # Get the list of possible action verbs (i.e. the first token of each action string)
         #possibleActionVerbs = list(set([actionStr.split(" ")[0] for actionStr in possibleActions]))
         actionVerbCounts = {}
@@ -133,7 +231,7 @@ class Pathcrawler():
         possibleActions = list(possibleActions)
         self.r.shuffle(possibleActions)              # This shuffle uses a random seed that's different from the one that's used to generate the game.
 
-        # Run each of the possible actions
+        sampledActions = []
         for actionStr in possibleActions:
             # Get this strings action verb
             actionVerb = actionStr.split(" ")[0]
@@ -147,30 +245,274 @@ class Pathcrawler():
                 continue
 
             actionVerbCounts[actionVerb] += 1
+            sampledActions.append(actionStr)
+
+        #print("Action verb counts: " + str(actionVerbCounts))
+
+        return sampledActions
+
+    # The possible actions from the game's current state, shuffled and capped per action verb (see sampleActions)
+    # Also refreshes the actions the game accepts in its next step.
+    def nodeActions(self, game, maxCrawlsPerAction:int):
+        try:
+            possibleActions = game.generatePossibleActions()
+        except TimeoutError:
+            raise
+        except Exception:
+            if self.error_strategy == "raise":
+                raise
+
+            # Otherwise, don't expand a node whose actions can't be generated
+            return []
+
+        self.recordActionClasses(possibleActions)
+        return self.sampleActions(possibleActions.keys(), maxCrawlsPerAction)
+
+    # Whether to stop crawling: the budget of paths is spent, or the crawl was cancelled (see crawlParallel)
+    def shouldStop(self, maxPathsToCrawl:int):
+        return (self.numPathsCrawled >= maxPathsToCrawl) or ((self.cancelled is not None) and self.cancelled())
+
+    # Crawl the game
+    # The subtree of each first-level action is shuffled with its own seed, derived from the shuffle random seed and the
+    # action's rank (counted from firstRank), so that crawlParallel can crawl the subtrees separately and get the same paths.
+    # Each crawled path is returned as a PathNode, sharing its prefix with the other paths.
+    # The possible actions of each node are generated once, from the node's state, and passed down to its expansion.
+    # When it's faster than replaying the actions leading to a node, the game is snapshotted at that
+    # node, so each of its actions is only run once from the node's state.
+    def crawl(self, maxDepth:int = 3, maxPathsToCrawl:int = 1000, maxCrawlsPerAction:int = 10, actionsSoFar:list = [],
+              node=None, snapshot=None, possibleActions=None, firstRank:int = 0):
+        # Initialize the progress bar if it isn't already initialized
+        if self.pbar is None:
+            self.pbar = tqdm(total=maxPathsToCrawl, desc=self.tqdm_desc, file=sys.stdout)
+
+        # If we have reached the maximum depth, or the maximum number of paths to crawl, return
+        if (maxDepth < 0) or self.shouldStop(maxPathsToCrawl):
+            return
+
+        # The initial state gets expanded here
+        isRoot = node is None
+        if isRoot:
+            gameStates, game = self.play(actionsSoFar)
+            node = PathNode(gameStates[-1])
+            snapshot = snapshot_game(game) if self.calibrated else self.calibrate(game)
+            if not self.shouldSnapshot(len(actionsSoFar)):
+                snapshot = None
+            if (self.seenStates is not None) and (len(actionsSoFar) == 0):
+                self.seenStates.visit(game_fingerprint(game), maxDepth)
+            if possibleActions is None:
+                possibleActions = self.nodeActions(game, maxCrawlsPerAction)
+
+        # Run each of the possible actions
+        for rank, actionStr in enumerate(possibleActions, start=firstRank):
+            if self.shouldStop(maxPathsToCrawl):
+                break
+
+            if isRoot:
+                self.r.seed(f"{self.shuffleRandomSeed}/{rank}")
 
-            # Run the game with the current actions, plus the new action
+            # Run the new action from the state of this node, or replay all the actions
             actionStrList = actionsSoFar + [actionStr]
-            gameStates, _ = self.run(actionStrList)
+            if snapshot is not None:
+                game = restore_game(snapshot)
+            else:
+                _, game = self.play(actionsSoFar)
 
-            # Append the game states to the output
-            out.append(gameStates)
+            child = PathNode(self.stepGame(game, actionStr), node)
+
+            # Output the path
+            yield child
 
             self.numPathsCrawled += 1
 
             # If we've reached the maximum depth or the maximum number of paths to crawl, return
-            if (maxDepth < 0) or (self.numPathsCrawled >= maxPathsToCrawl):
+            if (maxDepth < 0) or self.shouldStop(maxPathsToCrawl):
                 break
 
             # Update the progress bar
             self.pbar.update(1)
 
+            # Don't expand a state that was already expanded (at least as deep) through another path
+            if (self.seenStates is not None) and not self.seenStates.visit(game_fingerprint(game), maxDepth-1):
+                continue
+
             # Otherwise, if the game isn't over, recurse
-            if (len(gameStates) > 0) and (not gameStates[-1]["gameOver"]):
-                out.extend(self.crawl(maxDepth-1, maxPathsToCrawl, maxCrawlsPerAction, actionStrList))
+            if (maxDepth > 0) and (not child[-1]["gameOver"]):
+                childActions = self.nodeActions(game, maxCrawlsPerAction)
+                childSnapshot = None
+                if self.restoreTime and self.shouldSnapshot(len(actionStrList)):
+                    childSnapshot = snapshot_game(game)
+                yield from self.crawl(maxDepth-1, maxPathsToCrawl, maxCrawlsPerAction, actionStrList, child, childSnapshot,
+                                      childActions)
+
+    # Crawl the game, with the subtree of each first-level action crawled in a worker process
+    # The first-level actions are shuffled, and the game calibrated (see calibrate), once as in crawl(), and each subtree
+    # with the same seed as in crawl(). The subtrees are merged in rank order, up to maxPathsToCrawl paths, so the crawled
+    # paths are those of crawl(), whatever the number of workers or the order they finish in. Only with
+    # prune_duplicate_states can they differ, as each subtree only prunes the states it expanded itself.
+    # The workers share the budget of maxPathsToCrawl paths through the count of paths crawled in each subtree:
+    # a subtree stops once it holds what's left of the budget after the subtrees ranked before it.
+    def crawlParallel(self, gameFile:str, numWorkers:int, maxDepth:int = 3, maxPathsToCrawl:int = 1000, maxCrawlsPerAction:int = 10,
+                      sandboxLimits=None, profiler=None):
+        if self.pbar is None:
+            self.pbar = tqdm(total=maxPathsToCrawl, desc=self.tqdm_desc, file=sys.stdout)
 
-        #print("Action verb counts: " + str(actionVerbCounts))
+        # Workers record their own profile.
+        if profiler is not None:
+            profiler.stop()
+
+        if maxDepth < 0:
+            return
+
+        _, game = self.play([])
+        self.calibrate(game)
+        rankedActions = self.nodeActions(game, maxCrawlsPerAction)
+
+        settings = {
+            "error_strategy": self.error_strategy,
+            "random_seed": self.randomSeed,
+            "prune_duplicate_states": self.seenStates is not None,
+            "profile_games": profiler is not None,
+            "calibration": (self.replayTime, self.restoreTime),
+        }
+        cutoff = multiprocessing.Value("i", len(rankedActions))
+        subtreeSizes = multiprocessing.Array("i", len(rankedActions))
+
+        results = {}
+        lastRank = len(rankedActions) - 1
+        executor = ProcessPoolExecutor(max_workers=numWorkers, initializer=_initCrawlWorker,
+                                       initargs=(gameFile, sandboxLimits, cutoff, subtreeSizes))
+        try:
+            futures = {executor.submit(_crawlSubtree, gameFile, rank, self.shuffleRandomSeed, actionStr,
+                                       maxDepth, maxPathsToCrawl, maxCrawlsPerAction, settings): rank
+                       for rank, actionStr in enumerate(rankedActions)}
+
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+                self.pbar.update(min(sum(subtreeSizes), maxPathsToCrawl) - self.pbar.n)
+                for future in done:
+                    if not future.cancelled():
+                        results[futures[future]] = future
+
+                # The subtrees ranked after the first failing one, or after those filling the budget, won't be used.
+                numPaths = 0
+                for rank in range(len(rankedActions)):
+                    if rank not in results:
+                        break
+                    if results[rank].exception() is None:
+                        numPaths += len(results[rank].result()[0])
+                    if (results[rank].exception() is not None) or (numPaths >= maxPathsToCrawl):
+                        lastRank = cutoff.value = rank
+                        for otherFuture, otherRank in futures.items():
+                            if otherRank > rank:
+                                otherFuture.cancel()
+                        break
+
+                # Stop as soon as every subtree up to the cutoff is done.
+                if all(rank in results for rank in range(lastRank + 1)):
+                    break
+
+        except BaseException:
+            kill_workers(executor)
+            raise
+
+        finally:
+            cutoff.value = -1  # Stop any worker still crawling.
+            executor.shutdown(wait=True, cancel_futures=True)
+
+        self.numPathsCrawled = 0
+        for rank in range(lastRank + 1):
+            # Raises the error of the first failing subtree, as the serial crawl would.
+            subtreePaths, seenStates, profile = results.pop(rank).result()
+            if profiler is not None:
+                profiler.update(profile)
+            if self.seenStates is not None:
+                for fingerprint, remainingSteps in seenStates.items():
+                    self.seenStates.visit(fingerprint, remainingSteps)
+
+            for path in subtreePaths[:maxPathsToCrawl - self.numPathsCrawled]:
+                self.numPathsCrawled += 1
+                yield path
+
+        self.pbar.update(self.numPathsCrawled - self.pbar.n)
+
+
+# Per-process state of the parallel crawl workers.
+_crawlWorker = {}
+
+
+def _initCrawlWorker(gameFile, sandboxLimits, cutoff, subtreeSizes):
+    # Load the game once per worker process, and keep it loaded until the worker exits.
+    _crawlWorker["stack"] = ExitStack()
+    _crawlWorker["TextGame"] = _crawlWorker["stack"].enter_context(load_game(gameFile, sandboxLimits))
+    _crawlWorker["cutoff"] = cutoff
+    _crawlWorker["subtreeSizes"] = subtreeSizes
+
+
+# Progress bar of a worker, whose progress is reported through the subtree sizes instead.
+class _NoProgress():
+    def update(self, n):
+        pass
+
+
+def _crawlSubtree(gameFile, rank, shuffleRandomSeed, actionStr, maxDepth, maxPathsToCrawl, maxCrawlsPerAction, settings):
+    cutoff = _crawlWorker["cutoff"]
+    subtreeSizes = _crawlWorker["subtreeSizes"]
+
+    # Paths of this subtree that can still be used: the budget left by the subtrees ranked before it.
+    # These only grow, so paths past that number would never be merged.
+    def budgetLeft():
+        return maxPathsToCrawl - sum(subtreeSizes[:rank])
+
+    pathcrawler = Pathcrawler(_crawlWorker["TextGame"], error_strategy=settings["error_strategy"], random_seed=settings["random_seed"],
+                              shuffle_random_seed=shuffleRandomSeed, prune_duplicate_states=settings["prune_duplicate_states"])
+    pathcrawler.pbar = _NoProgress()
+    pathcrawler.calibrated = True
+    pathcrawler.replayTime, pathcrawler.restoreTime = settings["calibration"]
+    pathcrawler.cancelled = lambda: (cutoff.value < rank) or (pathcrawler.numPathsCrawled >= budgetLeft())
+
+    profiler = start_profiler(_crawlWorker["TextGame"], gameFile) if settings["profile_games"] else None
+    try:
+        out = []
+        if budgetLeft() > 0:
+            for path in pathcrawler.crawl(maxDepth, maxPathsToCrawl, maxCrawlsPerAction, possibleActions=[actionStr], firstRank=rank):
+                if len(out) >= budgetLeft():
+                    break
 
-        return out
+                out.append(path)
+                subtreeSizes[rank] = len(out)
+    finally:
+        profile = profiler.stop() if profiler is not None else {}
+
+    # Send the fingerprints back, so the unique states are counted across subtrees.
+    seenStates = pathcrawler.seenStates.depths if pathcrawler.seenStates is not None else {}
+    return out, seenStates, profile
+
+
+# A node of the tree of crawled paths: the game state reached by the last action of the path, and the node before it.
+# Behaves like the list of game states along the path, from the initial state to this one.
+class PathNode():
+    __slots__ = ("gameState", "parent")
+
+    def __init__(self, gameState, parent=None):
+        self.gameState = gameState      # None if the action was skipped because of an error
+        self.parent = parent
+
+    def __iter__(self):
+        gameStates = []
+        node = self
+        while node is not None:
+            if node.gameState is not None:
+                gameStates.append(node.gameState)
+            node = node.parent
+
+        return reversed(gameStates)
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def __getitem__(self, index):
+        return list(iter(self))[index]
 
 
 def extract_initial_action_token(action: str):
@@ -181,143 +523,460 @@ def extract_initial_action_token(action: str):
     return action.split(" ")[0].lower()
 
 
-def check_alignment(game_file, args):
+def is_negative_response(observation):
+    '''
+    Whether the game's response to an action is missing, or tells the action failed.
+    '''
+    return observation is None or NEGATIVE_RESPONSE_PATTERN.search(str(observation)) is not None
 
-    metric = {
-        "score": 0,
-        "error_msg": "",
-        "evaluations": [],
-    }
 
-    game_name = os.path.basename(game_file)
+def path_stratum(path, sample_strategy: str):
+    '''
+    Stratum a crawled path is sampled from: its final action token for "action_even",
+    otherwise whether the game's final response was negative or positive.
+    '''
+    if sample_strategy == "action_even":
+        return extract_initial_action_token(path[-1]["actionStrTaken"])
 
-    try:
-        game_module = importlib.import_module(game_name[:-3])
-    except SyntaxError as e:
-        print(f"Syntax error in {game_name}")
-        metric["error_msg"] = str(e)
-        return metric
-    except NameError as e:
-        print(f"Name error in {game_name}")
-        metric["error_msg"] = str(e)
-        return metric
+    return "negative" if is_negative_response(path[-1]["observationStr"]) else "positive"
 
-    # Create the pathcrawler
-    pathcrawler = Pathcrawler(game_module.TextGame, tqdm_desc=f"Crawling paths on {game_name}",
-                                error_strategy=args.error_strategy, random_seed=args.random_seed,
-                                shuffle_random_seed=args.shuffle_random_seed)
 
-    # Crawl the game
+def format_playthrough(path):
+    '''
+    Actions and observations along a crawled path, as shown to the judge.
+    '''
+    return [{"action": str(datapoint["actionStrTaken"]).strip(), "observation": str(datapoint["observationStr"]).strip()}
+            for datapoint in path]
+
+
+def _object_names(action: str):
+    '''
+    Names of the objects an action applies to: the words after its verb, split on prepositions.
+    For example: "put red apple in fridge" --> ["red apple", "fridge"]
+    '''
+    names = []
+    name = []
+    for word in action.lower().split()[1:]:
+        if word in PREPOSITIONS:
+            if name:
+                names.append(" ".join(name))
+            name = []
+        else:
+            name.append(word)
+
+    if name:
+        names.append(" ".join(name))
+    return names
+
+
+def _object_class(actionArg):
+    '''
+    Class of a game object an action applies to, from the arguments of the action in the possible actions.
+    None for the other arguments, e.g. the action's name.
+    '''
+    if isinstance(actionArg, str):
+        match = OBJECT_REPR_PATTERN.match(actionArg)
+        return match.group(1) if match else None
+    if actionArg is None or isinstance(actionArg, (bool, int, float, list, tuple, dict)):
+        return None
+
+    return type(actionArg).__name__
+
+
+def _replace_names(text: str, placeholders: dict):
+    text = " ".join(text.lower().split())
+    if not placeholders:
+        return text
+
+    pattern = re.compile(r"\b(" + "|".join(re.escape(name) for name in sorted(placeholders, key=len, reverse=True)) + r")\b")
+    return pattern.sub(lambda match: placeholders[match.group(1)], text)
+
+
+def canonical_playthrough(path: list):
+    '''
+    The actions and observations along a crawled path, with the names of the objects used by its actions
+    replaced by placeholders holding the object's class, numbered in order of appearance. Playthroughs only
+    differing by objects of the same classes are the same, but "eat apple" and "eat stove" aren't. Objects
+    whose class is unknown keep their name. The initial observation, shared by all playthroughs, is left out.
+    '''
+    placeholders = {}
+    canonical = []
+    for datapoint in path:
+        action = str(datapoint["actionStrTaken"]).strip()
+        if not action:
+            continue
+
+        names = _object_names(action)
+        objectClasses = datapoint.get("objectClasses") or []
+        if len(names) == len(objectClasses):
+            for name, cls in zip(names, objectClasses):
+                placeholders.setdefault(name, f"<{cls}{len(placeholders)}>")
+
+        canonical.append((_replace_names(action, placeholders), _replace_names(str(datapoint["observationStr"]).strip(), placeholders)))
+
+    return tuple(canonical)
+
+
+def group_playthroughs(paths: list):
+    '''
+    Indices of the crawled paths of each equivalence class (see canonical_playthrough), in order of first appearance.
+    '''
+    classes = {}
+    for i, path in enumerate(paths):
+        classes.setdefault(canonical_playthrough(path), []).append(i)
+
+    return list(classes.values())
+
+
+def local_verdict(path: list):
+    '''
+    Evaluation of a crawled path that needs no judgment: "error" if the game crashed along it.
+    None if the path must be judged.
+    '''
+    for datapoint in path:
+        if datapoint.get("crashed"):
+            return {"evaluation": "error", "short_justification": f"the game raised an error on `{str(datapoint['actionStrTaken']).strip()}`"}
+
+    return None
+
+
+def format_playthrough_line(idx: int, playthrough: list):
+    return f'{{"idx": {idx}, "playthrough": {playthrough}}}'
+
+
+def make_alignment_prompt(game_task: str, playthroughs: list):
+    '''
+    Prompt asking to judge the given playthroughs, numbered by their position in the list.
+    '''
+    playthroughs_text = "\n".join(format_playthrough_line(idx, playthrough) for idx, playthrough in enumerate(playthroughs))
+    full_prompt = f"{BASE_PROMPT_ALIGNMENT}\n\nGame Task: {game_task}\n\nHere are the playthroughs to evaluate:\n{playthroughs_text}\n\n"
+    full_prompt += "Evaluation:\n"
+    return full_prompt
+
+
+def make_verdict_prompt(game_task: str, playthrough: list):
+    '''
+    Prompt asking for the single-word verdict of a playthrough.
+    '''
+    return f"{BASE_PROMPT_ALIGNMENT_VERDICT}\n\nGame Task: {game_task}\n\nPlaythrough: {playthrough}\n\nVerdict:"
+
+
+def verdict_probabilities(top_logprobs: dict):
+    '''
+    Probability of each verdict, given the log-probabilities of the first token of the answer. The mass
+    the model puts on other tokens is left out, i.e. the probabilities are normalized over the verdicts.
+    None if none of the tokens is a verdict.
+    '''
+    probabilities = dict.fromkeys(ALIGNMENT_VERDICTS, 0.0)
+    for token, logprob in top_logprobs.items():
+        token = token.strip().strip('"').lower()
+        if token in probabilities:
+            probabilities[token] += math.exp(logprob)
+
+    total = sum(probabilities.values())
+    if total == 0:
+        return None
+
+    return {verdict: probability / total for verdict, probability in probabilities.items()}
+
+
+def pack_playthroughs(playthroughs: list, game_task: str, model: str, token_budget: int):
+    '''
+    Split the playthroughs, in order, into batches whose prompt fits in `token_budget` tokens, leaving
+    ALIGNMENT_RESPONSE_TOKENS tokens per playthrough for its evaluation. The base prompt and the game task
+    are counted once, and each playthrough once. A playthrough too long for the budget gets a batch of its own.
+    '''
+    budget = token_budget - count_tokens(make_alignment_prompt(game_task, []), model)
+
+    batches = []
+    batch, batch_tokens = [], 0
+    for playthrough in playthroughs:
+        # The idx of a playthrough depends on its batch, but any idx below 1000 is a single token.
+        tokens = count_tokens(format_playthrough_line(0, playthrough) + "\n", model) + ALIGNMENT_RESPONSE_TOKENS
+        if batch and batch_tokens + tokens > budget:
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+
+        batch.append(playthrough)
+        batch_tokens += tokens
+
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+
+def _parse_evaluation_line(line: str):
+    '''
+    Evaluations found on a line of the response: a JSON object or list, a Python literal,
+    or failing that the idx and evaluation salvaged from malformed JSON. Several objects
+    on the same line are parsed separately.
+    '''
+    for loads in (json.loads, ast.literal_eval):
+        try:
+            data = loads(line)
+        except (ValueError, SyntaxError, TypeError, MemoryError, RecursionError):
+            continue
+
+        if isinstance(data, dict):
+            return [data]
+        if isinstance(data, list):
+            return [item for item in data if isinstance(item, dict)]
+
+    objects = OBJECT_SEPARATOR.split(line)
+    if len(objects) > 1:
+        return [data for obj in objects for data in _parse_evaluation_line(obj)]
+
+    idx = IDX_PATTERN.search(line)
+    evaluation = EVALUATION_PATTERN.search(line)
+    if idx is None or evaluation is None:
+        return []
+
+    justification = JUSTIFICATION_PATTERN.search(line)
+    return [{"idx": idx.group(1), "evaluation": evaluation.group(1), "short_justification": justification.group(1) if justification else ""}]
+
+
+def parse_alignment_response(response: str, num_playthroughs: int):
+    '''
+    Evaluations of a response, keyed by idx. Code fences, list brackets, trailing commas and malformed
+    lines are tolerated, and evaluations without a valid idx or verdict (see ALIGNMENT_VERDICTS) are left out.
+    '''
+    evaluations = {}
+    for line in response.split("\n"):
+        line = line.strip().rstrip(",")
+        if line == "" or line.startswith("```") or line in ("[", "]"):
+            continue  # Skip empty lines and formatting
+
+        for data in _parse_evaluation_line(line):
+            try:
+                idx = int(data.pop("idx"))
+            except (KeyError, TypeError, ValueError):
+                continue
+
+            evaluation = data.get("evaluation")
+            if not isinstance(evaluation, str) or evaluation.strip().lower() not in ALIGNMENT_VERDICTS:
+                continue
+
+            if 0 <= idx < num_playthroughs and idx not in evaluations:
+                data["evaluation"] = evaluation.strip().lower()
+                evaluations[idx] = data
+
+    return evaluations
+
+
+async def judge_batch(playthroughs: list, game_task: str, model: str, semaphore: asyncio.Semaphore, max_retries: int = 2):
+    '''
+    Judge a batch of playthroughs in a single prompt, waiting for the semaphore before each request.
+    The playthroughs missing from the response, or whose evaluation can't be parsed, are sent again
+    together in a single prompt, up to `max_retries` times. Returns the evaluation of each playthrough,
+    None for those still missing, and the number of requests sent.
+    '''
+    evaluations = [None] * len(playthroughs)
+    missing = list(range(len(playthroughs)))
+    num_requests = 0
+    while missing and num_requests <= max_retries:
+        if num_requests > 0:
+            print(colored(f"Warning: missing response for {len(missing)} playthrough(s). Recomputing...", "yellow"))
+
+        async with semaphore:
+            response = await async_llm_gpt(make_alignment_prompt(game_task, [playthroughs[i] for i in missing]), model=model)
+        num_requests += 1
+
+        # The playthroughs sent again are numbered by their position in the new prompt.
+        for idx, data in parse_alignment_response(response, len(missing)).items():
+            data["playthrough"] = playthroughs[missing[idx]]
+            evaluations[missing[idx]] = data
+
+        missing = [i for i in missing if evaluations[i] is None]
+
+    return evaluations, num_requests
+
+
+async def judge_paths(playthroughs: list, game_task: str, args):
+    '''
+    Judge the playthroughs in batches of `args.alignment_batch_size`, or packed up to `args.alignment_token_budget`
+    tokens if given, with at most `args.alignment_concurrency` requests in flight. Each batch numbers its
+    playthroughs from 0, and the evaluations are returned in the order of the playthroughs, whatever order
+    the responses arrive in, along with the number of requests sent. Playthroughs that couldn't be judged are None.
+    '''
+    if args.alignment_token_budget:
+        batches = pack_playthroughs(playthroughs, game_task, args.alignment_model_name, args.alignment_token_budget)
+    else:
+        batches = list(batched(playthroughs, args.alignment_batch_size))
+
+    semaphore = asyncio.Semaphore(args.alignment_concurrency)
+    pbar = tqdm(desc="Querying OpenAI API", total=len(playthroughs), leave=False)
+
+    async def judge(batch):
+        evaluations, num_requests = await judge_batch(batch, game_task, args.alignment_model_name, semaphore,
+                                                      args.alignment_max_retries)
+        pbar.update(len(batch))
+        return evaluations, num_requests
+
     try:
-        out = pathcrawler.crawl(maxDepth=args.max_depth, maxPathsToCrawl=args.max_paths)       # Hyperparameters, can change these
-    except Exception as e:
-        pathcrawler.pbar.leave = False
-        pathcrawler.pbar.close()
-        print(f"Encountered the following error while crawling {game_name}: {e}")
-        metric["error_msg"] = str(e)
-        return metric
+        results = await asyncio.gather(*(judge(batch) for batch in batches))
+    finally:
+        pbar.close()
 
-    packed = {
-            "gameName": game_name,
-            "gameTask": pathcrawler.getGameTaskDescription(),
-            "paths": out,
-        }
+    evaluations = [evaluation for batch_evaluations, _ in results for evaluation in batch_evaluations]
+    return evaluations, sum(num_requests for _, num_requests in results)
+
+
+async def judge_verdict(playthrough: list, game_task: str, model: str, semaphore: asyncio.Semaphore):
+    '''
+    Judge a playthrough from the log-probabilities of a single-token answer. Returns its most likely
+    verdict and that verdict's probability, or None if the answer isn't a verdict.
+    '''
+    async with semaphore:
+        top_logprobs = await async_llm_logprobs(make_verdict_prompt(game_task, playthrough), model=model)
+
+    probabilities = verdict_probabilities(top_logprobs)
+    if probabilities is None:
+        return None
+
+    evaluation = max(probabilities, key=probabilities.get)
+    return {"evaluation": evaluation, "probability": round(probabilities[evaluation], 4), "short_justification": "",
+            "playthrough": playthrough}
 
-    game_task = packed["gameTask"]
 
-    all_paths = packed["paths"]
-    negative_response_paths = [path for path in packed["paths"] if path[-1]["observationStr"] is None or
-                            any([phrase in str(path[-1]["observationStr"]).lower() for phrase in NEGATIVE_RESPONSE_PHRASES])]
-    positive_response_paths = [path for path in packed["paths"] if not (path[-1]["observationStr"] is None or
-                            any([phrase in str(path[-1]["observationStr"]).lower() for phrase in NEGATIVE_RESPONSE_PHRASES]))]
+async def judge_paths_logprobs(playthroughs: list, game_task: str, args):
+    '''
+    Judge each playthrough with a single-token verdict, then judge the playthroughs whose verdict has a
+    probability below `args.alignment_confidence` again with justifications (see judge_paths). Returns the
+    evaluations, None for the playthroughs that couldn't be judged, the number of requests sent and the
+    number of playthroughs judged again.
+    '''
+    semaphore = asyncio.Semaphore(args.alignment_concurrency)
+    pbar = tqdm(desc="Querying OpenAI API", total=len(playthroughs), leave=False)
 
-    paths_by_action = defaultdict(list)
-    for path in packed["paths"]:
-        paths_by_action[extract_initial_action_token(path[-1]["actionStrTaken"])].append(path)
+    async def judge(playthrough):
+        evaluation = await judge_verdict(playthrough, game_task, args.alignment_model_name, semaphore)
+        pbar.update(1)
+        return evaluation
 
-    # Subsample a specified number of paths to pass to OpenAI, based on selected strategy
-    sampled_paths = []
+    try:
+        evaluations = await asyncio.gather(*(judge(playthrough) for playthrough in playthroughs))
+    finally:
+        pbar.close()
 
-    # Sample paths evenly between those with a 'positive' and 'negative' final console response
-    if args.sample_strategy == "pos_neg_even":
-        sampled_paths.extend(random.sample(negative_response_paths, min(args.num_samples_per_game // 2, len(negative_response_paths))))
-        sampled_paths.extend(random.sample(positive_response_paths, min(args.num_samples_per_game // 2, len(positive_response_paths))))
+    # Fall back to justified evaluations when the model isn't confident, keeping its verdict if those fail too.
+    unsure = [i for i, evaluation in enumerate(evaluations) if evaluation is None or evaluation["probability"] < args.alignment_confidence]
+    justified, num_requests = await judge_paths([playthroughs[i] for i in unsure], game_task, args)
+    for i, evaluation in zip(unsure, justified):
+        if evaluation is not None:
+            evaluations[i] = evaluation
 
-        num_samples_added = min(args.num_samples_per_game // 2, len(negative_response_paths)) + min(args.num_samples_per_game // 2, len(positive_response_paths))
+    return evaluations, len(playthroughs) + num_requests, len(unsure)
 
-    # Sample paths proportionally to the number of paths in each category
-    elif args.sample_strategy == "pos_neg_proportional":
-        num_negative_samples = int(len(negative_response_paths) / len(out["paths"]) * args.num_samples_per_game)
-        num_positive_samples = int(len(positive_response_paths) / len(out["paths"]) * args.num_samples_per_game)
 
-        sampled_paths.extend(random.sample(negative_response_paths, min(num_negative_samples, len(negative_response_paths))))
-        sampled_paths.extend(random.sample(positive_response_paths, min(num_positive_samples, len(positive_response_paths))))
+def check_alignment(game_file, args):
 
-        num_samples_added = min(num_negative_samples, len(negative_response_paths)) + min(num_positive_samples, len(positive_response_paths))
+    metric = {
+        "score": 0,
+        "error_msg": "",
+        "num_unique_states": 0,
+        "num_requests": 0,
+        "requests_saved": 0,
+        "num_unjudged": 0,
+        "num_deduplicated": 0,
+        "num_local_verdicts": 0,
+        "num_low_confidence": 0,
+        "evaluations": [],
+    }
+
+    game_name = os.path.basename(game_file)
 
-    # Sample paths evenly between each final action (as determined by the first action token)
-    elif args.sample_strategy == "action_even":
-        samples_per_action = args.num_samples_per_game // len(paths_by_action)
+    with ExitStack() as stack:
+        try:
+            TextGame = stack.enter_context(load_game(game_file, get_sandbox_limits(args)))
+        except SyntaxError as e:
+            print(f"Syntax error in {game_name}")
+            metric["error_msg"] = str(e)
+            return metric
+        except NameError as e:
+            print(f"Name error in {game_name}")
+            metric["error_msg"] = str(e)
+            return metric
+        except GameError as e:
+            print(f"Error while loading {game_name}")
+            metric["error_msg"] = str(e)
+            return metric
+
+        profiler = None
+        if args.profile_games:
+            profiler = start_profiler(TextGame, game_file)
+            stack.callback(lambda: metric.update(profile=profiler.stop()))
+
+        # Create the pathcrawler
+        pathcrawler = Pathcrawler(TextGame, tqdm_desc=f"Crawling paths on {game_name}",
+                                    error_strategy=args.error_strategy, random_seed=args.random_seed,
+                                    shuffle_random_seed=args.shuffle_random_seed,
+                                    prune_duplicate_states=args.prune_duplicate_states)
+
+        # Subsample a specified number of paths to pass to OpenAI, based on selected strategy, while crawling the game
+        # Seeded, so the same crawled paths always give the same sample.
+        sampler = StratifiedSampler(args.sample_strategy, args.num_samples_per_game, random.Random(args.shuffle_random_seed))
+
+        # Crawl the game
+        try:
+            if args.crawl_workers > 1:
+                paths = pathcrawler.crawlParallel(game_file, args.crawl_workers, maxDepth=args.max_depth, maxPathsToCrawl=args.max_paths,
+                                                  sandboxLimits=get_sandbox_limits(args), profiler=profiler)
+            else:
+                paths = pathcrawler.crawl(maxDepth=args.max_depth, maxPathsToCrawl=args.max_paths)       # Hyperparameters, can change these
+
+            for path in paths:
+                sampler.add(path, path_stratum(path, args.sample_strategy))
+        except Exception as e:
+            pathcrawler.pbar.leave = False
+            pathcrawler.pbar.close()
+            print(f"Encountered the following error while crawling {game_name}: {e}")
+            metric["error_msg"] = str(e)
+            metric[TRANSIENT_ERROR] = isinstance(e, GameTimeBudgetError)
+            return metric
+
+        metric["num_unique_states"] = len(pathcrawler.seenStates or [])
+        game_task = pathcrawler.getGameTaskDescription()
+
+    sampled_paths = sampler.sample()
+    playthroughs = [format_playthrough(path) for path in sampled_paths]
+
+    # Only judge one playthrough of each class of playthroughs differing by the objects they use
+    if args.dedup_playthroughs:
+        classes = group_playthroughs(sampled_paths)
+    else:
+        classes = [[i] for i in range(len(playthroughs))]
+    metric["num_deduplicated"] = len(playthroughs) - len(classes)
 
-        num_samples_added = 0
-        for action, action_paths in paths_by_action.items():
-            num_samples_added += min(samples_per_action, len(action_paths))
-            sampled_paths.extend(random.sample(action_paths, min(samples_per_action, len(action_paths))))
+    # Label the classes needing no judgment locally, and send the others to the LLM, concurrently
+    verdicts = [local_verdict(sampled_paths[members[0]]) for members in classes]
+    to_judge = [k for k, verdict in enumerate(verdicts) if verdict is None]
+    metric["num_local_verdicts"] = sum(len(classes[k]) for k in range(len(classes)) if verdicts[k] is not None)
 
+    representatives = [playthroughs[classes[k][0]] for k in to_judge]
+    if args.alignment_judge == "logprob":
+        judged, metric["num_requests"], metric["num_low_confidence"] = asyncio.run(judge_paths_logprobs(representatives, game_task, args))
     else:
-        raise ValueError(f"Invalid SAMPLE_STRATEGY: {args.sample_strategy}")
-
-    # After subsampling paths, if we failed to add enough samples, add more randomly
-    # NOTE: this has the potential for sampling the same path more than once.
-    if num_samples_added < args.num_samples_per_game:
-        sampled_paths.extend(random.sample(all_paths, min(args.num_samples_per_game - num_samples_added, len(all_paths))))
-
-    def _parse_response(response):
-        data = []
-        for json_data in response.split("\n"):
-            if json_data.strip() == "":
-                continue  # Skip empty lines
-
-            data.append(json.loads(json_data))
-        return data
-
-    evaluations = []
-    pbar = iter(tqdm(sampled_paths, desc="Querying OpenAI API", total=len(sampled_paths), leave=False))
-    for paths in batched(pbar, args.alignment_batch_size):
-        playthroughs = []
-        for i, path in enumerate(paths):
-            playthrough = []
-            for datapoint in path:
-                action = str(datapoint["actionStrTaken"]).strip()
-                observation = str(datapoint["observationStr"]).strip()
-
-                playthrough.append({"action": action, "observation": observation})
-
-            playthroughs.append(f'{{"idx": {i}, "playthrough": {playthrough}}}')
-
-        playthroughs_text = "\n".join(playthroughs)
-        full_prompt = f"{BASE_PROMPT_ALIGNMENT}\n\nGame Task: {game_task}\n\nHere are the playthroughs to evaluate:\n{playthroughs_text}\n\n"
-        full_prompt += "Evaluation:\n"
-
-        response = stream_llm_gpt(full_prompt, model=args.alignment_model_name)
-        response_data = _parse_response(response)
-
-        idx = 0
-        for data in response_data:
-            if idx != data['idx']:
-                print(colored(f"Warning: missing response for playthrough {idx}. Recomputing...", "yellow"))
-                full_prompt = f"{BASE_PROMPT_ALIGNMENT}\n\nGame Task: {game_task}\n\nHere are the playthroughs to evaluate:\n{playthroughs[idx]}\n\n"
-                full_prompt += "Evaluation:\n"
-                response = stream_llm_gpt(full_prompt, model=args.alignment_model_name)
-                data = _parse_response(response)
-                assert idx == data['idx'], "TODO: Retry?"
-
-            data.pop("idx")
-            data["playthrough"] = eval(playthroughs[idx])["playthrough"]
-            evaluations.append(data)
-            idx += 1
-
-    assert len(sampled_paths) == len(evaluations), "For some reason, we don't have the right amount of evaluations."
+        judged, metric["num_requests"] = asyncio.run(judge_paths(representatives, game_task, args))
+    metric["requests_saved"] = len(sampled_paths) - metric["num_requests"]    # Compared to judging each path separately
+    for k, verdict in zip(to_judge, judged):
+        verdicts[k] = verdict
+
+    # Each member of a class gets the verdict of the class
+    evaluations = [None] * len(playthroughs)
+    for members, verdict in zip(classes, verdicts):
+        for i in members:
+            if verdict is not None:
+                evaluations[i] = dict(verdict, playthrough=playthroughs[i], class_size=len(members))
+
+    # Paths still missing from the responses after the retries don't count towards the score.
+    # Neither are they cached, to ask for them again next time.
+    metric["num_unjudged"] = evaluations.count(None)
+    metric[TRANSIENT_ERROR] = metric["num_unjudged"] > 0
+    evaluations = [e for e in evaluations if e is not None]
+    if not evaluations:
+        metric["error_msg"] = f"No valid evaluation in the responses of {args.alignment_model_name}."
+        return metric
 
     metric["score"] = sum(e['evaluation'].lower().strip().startswith('yes') for e in evaluations) / len(evaluations)
     metric["evaluations"] = evaluations
@@ -0,0 +1,194 @@
+import json
+import threading
+
+import openai
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+
+from bytes32.cache import make_response_key
+
+
+# Request arguments that don't change the response, left out of its key
+TRANSPORT_PARAMS = ("model", "messages", "timeout", "stream", "stream_options")
+
+
+def request_key(kwargs):
+    """ Key of a chat completion request: hash of the model, the messages and the sampling parameters. """
+    params = {name: value for name, value in kwargs.items() if name not in TRANSPORT_PARAMS}
+    return make_response_key(kwargs["model"], kwargs["messages"], params)
+
+
+class OpenAIBackend():
+    """ Send the chat completion requests to the OpenAI API, or Azure OpenAI if `openai.api_type` is "azure".
+    The clients read their configuration (API key, `OPENAI_BASE_URL`, ...) from the environment by default. """
+
+    def __init__(self, **client_kwargs):
+        if openai.api_type == "azure":
+            self.client = openai.AzureOpenAI(**client_kwargs)
+            self.async_client = openai.AsyncAzureOpenAI(**client_kwargs)
+        else:
+            self.client = openai.OpenAI(**client_kwargs)
+            self.async_client = openai.AsyncOpenAI(**client_kwargs)
+
+    def create(self, **kwargs):
+        return self.client.chat.completions.create(**kwargs)
+
+    async def acreate(self, **kwargs):
+        return await self.async_client.chat.completions.create(**kwargs)
+
+
+class RecordBackend():
+    """ Send the requests to another backend, and append each request and its response to a JSONL log,
+    to replay them later with `ReplayBackend`. Streamed responses are logged once fully received. """
+
+    def __init__(self, filename, backend=None):
+        self.filename = filename
+        self.backend = backend or OpenAIBackend()
+        self.lock = threading.Lock()
+
+    def create(self, **kwargs):
+        response = self.backend.create(**kwargs)
+        if kwargs.get("stream"):
+            return self._record_stream(response, kwargs)
+
+        self._write(kwargs, completion_record(response))
+        return response
+
+    async def acreate(self, **kwargs):
+        response = await self.backend.acreate(**kwargs)
+        if kwargs.get("stream"):
+            return self._arecord_stream(response, kwargs)
+
+        self._write(kwargs, completion_record(response))
+        return response
+
+    def _record_stream(self, stream, kwargs):
+        record = StreamRecord()
+        for chunk in stream:
+            record.add(chunk)
+            yield chunk
+
+        self._write(kwargs, record.record())
+
+    async def _arecord_stream(self, stream, kwargs):
+        record = StreamRecord()
+        async for chunk in stream:
+            record.add(chunk)
+            yield chunk
+
+        self._write(kwargs, record.record())
+
+    def _write(self, kwargs, record):
+        record = dict(key=request_key(kwargs), model=kwargs["model"], messages=kwargs["messages"], **record)
+        with self.lock, open(self.filename, "a") as f:
+            f.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+
+class ReplayBackend():
+    """ Answer the requests with the responses recorded by `RecordBackend`, without any network access.
+    Requests that weren't recorded raise a LookupError. """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.records = {}
+        with open(filename) as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    self.records[record["key"]] = record
+
+    def create(self, **kwargs):
+        record = self._lookup(kwargs)
+        if kwargs.get("stream"):
+            include_usage = (kwargs.get("stream_options") or {}).get("include_usage", False)
+            return replay_stream(record, kwargs["model"], include_usage)
+
+        return replay_completion(record, kwargs["model"])
+
+    async def acreate(self, **kwargs):
+        response = self.create(**kwargs)
+        if kwargs.get("stream"):
+            return _aiter(response)
+
+        return response
+
+    def _lookup(self, kwargs):
+        record = self.records.get(request_key(kwargs))
+        if record is None:
+            raise LookupError(f"No recorded response in {self.filename} for this request to {kwargs['model']}.")
+
+        return record
+
+
+def completion_record(response):
+    """ What is logged of a chat completion: the content, finish reason and logprobs of each choice, and the usage. """
+    choices = [{"content": choice.message.content, "finish_reason": choice.finish_reason,
+                "logprobs": choice.logprobs.model_dump(exclude_none=True) if choice.logprobs else None}
+               for choice in response.choices]
+    return {"choices": choices, "usage": response.usage.model_dump(exclude_none=True) if response.usage else None}
+
+
+class StreamRecord():
+    """ What is logged of a streamed chat completion, like `completion_record`, built from its chunks. """
+
+    def __init__(self):
+        self.contents, self.finish_reasons, self.usage = {}, {}, None
+
+    def add(self, chunk):
+        for choice in chunk.choices:
+            self.contents[choice.index] = self.contents.get(choice.index, "") + (choice.delta.content or "")
+            self.finish_reasons[choice.index] = choice.finish_reason or self.finish_reasons.get(choice.index)
+
+        if chunk.usage is not None:
+            self.usage = chunk.usage.model_dump(exclude_none=True)
+
+    def record(self):
+        choices = [{"content": self.contents[index], "finish_reason": self.finish_reasons[index], "logprobs": None}
+                   for index in sorted(self.contents)]
+        return {"choices": choices, "usage": self.usage}
+
+
+def replay_completion(record, model):
+    return ChatCompletion.model_validate({
+        "id": "chatcmpl-replay",
+        "object": "chat.completion",
+        "created": 0,
+        "model": model,
+        "choices": [{"index": index, "message": {"role": "assistant", "content": choice["content"]},
+                     "finish_reason": choice["finish_reason"] or "stop", "logprobs": choice["logprobs"]}
+                    for index, choice in enumerate(record["choices"])],
+        "usage": record["usage"],
+    })
+
+
+def replay_stream(record, model, include_usage=False):
+    """ Chunks of a recorded response: the whole content of each choice in a single chunk. """
+    def chunk(choices, usage=None):
+        return ChatCompletionChunk.model_validate({"id": "chatcmpl-replay", "object": "chat.completion.chunk", "created": 0,
+                                                   "model": model, "choices": choices, "usage": usage})
+
+    for index, choice in enumerate(record["choices"]):
+        yield chunk([{"index": index, "delta": {"role": "assistant", "content": choice["content"]}, "finish_reason": None}])
+        yield chunk([{"index": index, "delta": {}, "finish_reason": choice["finish_reason"] or "stop"}])
+
+    if include_usage and record["usage"] is not None:
+        yield chunk([], record["usage"])
+
+
+async def _aiter(iterable):
+    for item in iterable:
+        yield item
+
+
+def make_backend(name, log_file=None):
+    """ Backend called `name`, recording to or replaying from `log_file`. """
+    if name in ("record", "replay") and not log_file:
+        raise ValueError(f"The {name} LLM backend needs a log file.")
+
+    if name == "openai":
+        return OpenAIBackend()
+    if name == "record":
+        return RecordBackend(log_file)
+    if name == "replay":
+        return ReplayBackend(log_file)
+
+    raise ValueError(f"Invalid LLM backend: {name}")
@@ -0,0 +1,114 @@
+import io
+import os
+import json
+import time
+import hashlib
+
+from termcolor import colored
+
+from bytes32 import utils
+from bytes32.backends import OpenAIBackend
+
+
+# Endpoint the batched requests are sent to, and how long the API may take to run them
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_COMPLETION_WINDOW = "24h"
+
+# Statuses of a batch that won't change anymore
+BATCH_FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+def batch_request(custom_id, prompt, model, n=1, **params):
+    """ Line of a batch input file asking for the answer to a prompt, with the sampling parameters of `call_gpt`. """
+    body = dict(utils.SAMPLING_PARAMS, model=model, messages=[{"role": "user", "content": prompt}], n=n, **params)
+    return {"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT, "body": body}
+
+
+def run_batch(requests, batch_file, client=None, poll_interval=60):
+    """ Answer `batch_request`s through the Batch API, returning the outputs keyed by custom id,
+    as `llm_gpt` would return them: the answer, or the list of answers if n > 1.
+
+    Requests already in the response cache aren't sent, and the new responses are stored in it.
+    The pending requests are written to `batch_file`, and the id of the batch running them to
+    `{batch_file}.batch_id`, so that running the same requests again after an interruption waits
+    for that batch instead of submitting a new one. Failed requests are left out of the outputs.
+    """
+    outputs, pending = {}, {}
+    for request in requests:
+        body = request["body"]
+        params = {name: value for name, value in body.items() if name not in ("model", "messages")}
+        key, output = utils._cached_response(body["model"], body["messages"], params)
+        if output is not None:
+            outputs[request["custom_id"]] = output
+        else:
+            pending[request["custom_id"]] = (request, key)
+
+    if not pending:
+        return outputs
+
+    if client is None:
+        backend = utils.get_backend()
+        if not isinstance(backend, OpenAIBackend):
+            raise ValueError("The Batch API needs the openai LLM backend.")
+
+        client = backend.client
+
+    content = "".join(json.dumps(request) + "\n" for request, _ in pending.values()).encode()
+    batch = _submit_batch(client, content, batch_file)
+    while batch.status not in BATCH_FINAL_STATUSES:
+        counts = batch.request_counts
+        print(colored(f"Batch {batch.id} {batch.status}" + (f": {counts.completed}/{counts.total} done." if counts else "."), "yellow"))
+        time.sleep(poll_interval)
+        batch = client.batches.retrieve(batch.id)
+
+    lines = []
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if file_id:
+            lines += client.files.content(file_id).text.splitlines()
+
+    for line in lines:
+        if not line.strip():
+            continue
+
+        result = json.loads(line)
+        response = result.get("response") or {}
+        if result["custom_id"] not in pending or result.get("error") or response.get("status_code") != 200:
+            continue  # Reported below.
+
+        request, key = pending[result["custom_id"]]
+        contents = [choice["message"]["content"].strip() for choice in response["body"]["choices"]]
+        output = contents[0] if request["body"]["n"] == 1 else contents
+        outputs[result["custom_id"]] = utils._cache_response(key, request["body"]["model"], output)
+
+    missing = [custom_id for custom_id in pending if custom_id not in outputs]
+    if missing:
+        print(colored(f"Batch {batch.id} {batch.status}, {len(missing)} of {len(pending)} requests failed: {', '.join(missing[:10])}", "red"))
+
+    return outputs
+
+
+def _submit_batch(client, content, batch_file):
+    """ Batch running the requests in `content`: the one already submitted for them, if any, otherwise a new one. """
+    digest = hashlib.sha256(content).hexdigest()
+    try:
+        with open(f"{batch_file}.batch_id") as f:
+            submitted = json.load(f)
+
+        if submitted["sha256"] == digest:
+            batch = client.batches.retrieve(submitted["batch_id"])
+            if batch.status not in ("failed", "expired", "cancelled"):
+                print(colored(f"Resuming batch {batch.id}.", "yellow"))
+                return batch
+    except FileNotFoundError:
+        pass
+
+    with open(batch_file, "wb") as f:
+        f.write(content)
+
+    input_file = client.files.create(file=(os.path.basename(batch_file), io.BytesIO(content)), purpose="batch")
+    batch = client.batches.create(input_file_id=input_file.id, endpoint=BATCH_ENDPOINT, completion_window=BATCH_COMPLETION_WINDOW)
+    with open(f"{batch_file}.batch_id", "w") as f:
+        json.dump({"batch_id": batch.id, "sha256": digest}, f)
+
+    print(colored(f"Submitted batch {batch.id} of {len(content.splitlines())} requests.", "yellow"))
+    return batch
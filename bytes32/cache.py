@@ -0,0 +1,241 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+
+from bytes32.version import __version__
+
+
+# Arguments each check depends on, besides the source code of the game.
+# Arguments that only change how a result is computed (e.g. number of workers) are left out.
+CHECK_ARGS = {
+    "validity": ["max_steps", "random_seed", "max_num_actions", "prune_duplicate_states", "validity_order", "profile_games",
+                 "sandbox", "sandbox_max_memory", "sandbox_max_cpu_time", "sandbox_step_timeout", "sandbox_game_timeout"],
+    "compliance": ["compliance_model_name", "compliance_majority_vote"],
+    "alignment": ["alignment_model_name", "random_seed", "shuffle_random_seed", "max_depth", "max_paths", "error_strategy",
+                  "num_samples_per_game", "sample_strategy", "alignment_batch_size", "alignment_token_budget",
+                  "prune_duplicate_states", "profile_games", "crawl_workers", "dedup_playthroughs", "alignment_judge",
+                  "alignment_confidence"],
+    "winnability": ["agent_model_name", "env_step_limit", "game_random_seed"],
+}
+
+# Key of a check result recording a failure that may not happen again (e.g. an LLM error, or running
+# out of wall-clock time on a loaded machine). Such results aren't cached, and `cached_check` removes the key from them.
+TRANSIENT_ERROR = "transient_error"
+
+# Placeholders of the game's file in the cached results, e.g. in tracebacks, from the longest form to the shortest.
+GAMEFILE_PLACEHOLDERS = ("<gamefile:abspath>", "<gamefile:cwdpath>", "<gamefile:path>", "<gamefile:name>")
+
+
+def hash_file(filename):
+    with open(filename, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def make_key(check, gamefile, args, extra_files=(), extra_inputs=()):
+    """ Key of a check's result: hash of the game source, the check's arguments, any other input file and any other
+    input (e.g. taken from the game's file name). The name itself isn't part of it, so that renamed copies of a game,
+    like unchanged reflection revisions, share its results. """
+    inputs = {
+        "version": __version__,
+        "check": check,
+        "source": hash_file(gamefile),
+        "args": {name: getattr(args, name, None) for name in CHECK_ARGS[check]},
+        "files": [hash_file(filename) for filename in extra_files],
+        "inputs": list(extra_inputs),
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+class ResultCache():
+    """ Persistent cache of check results, stored in a SQLite database. """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "  check_name TEXT, key TEXT, gamefile TEXT, result TEXT,"
+            "  created REAL, accessed REAL,"
+            "  PRIMARY KEY (check_name, key))"
+        )
+        self.db.commit()
+
+    def get(self, check, key):
+        row = self.db.execute("SELECT result FROM results WHERE check_name = ? AND key = ?", (check, key)).fetchone()
+        if row is None:
+            return None
+
+        self.db.execute("UPDATE results SET accessed = ? WHERE check_name = ? AND key = ?", (time.time(), check, key))
+        self.db.commit()
+        return json.loads(row[0])
+
+    def put(self, check, key, result, gamefile=""):
+        now = time.time()
+        self.db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+                        (check, key, gamefile, json.dumps(result), now, now))
+        self.db.commit()
+
+    def evict(self, older_than=None, check=None, max_entries=None):
+        """ Remove the entries not accessed for `older_than` seconds, then the least recently used ones
+        beyond `max_entries`. Only entries of `check` are considered if given. Returns the number removed. """
+        where, params = "1", []
+        if check:
+            where, params = "check_name = ?", [check]
+
+        removed = 0
+        if older_than is not None:
+            cursor = self.db.execute(f"DELETE FROM results WHERE {where} AND accessed < ?", params + [time.time() - older_than])
+            removed += cursor.rowcount
+
+        if max_entries is not None:
+            cursor = self.db.execute(
+                f"DELETE FROM results WHERE rowid IN ("
+                f"  SELECT rowid FROM results WHERE {where} ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                params + [max_entries])
+            removed += cursor.rowcount
+
+        self.db.commit()
+        return removed
+
+    def compact(self):
+        """ Reclaim the space left by removed entries. """
+        self.db.execute("VACUUM")
+
+    def stats(self):
+        return dict(self.db.execute("SELECT check_name, COUNT(*) FROM results GROUP BY check_name").fetchall())
+
+    def close(self):
+        self.db.close()
+
+
+def make_response_key(model, messages, params):
+    """ Key of an LLM response: hash of the model, the messages and the sampling parameters. """
+    inputs = {"model": model, "messages": messages, "params": params}
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class ResponseCache():
+    """ Persistent cache of LLM responses, stored in a SQLite database.
+
+    In `readonly` mode new responses aren't stored, and in `refresh` mode cached
+    responses aren't used but are replaced by the new ones. Once the responses take
+    more than `max_size` bytes, the least recently used ones are removed.
+    """
+
+    MODES = ("readwrite", "readonly", "refresh")
+
+    def __init__(self, filename, mode="readwrite", max_size=None):
+        if mode not in self.MODES:
+            raise ValueError(f"Invalid response cache mode: {mode}")
+
+        self.filename = filename
+        self.mode = mode
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.db = sqlite3.connect(filename)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "  key TEXT PRIMARY KEY, model TEXT, response TEXT, size INTEGER,"
+            "  created REAL, accessed REAL)"
+        )
+        self.db.commit()
+        self.size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, key):
+        row = None
+        if self.mode != "refresh":
+            row = self.db.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+        self.db.commit()
+        return json.loads(row[0])
+
+    def put(self, key, model, response):
+        if self.mode == "readonly":
+            return
+
+        data = json.dumps(response)
+        old = self.db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        now = time.time()
+        self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)", (key, model, data, len(data), now, now))
+        self.db.commit()
+        self.size += len(data) - (old[0] if old else 0)
+
+        if self.max_size is not None and self.size > self.max_size:
+            self.evict(self.max_size)
+
+    def evict(self, max_size):
+        """ Remove the least recently used responses until they take at most `max_size` bytes. Returns the number removed. """
+        keys = []
+        for key, size in self.db.execute("SELECT key, size FROM responses ORDER BY accessed"):
+            if self.size <= max_size:
+                break
+
+            keys.append(key)
+            self.size -= size
+
+        self.db.executemany("DELETE FROM responses WHERE key = ?", [(key,) for key in keys])
+        self.db.commit()
+        return len(keys)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+    def close(self):
+        self.db.close()
+
+
+def gamefile_forms(gamefile):
+    """ Forms of the path of a game that its results may contain, matching GAMEFILE_PLACEHOLDERS. """
+    path = os.path.abspath(gamefile)
+    return (path, path.replace(os.getcwd(), ""), gamefile, os.path.basename(gamefile))
+
+
+def strip_gamefile(result, gamefile):
+    """ Replace the game's file in a result by placeholders, so the result fits any game with the same source. """
+    data = json.dumps(result)
+    for placeholder, form in sorted(zip(GAMEFILE_PLACEHOLDERS, gamefile_forms(gamefile)), key=lambda item: -len(item[1])):
+        if form:
+            data = data.replace(json.dumps(form)[1:-1], placeholder)
+
+    return json.loads(data)
+
+
+def restore_gamefile(result, gamefile):
+    """ Inverse of `strip_gamefile`, for the given game. """
+    data = json.dumps(result)
+    for placeholder, form in zip(GAMEFILE_PLACEHOLDERS, gamefile_forms(gamefile)):
+        data = data.replace(placeholder, json.dumps(form)[1:-1])
+
+    return json.loads(data)
+
+
+def cached_check(cache, check, gamefile, args, compute, extra_files=(), extra_inputs=()):
+    """ Return the cached result of `check` for this game if its inputs didn't change, otherwise `compute()` it.
+    Results marked with TRANSIENT_ERROR are computed again next time. """
+    if cache is None:
+        result = compute()
+        result.pop(TRANSIENT_ERROR, None)
+        return result
+
+    key = make_key(check, gamefile, args, extra_files, extra_inputs)
+    result = cache.get(check, key)
+    if result is not None:
+        print(f"-> Reusing cached {check} results.")
+        return restore_gamefile(result, gamefile)
+
+    result = compute()
+    if result.pop(TRANSIENT_ERROR, False):
+        print(f"-> Not caching the {check} results, their error may not happen again.")
+    else:
+        cache.put(check, key, strip_gamefile(result, gamefile), gamefile)
+
+    return result
@@ -32,10 +32,20 @@ def parse_game_file_name(game_file_name):
     return experiment, test_id, fold
 
 
-def check_compliance(gamefile, args):
-    game_file_name = os.path.basename(gamefile)
-    experiment, test_id, fold = parse_game_file_name(game_file_name)
-    results = {"fold": fold, "experiment": experiment, "passed": False, "response_msg": ''}
+def get_compliance_files(gamefile, args):
+    """ Files read by the compliance check, besides the game itself. """
+    _, test_id, _ = parse_game_file_name(os.path.basename(gamefile))
+    return [args.evaluation_form, f"{args.test_prompt_input_folder}/test_{test_id}.py"]
+
+
+def get_compliance_inputs(gamefile):
+    """ Inputs of the compliance check taken from the game's file name: experiment, test id and fold. """
+    return parse_game_file_name(os.path.basename(gamefile))
+
+
+def make_compliance_prompt(gamefile, args):
+    """ Prompt asking whether the game meets the requirement of its specification. """
+    experiment, test_id, _ = parse_game_file_name(os.path.basename(gamefile))
 
     with open(args.evaluation_form) as f:
         evaluation_form_df = pd.read_csv(f)
@@ -66,15 +76,17 @@ def check_compliance(gamefile, args):
     prompt += eval_requirement
 
     prompt += "Answer 'Yes' or 'No' first and briefly explain your answer."
+    return prompt
 
-    start = time.time()
-    print(colored(f"Prompting {args.compliance_model_name} for compliance evaluation (using {args.compliance_majority_vote} votes)...", "yellow"))
 
-    responses = llm_gpt(prompt, model=args.compliance_model_name, n=args.compliance_majority_vote)
+def compliance_results(gamefile, responses, args):
+    """ Results of the compliance check from the votes answering `make_compliance_prompt`, as returned by `llm_gpt`. """
+    experiment, _, fold = parse_game_file_name(os.path.basename(gamefile))
+    results = {"fold": fold, "experiment": experiment, "passed": False, "response_msg": ''}
+
     if args.compliance_majority_vote == 1:
         responses = [responses]
 
-    print(colored(f"  Response time: {time.time()-start} secs.", "yellow"))
     print(colored(f"  Responded with {sum(count_tokens(response) for response in responses)} tokens.", "yellow"))
     majority_vote = sum(response.lower().startswith('yes') for response in responses) / args.compliance_majority_vote
     print(colored(f"Majority vote: {majority_vote:.1%}", "green"))
@@ -82,3 +94,14 @@ def check_compliance(gamefile, args):
     results["passed"] = majority_vote > 0.5
 
     return results
+
+
+def check_compliance(gamefile, args):
+    prompt = make_compliance_prompt(gamefile, args)
+
+    start = time.time()
+    print(colored(f"Prompting {args.compliance_model_name} for compliance evaluation (using {args.compliance_majority_vote} votes)...", "yellow"))
+
+    responses = llm_gpt(prompt, model=args.compliance_model_name, n=args.compliance_majority_vote)
+    print(colored(f"  Response time: {time.time()-start} secs.", "yellow"))
+    return compliance_results(gamefile, responses, args)
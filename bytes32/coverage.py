@@ -0,0 +1,167 @@
+import os
+import sys
+import dis
+import inspect
+
+from bytes32.sandbox import get_sandbox
+
+
+def code_objects(code):
+    yield code
+    for const in code.co_consts:
+        if hasattr(const, "co_code"):
+            yield from code_objects(const)
+
+
+def function_lines(gamefile):
+    """ Lines of code of each of the game's functions, keyed by (name, first line). """
+    with open(gamefile) as f:
+        module = compile(f.read(), gamefile, "exec")
+
+    lines = {}
+    for code in code_objects(module):
+        # Module and class bodies run on import, before any coverage is recorded.
+        if not code.co_flags & inspect.CO_NEWLOCALS:
+            continue
+
+        lines[code.co_name, code.co_firstlineno] = {lineno for _, lineno in dis.findlinestarts(code)
+                                                    if lineno is not None and lineno != code.co_firstlineno}
+
+    return lines
+
+
+class LineCoverage():
+    """ Record which lines of the game's functions run.
+
+    Uses `sys.monitoring` on Python 3.12+, where each line only costs a callback the
+    first time it runs, and `sys.settrace` otherwise. Lines of `step` and `action*`
+    methods are the targets of the coverage-guided search, see `poll_new_targets`.
+    """
+
+    def __init__(self, gamefile):
+        self.filename = os.path.abspath(gamefile)
+        self.function_lines = function_lines(gamefile)
+        self.executable = set().union(*self.function_lines.values())
+        self.targets = set().union(*(lines for (name, _), lines in self.function_lines.items()
+                                     if name == "step" or name.startswith("action")))
+        self.lines = set()
+        self.new_targets = 0
+        self._is_game_file = {}
+        self._uncovered = {}
+        self._running = None
+
+    def _in_game(self, code):
+        try:
+            return self._is_game_file[code.co_filename]
+        except KeyError:
+            in_game = os.path.abspath(code.co_filename) == self.filename
+            self._is_game_file[code.co_filename] = in_game
+            return in_game
+
+    def _record(self, lineno):
+        if lineno not in self.lines:
+            self.lines.add(lineno)
+            if lineno in self.targets:
+                self.new_targets += 1
+
+    def _trace(self, frame, event, arg):
+        # Only trace the game's functions with lines not covered yet.
+        code = frame.f_code
+        try:
+            uncovered = self._uncovered[code]
+        except KeyError:
+            uncovered = set()
+            if self._in_game(code):
+                uncovered = self.function_lines.get((code.co_name, code.co_firstlineno), set()) - self.lines
+
+            self._uncovered[code] = uncovered
+
+        return self._trace_lines if uncovered else None
+
+    def _trace_lines(self, frame, event, arg):
+        if event == "line":
+            self._record(frame.f_lineno)
+            self._uncovered[frame.f_code].discard(frame.f_lineno)
+
+        return self._trace_lines
+
+    def _monitor_line(self, code, lineno):
+        if self._in_game(code):
+            self._record(lineno)
+
+        # Lines are only reported once, either way.
+        return sys.monitoring.DISABLE
+
+    def start(self):
+        if hasattr(sys, "monitoring") and sys.monitoring.get_tool(sys.monitoring.COVERAGE_ID) is None:
+            sys.monitoring.use_tool_id(sys.monitoring.COVERAGE_ID, "bytes32")
+            sys.monitoring.register_callback(sys.monitoring.COVERAGE_ID, sys.monitoring.events.LINE, self._monitor_line)
+            sys.monitoring.set_events(sys.monitoring.COVERAGE_ID, sys.monitoring.events.LINE)
+            sys.monitoring.restart_events()  # Re-enable the lines disabled by a previous run.
+            self._running = "monitoring"
+        else:
+            sys.settrace(self._trace)
+            self._running = "settrace"
+
+    def stop(self):
+        if self._running == "monitoring":
+            sys.monitoring.set_events(sys.monitoring.COVERAGE_ID, 0)
+            sys.monitoring.register_callback(sys.monitoring.COVERAGE_ID, sys.monitoring.events.LINE, None)
+            sys.monitoring.free_tool_id(sys.monitoring.COVERAGE_ID)
+        elif self._running == "settrace":
+            sys.settrace(None)
+
+        self._running = None
+
+    def poll_new_targets(self):
+        """ Number of `step` and `action*` lines run for the first time since the last call. """
+        new_targets, self.new_targets = self.new_targets, 0
+        return new_targets
+
+    def covered_lines(self):
+        return set(self.lines)
+
+    def update(self, lines):
+        """ Add lines covered elsewhere, e.g. by another process. """
+        self.lines.update(lines)
+        self._uncovered.clear()
+
+    def percent(self):
+        """ Percentage of the lines of the game's functions that ran. """
+        if not self.executable:
+            return 0.0
+
+        return 100 * len(self.lines & self.executable) / len(self.executable)
+
+
+class SandboxedCoverage(LineCoverage):
+    """ Coverage of a game running in a `Sandbox`, recorded by the sandbox process. """
+
+    def __init__(self, sandbox):
+        super().__init__(sandbox.gamefile)
+        self.sandbox = sandbox
+
+    def start(self):
+        self.sandbox._request("coverage", name="start")
+        self._running = "sandbox"
+
+    def stop(self):
+        if self._running and not self.sandbox._dead:
+            self.update(self.covered_lines())
+            self.sandbox._request("coverage", name="stop")
+
+        self._running = None
+
+    def poll_new_targets(self):
+        return self.sandbox._request("coverage", name="poll")
+
+    def covered_lines(self):
+        return set(self.sandbox._request("coverage", name="lines"))
+
+
+def start_coverage(TextGame, gamefile):
+    """ Start recording the coverage of `gamefile`, in its sandbox if `TextGame` runs in one. """
+    sandbox = get_sandbox(TextGame)
+    coverage = SandboxedCoverage(sandbox) if sandbox is not None else LineCoverage(gamefile)
+    coverage.start()
+    return coverage
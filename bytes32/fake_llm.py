@@ -0,0 +1,293 @@
+import re
+import json
+import math
+import time
+import argparse
+import threading
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+PLAYTHROUGH_IDX_PATTERN = re.compile(r'\{"idx": (\d+), "playthrough"')
+
+# Probability given to the first token of a canned answer, the rest going to the other verdicts
+FAKE_CONFIDENCE = 0.95
+FAKE_VERDICTS = ("yes", "no", "error")
+
+
+def fake_response(prompt):
+    """ Canned answer to a prompt: a positive evaluation of each playthrough of an alignment prompt, "yes" otherwise. """
+    idxs = PLAYTHROUGH_IDX_PATTERN.findall(prompt)
+    if not idxs:
+        return "yes"
+
+    return "\n".join(json.dumps({"idx": int(idx), "evaluation": "yes", "short_justification": "fake response"}) for idx in idxs)
+
+
+def fake_top_logprobs(prompt, content):
+    """ Canned log-probabilities of the first token of an answer: FAKE_CONFIDENCE for the token of `content`. """
+    token = content.split()[0] if content.split() else ""
+    others = [verdict for verdict in FAKE_VERDICTS if verdict != token]
+    top_logprobs = {token: math.log(FAKE_CONFIDENCE)}
+    top_logprobs.update({verdict: math.log((1 - FAKE_CONFIDENCE) / len(others)) for verdict in others})
+    return top_logprobs
+
+
+def fake_logprobs(request, prompt, content, record):
+    """ Log-probabilities of the first token of the answer only, if requested. """
+    if not request.get("logprobs"):
+        return None
+
+    top_logprobs = record.get("top_logprobs") or fake_top_logprobs(prompt, content)
+    ranked = sorted(top_logprobs.items(), key=lambda item: item[1], reverse=True)
+    token, logprob = ranked[0]
+    return {"content": [{"token": token, "logprob": logprob, "bytes": None,
+                         "top_logprobs": [{"token": token, "logprob": logprob, "bytes": None}
+                                          for token, logprob in ranked[:request.get("top_logprobs") or 0]]}]}
+
+
+def load_replay(filename):
+    """ Recorded answers to replay, keyed by prompt, from a JSONL file of {"prompt", "content", "top_logprobs"} records.
+    `top_logprobs`, the log-probabilities of the first token of the answer keyed by token, is optional. The logs
+    of `bytes32.backends.RecordBackend` are also accepted, keeping the first choice of each response. """
+    replay = {}
+    with open(filename) as f:
+        for line in f:
+            if not line.strip():
+                continue
+
+            record = json.loads(line)
+            if "messages" in record:
+                choice = record["choices"][0]
+                logprobs = (choice.get("logprobs") or {}).get("content")
+                record = {
+                    "prompt": "\n".join(str(message["content"]) for message in record["messages"]),
+                    "content": choice["content"],
+                    "top_logprobs": {candidate["token"]: candidate["logprob"] for candidate in logprobs[0]["top_logprobs"]} if logprobs else None,
+                }
+
+            replay[record["prompt"]] = record
+
+    return replay
+
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    """ Answer OpenAI chat completion requests with `fake_response`, after waiting `server.latency` seconds,
+    and generating `server.token_rate` words per second if set. Files can be uploaded and run as batches. """
+
+    def do_POST(self):
+        path = self.path.rstrip("/")
+        if path.endswith("/chat/completions"):
+            self._chat_completion()
+        elif path.endswith("/files"):
+            self._upload_file()
+        elif path.endswith("/batches"):
+            self._create_batch()
+        else:
+            self.send_error(404)
+
+    def do_GET(self):
+        path = self.path.rstrip("/")
+        content = re.search(r"/files/([^/]+)/content$", path)
+        batch = re.search(r"/batches/([^/]+)$", path)
+        if content and content.group(1) in self.server.files:
+            self._send_bytes(self.server.files[content.group(1)]["content"], "application/octet-stream")
+        elif batch and batch.group(1) in self.server.batches:
+            self._send_json(self.server.batches[batch.group(1)])
+        else:
+            self.send_error(404)
+
+    def _chat_completion(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        content, completion = self.server.answer(request)
+        time.sleep(self.server.latency)
+
+        with self.server.lock:
+            self.server.num_requests += 1
+
+        if request.get("stream"):
+            self._stream(request, content)
+            return
+
+        self._generate(len(content.split()))
+        self._send_json(completion)
+
+    def _upload_file(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        message = BytesParser(policy=HTTP).parsebytes(f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + body)
+        fields = {part.get_param("name", header="content-disposition"): part for part in message.iter_parts()}
+        self._send_json(self.server.add_file(fields["file"].get_filename(), fields["file"].get_payload(decode=True),
+                                             fields["purpose"].get_payload(decode=True).decode()))
+
+    def _create_batch(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if request.get("input_file_id") not in self.server.files:
+            self.send_error(404)
+            return
+
+        self._send_json(self.server.create_batch(request))
+
+    def _generate(self, num_tokens):
+        """ Wait for the time it takes to generate that many tokens. """
+        if self.server.token_rate:
+            time.sleep(num_tokens / self.server.token_rate)
+
+    def _send_json(self, data):
+        self._send_bytes(json.dumps(data).encode(), "application/json")
+
+    def _send_bytes(self, body, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream(self, request, content):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+
+        def chunk(delta, finish_reason=None):
+            data = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": request["model"],
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+            self.wfile.write(f"data: {json.dumps(data)}\n\n".encode())
+
+        chunk({"role": "assistant", "content": ""})
+        pieces = re.findall(r"\S+\s*|\s+", content)
+        for piece in pieces:
+            self._generate(1)
+            chunk({"content": piece})
+
+        chunk({}, finish_reason="stop")
+        if (request.get("stream_options") or {}).get("include_usage"):
+            prompt_tokens = sum(len(str(message["content"]).split()) for message in request["messages"])
+            data = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": request["model"],
+                    "choices": [], "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(pieces),
+                                             "total_tokens": prompt_tokens + len(pieces)}}
+            self.wfile.write(f"data: {json.dumps(data)}\n\n".encode())
+
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass  # Keep benchmarks quiet.
+
+
+class FakeLLMServer(ThreadingHTTPServer):
+    """ Local stand-in for the OpenAI API, to run and benchmark the LLM checks offline.
+
+    Point the client at it with `OPENAI_BASE_URL=http://<host>:<port>/v1`. Requests
+    are answered concurrently, each after `latency` seconds, with the recorded answer
+    to the same prompt in `replay` (see `load_replay`) or else a canned one. With a
+    `token_rate`, answers take one more second per `token_rate` words to generate.
+    Batches of requests uploaded as files are answered `batch_delay` seconds after
+    being created, like the Batch API.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, replay=None, token_rate=None, batch_delay=1.0):
+        super().__init__((host, port), FakeLLMHandler)
+        self.latency = latency
+        self.token_rate = token_rate
+        self.batch_delay = batch_delay
+        self.replay = replay or {}
+        self.num_requests = 0
+        self.files = {}
+        self.batches = {}
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        """ Serve from a background thread. """
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def answer(self, request):
+        """ Content of the answer to a chat completion request, and the chat completion returned. """
+        prompt = "\n".join(str(message["content"]) for message in request["messages"])
+        record = self.replay.get(prompt) or {}
+        content = record.get("content", fake_response(prompt))
+        if request.get("max_tokens"):
+            content = " ".join(content.split()[:request["max_tokens"]])  # Words as tokens
+
+        prompt_tokens, completion_tokens = len(prompt.split()), len(content.split())
+        n = request.get("n") or 1
+        completion = {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request["model"],
+            "choices": [{"index": i, "message": {"role": "assistant", "content": content}, "finish_reason": "stop",
+                         "logprobs": fake_logprobs(request, prompt, content, record)} for i in range(n)],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": n * completion_tokens,
+                      "total_tokens": prompt_tokens + n * completion_tokens},
+        }
+        return content, completion
+
+    def add_file(self, filename, content, purpose):
+        with self.lock:
+            file_id = f"file-fake{len(self.files)}"
+            self.files[file_id] = {"id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()),
+                                   "filename": filename, "purpose": purpose, "status": "processed", "content": content}
+
+        return {name: value for name, value in self.files[file_id].items() if name != "content"}
+
+    def create_batch(self, request):
+        """ Start a batch of chat completion requests, answered after `batch_delay` seconds. """
+        with self.lock:
+            batch_id = f"batch_fake{len(self.batches)}"
+            self.batches[batch_id] = {
+                "id": batch_id, "object": "batch", "endpoint": request["endpoint"], "errors": None,
+                "input_file_id": request["input_file_id"], "completion_window": request["completion_window"],
+                "status": "in_progress", "output_file_id": None, "error_file_id": None, "created_at": int(time.time()),
+                "request_counts": {"total": 0, "completed": 0, "failed": 0}, "metadata": request.get("metadata"),
+            }
+
+        threading.Thread(target=self._run_batch, args=(batch_id,), daemon=True).start()
+        return self.batches[batch_id]
+
+    def _run_batch(self, batch_id):
+        time.sleep(self.batch_delay)
+        batch = self.batches[batch_id]
+        outputs = []
+        for line in self.files[batch["input_file_id"]]["content"].decode().splitlines():
+            if line.strip():
+                request = json.loads(line)
+                _, completion = self.answer(request["body"])
+                outputs.append({"id": f"batch_req_{len(outputs)}", "custom_id": request["custom_id"], "error": None,
+                                "response": {"status_code": 200, "request_id": f"req_{len(outputs)}", "body": completion}})
+
+        output = "".join(json.dumps(output) + "\n" for output in outputs).encode()
+        batch["output_file_id"] = self.add_file(f"{batch_id}_output.jsonl", output, "batch_output")["id"]
+        batch["request_counts"] = {"total": len(outputs), "completed": len(outputs), "failed": 0}
+        batch["status"] = "completed"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve canned OpenAI chat completions and batches locally.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=1.0,
+                        help="Seconds to wait before answering each request. Default: %(default)s")
+    parser.add_argument("--token-rate", type=float,
+                        help="Words generated per second by each answer. Default: instantaneous.")
+    parser.add_argument("--replay",
+                        help="JSONL file of recorded answers to replay, see `load_replay`.")
+    parser.add_argument("--batch-delay", type=float, default=1.0,
+                        help="Seconds before a batch of requests is answered. Default: %(default)s")
+    args = parser.parse_args()
+
+    server = FakeLLMServer(args.host, args.port, args.latency, load_replay(args.replay) if args.replay else None, args.token_rate,
+                           args.batch_delay)
+    print(f"Serving fake chat completions at {server.base_url}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
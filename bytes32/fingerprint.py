@@ -0,0 +1,85 @@
+import random
+import hashlib
+
+from bytes32.sandbox import SandboxedGame
+
+
+# Attributes that link objects together (walked separately) or don't describe the world.
+IGNORED_OBJECT_ATTRIBUTES = ("contains", "parentContainer", "constructorsRun")
+
+
+def _canonical(value, depth=0):
+    """ Turn an attribute value into a hashable, order-stable representation. """
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if depth > 3:
+        return type(value).__name__
+    if isinstance(value, (list, tuple)):
+        return tuple(_canonical(v, depth + 1) for v in value)
+    if isinstance(value, (set, frozenset)):
+        return tuple(sorted(repr(_canonical(v, depth + 1)) for v in value))
+    if isinstance(value, dict):
+        return tuple(sorted(((repr(k), _canonical(v, depth + 1)) for k, v in value.items()), key=lambda kv: kv[0]))
+    if isinstance(value, random.Random):
+        return "Random"  # The state of the random generator is not part of the world.
+    if hasattr(value, "name"):
+        # Reference to another game object: its own state is captured when walking the object tree.
+        return (type(value).__name__, str(value.name))
+
+    return type(value).__name__
+
+
+def _object_state(obj, visited):
+    if id(obj) in visited:
+        return (type(obj).__name__, str(getattr(obj, "name", "")))
+
+    visited.add(id(obj))
+    attributes = tuple(sorted((name, _canonical(value)) for name, value in vars(obj).items()
+                              if name not in IGNORED_OBJECT_ATTRIBUTES))
+    contains = tuple(_object_state(child, visited) for child in getattr(obj, "contains", []))
+    return (type(obj).__name__, attributes, contains)
+
+
+def game_fingerprint(game):
+    """ Canonical fingerprint of the world state of a game, or None if it can't be computed.
+
+    Walks the object tree from `rootObject` through `contains`, recording each
+    object's attributes (including `properties`), plus the game's `score`,
+    `gameOver` and `gameWon`. Two action sequences leading to the same world get
+    the same fingerprint, regardless of the number of steps or last observation.
+    """
+    if isinstance(game, SandboxedGame):
+        return game.fingerprint()
+
+    try:
+        state = (
+            _object_state(game.rootObject, set()),
+            _canonical(getattr(game, "score", None)),
+            bool(getattr(game, "gameOver", False)),
+            bool(getattr(game, "gameWon", False)),
+        )
+    except Exception:
+        return None
+
+    return hashlib.blake2b(repr(state).encode(), digest_size=16).hexdigest()
+
+
+class TranspositionTable():
+    """ Keep track of the states already expanded, and how many steps were left when they were. """
+
+    def __init__(self):
+        self.depths = {}
+
+    def visit(self, fingerprint, remaining_steps):
+        """ Record a visit, returning False if the state was already expanded at least as deep. """
+        if fingerprint is None:
+            return True
+
+        if self.depths.get(fingerprint, -1) >= remaining_steps:
+            return False
+
+        self.depths[fingerprint] = remaining_steps
+        return True
+
+    def __len__(self):
+        return len(self.depths)
@@ -0,0 +1,245 @@
+import os
+import ast
+from concurrent.futures import ProcessPoolExecutor
+
+from bytes32.utils import get_empty_metrics
+
+
+# Methods checked by the validity check, besides the constructor.
+REQUIRED_METHODS = ("getTaskDescription", "generatePossibleActions", "step", "calculateScore")
+
+# Calls that end the program, which count as a way out of a `while True` loop.
+EXIT_CALLS = ("exit", "quit", "sys.exit", "os._exit")
+
+
+def _call_name(node):
+    """ Dotted name of the function called by `node`, e.g. "sys.exit", or "" if it isn't a plain name. """
+    func = node.func
+    names = []
+    while isinstance(func, ast.Attribute):
+        names.append(func.attr)
+        func = func.value
+
+    if not isinstance(func, ast.Name):
+        return ""
+
+    names.append(func.id)
+    return ".".join(reversed(names))
+
+
+def _leaves_loop(node, in_nested_loop=False):
+    """ Whether `node` can leave the enclosing loop: break, return, raise, yield or a call ending the program. """
+    if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda, ast.ClassDef)):
+        return False
+    if isinstance(node, ast.Break):
+        return not in_nested_loop  # A break in a nested loop only leaves that loop.
+    if isinstance(node, (ast.Return, ast.Raise, ast.Yield, ast.YieldFrom)):
+        return True
+    if isinstance(node, ast.Call) and _call_name(node) in EXIT_CALLS:
+        return True
+
+    in_nested_loop = in_nested_loop or isinstance(node, (ast.For, ast.AsyncFor, ast.While))
+    return any(_leaves_loop(child, in_nested_loop) for child in ast.iter_child_nodes(node))
+
+
+def find_infinite_loops(tree):
+    """ Line numbers of the `while True` loops with no way out. """
+    lines = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.While) and isinstance(node.test, ast.Constant) and node.test.value and not node.orelse:
+            if not any(_leaves_loop(child) for child in node.body):
+                lines.append(node.lineno)
+
+    return sorted(lines)
+
+
+def _is_main_guard(node):
+    """ Whether `node` is `if __name__ == "__main__":`. """
+    return ast.unparse(node.test) in ("__name__ == '__main__'", "'__main__' == __name__")
+
+
+def _import_time_statements(tree):
+    """ Module-level statements run on import, outside the main guard, including the bodies of the classes. """
+    run, statements = [], list(tree.body)
+    while statements:
+        node = statements.pop(0)
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            continue
+        if isinstance(node, ast.ClassDef):
+            statements[:0] = node.body
+            continue
+        if isinstance(node, ast.If):
+            if not _is_main_guard(node):
+                statements[:0] = node.body + node.orelse
+            continue
+        if isinstance(node, ast.Try):
+            statements[:0] = node.body + [n for handler in node.handlers for n in handler.body] + node.orelse + node.finalbody
+            continue
+
+        run.append(node)
+
+    return run
+
+
+def _module_functions(tree):
+    return {node.name: node for node in tree.body if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef))}
+
+
+def _called_functions(nodes, functions):
+    """ Module-level functions called by `nodes`, directly or through each other. """
+    called, todo = {}, list(nodes)
+    while todo:
+        for node in ast.walk(todo.pop()):
+            if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in functions and node.func.id not in called:
+                called[node.func.id] = functions[node.func.id]
+                todo.append(functions[node.func.id])
+
+    return list(called.values())
+
+
+def find_blocking_code(tree):
+    """ Line numbers and reasons of the statements run on import that wait for user input or loop forever,
+    either themselves or through the module's functions they call. """
+    functions = _module_functions(tree)
+    blocking = []
+    for statement in _import_time_statements(tree):
+        code = ast.Module(body=[statement] + _called_functions([statement], functions), type_ignores=[])
+        if any(isinstance(node, ast.Call) and _call_name(node) == "input" for node in ast.walk(code)):
+            blocking.append((statement.lineno, "waits for user input"))
+        elif find_infinite_loops(code):
+            blocking.append((statement.lineno, f"runs the endless `while True` loop at line {find_infinite_loops(code)[0]}"))
+
+    return blocking
+
+
+def find_side_effects(tree):
+    """ Line numbers and code of the module-level statements run on import, other than definitions and assignments. """
+    side_effects = []
+    statements = list(tree.body)
+    while statements:
+        node = statements.pop(0)
+        if isinstance(node, (ast.Import, ast.ImportFrom, ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef, ast.Pass)):
+            continue
+        if isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant):
+            continue  # Docstring.
+        if isinstance(node, ast.If):
+            if not _is_main_guard(node):
+                statements[:0] = node.body + node.orelse
+            continue
+        if isinstance(node, ast.Try):
+            statements[:0] = node.body + [n for handler in node.handlers for n in handler.body] + node.orelse + node.finalbody
+            continue
+        if isinstance(node, (ast.Assign, ast.AnnAssign, ast.AugAssign)):
+            # Assignments are fine, unless they wait for user input.
+            if not any(isinstance(n, ast.Call) and _call_name(n) == "input" for n in ast.walk(node)):
+                continue
+
+        side_effects.append((node.lineno, ast.unparse(node).split("\n")[0]))
+
+    return side_effects
+
+
+def _class_methods(tree, name, visited=()):
+    """ Names defined in the body of class `name` and its bases defined in the module, or None if a base is unknown. """
+    classes = {node.name: node for node in tree.body if isinstance(node, ast.ClassDef)}
+    if name not in classes or name in visited:
+        return None
+
+    node = classes[name]
+    methods = set()
+    for child in node.body:
+        if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            methods.add(child.name)
+        elif isinstance(child, ast.Assign):
+            methods.update(target.id for target in child.targets if isinstance(target, ast.Name))
+
+    for base in node.bases:
+        if isinstance(base, ast.Name) and base.id == "object":
+            continue
+
+        base_methods = _class_methods(tree, base.id, visited + (name,)) if isinstance(base, ast.Name) else None
+        if base_methods is None:
+            return None  # Can't tell what an imported base class provides.
+
+        methods |= base_methods
+
+    return methods
+
+
+def prescreen_game(gamefile):
+    """ Statically check a game without importing it.
+
+    Fills the validity checks that can be known from the source (`TextGame` and
+    its methods), and flags syntax errors and code run on import that would block:
+    waiting for user input, or `while True` loops with no way out. Other code run
+    on import, and endless loops elsewhere, only give `warnings`. Returns the checks
+    and whether the game `passed`, in which case the validity check still has to run it.
+    Rejected games are never run, so the checks they would pass are left as None.
+    Games whose source can't be read aren't `readable`.
+    """
+    checks = get_empty_metrics()["validity"]
+
+    try:
+        with open(gamefile) as f:
+            source = f.read()
+    except (OSError, UnicodeDecodeError) as e:
+        checks["error_msg"] = str(e)
+        return {"passed": False, "readable": False, "checks": checks, "warnings": []}
+
+    try:
+        tree = ast.parse(source, filename=gamefile)
+    except (SyntaxError, ValueError) as e:
+        checks["error_msg"] = str(e)
+        return {"passed": False, "readable": True, "checks": checks, "warnings": []}
+
+    issues, warnings = [], []
+    methods = _class_methods(tree, "TextGame")
+    if "TextGame" not in {node.name for node in tree.body if isinstance(node, ast.ClassDef)}:
+        issues.append(f"module '{os.path.basename(gamefile)[:-3]}' has no attribute 'TextGame'")
+    else:
+        checks["TextGame"] = True
+        for method in REQUIRED_METHODS:
+            checks[method] = methods is None or method in methods
+            if not checks[method]:
+                issues.append(f"'TextGame' object has no attribute '{method}'")
+
+    blocking = find_blocking_code(tree)
+    for lineno, reason in blocking:
+        issues.append(f"Line {lineno} {reason} when the game is imported, move it under `if __name__ == \"__main__\":`.")
+
+    blocking_lines = {lineno for lineno, _ in blocking}
+    for lineno, code in find_side_effects(tree):
+        if lineno not in blocking_lines:
+            warnings.append(f"Line {lineno} runs when the game is imported: {code}")
+
+    functions = _module_functions(tree)
+    statements = _import_time_statements(tree)
+    blocking_loops = set(find_infinite_loops(ast.Module(body=statements + _called_functions(statements, functions), type_ignores=[])))
+    for lineno in find_infinite_loops(tree):
+        if lineno not in blocking_loops:
+            warnings.append(f"The `while True` loop at line {lineno} may never exit.")
+
+    if issues:
+        for name in ("TextGame",) + REQUIRED_METHODS:
+            if checks[name]:
+                checks[name] = None
+
+    checks["error_msg"] = "\n".join(issues)
+    return {"passed": not issues, "readable": True, "checks": checks, "warnings": warnings}
+
+
+def _prescreen_file(gamefile):
+    """ `prescreen_game`, failing the games that can't be analysed instead of raising. """
+    try:
+        return prescreen_game(gamefile)
+    except Exception as e:
+        checks = get_empty_metrics()["validity"]
+        checks["error_msg"] = f"Can't pre-screen {os.path.basename(gamefile)}: {e}"
+        return {"passed": False, "readable": True, "checks": checks, "warnings": []}
+
+
+def prescreen_games(gamefiles, num_workers=None):
+    """ Run `prescreen_game` on each game in parallel. Returns the results keyed by game file. """
+    gamefiles = list(gamefiles)
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        return dict(zip(gamefiles, executor.map(_prescreen_file, gamefiles, chunksize=8)))
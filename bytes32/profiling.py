@@ -0,0 +1,145 @@
+import os
+import time
+import pstats
+import cProfile
+import tracemalloc
+
+from bytes32.sandbox import get_sandbox
+from bytes32.coverage import code_objects
+
+
+def _qualified_names(gamefile):
+    """ Qualified name of each of the game's functions (e.g. "TextGame.step"), keyed by (name, first line). """
+    with open(gamefile) as f:
+        module = compile(f.read(), gamefile, "exec")
+
+    return {(code.co_name, code.co_firstlineno): getattr(code, "co_qualname", code.co_name)
+            for code in code_objects(module)}
+
+
+class GameProfiler():
+    """ Profile the calls to the game's functions, and the peak memory allocated meanwhile.
+
+    `stop()` returns the profile: time spent profiling, peak memory in MB, and the
+    number of calls, own time (`tottime`) and cumulative time (`cumtime`) of the
+    game's `top` functions spending the most time on their own.
+    """
+
+    def __init__(self, gamefile, top=20):
+        self.filename = os.path.abspath(gamefile)
+        self.names = _qualified_names(gamefile)
+        self.top = top
+        self.profiles = []
+        self._profile = None
+
+    def start(self):
+        self._started_tracemalloc = not tracemalloc.is_tracing()
+        if self._started_tracemalloc:
+            tracemalloc.start()
+
+        tracemalloc.reset_peak()
+        self._start_time = time.time()
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+
+    def stop(self):
+        if self._profile is not None:
+            self.profiles.append(self._collect())
+
+        return merge_profiles(self.profiles, self.top)
+
+    def update(self, profile):
+        """ Add a profile recorded elsewhere, e.g. by another process. """
+        self.profiles.append(profile)
+
+    def _collect(self):
+        self._profile.disable()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+
+        methods = {}
+        for (filename, lineno, funcname), (_, calls, tottime, cumtime, _) in pstats.Stats(self._profile).stats.items():
+            if os.path.abspath(filename) != self.filename:
+                continue
+
+            stats = methods.setdefault(self.names.get((funcname, lineno), funcname), {"calls": 0, "tottime": 0, "cumtime": 0})
+            stats["calls"] += calls
+            stats["tottime"] += tottime
+            stats["cumtime"] += cumtime
+
+        self._profile = None
+        return {
+            "total_time": time.time() - self._start_time,
+            "peak_memory_mb": peak_memory / 1024**2,
+            "methods": top_methods(methods, self.top),
+        }
+
+
+def top_methods(methods, top):
+    ranked = sorted(methods.items(), key=lambda item: item[1]["tottime"], reverse=True)[:top]
+    return {name: {"calls": stats["calls"], "tottime": round(stats["tottime"], 4), "cumtime": round(stats["cumtime"], 4)}
+            for name, stats in ranked}
+
+
+class SandboxedProfiler(GameProfiler):
+    """ Profile of a game running in a `Sandbox`, recorded by the sandbox process. """
+
+    def __init__(self, sandbox, top=20):
+        self.sandbox = sandbox
+        self.top = top
+        self.profiles = []
+
+    def start(self):
+        self.sandbox._request("profile", name="start", args=(self.top,))
+        self.sandbox.profiling = True
+
+    def stop(self):
+        if self.sandbox.profiling:
+            self.sandbox.profiling = False
+            if self.sandbox._dead:
+                # Profile salvaged from the game process before it was killed, if any.
+                self.profiles.append(self.sandbox.last_profile)
+            else:
+                self.profiles.append(self.sandbox._request("profile", name="stop"))
+
+        return merge_profiles(self.profiles, self.top)
+
+
+def start_profiler(TextGame, gamefile):
+    """ Start profiling `gamefile`, in its sandbox if `TextGame` runs in one. """
+    sandbox = get_sandbox(TextGame)
+    profiler = SandboxedProfiler(sandbox) if sandbox is not None else GameProfiler(gamefile)
+    profiler.start()
+    return profiler
+
+
+def merge_profiles(profiles, top=20):
+    """ Sum profiles recorded separately, e.g. by different processes. """
+    profiles = [profile for profile in profiles if profile]
+    if not profiles:
+        return {}
+
+    methods = {}
+    for profile in profiles:
+        for name, stats in profile["methods"].items():
+            merged = methods.setdefault(name, {"calls": 0, "tottime": 0, "cumtime": 0})
+            for key in merged:
+                merged[key] += stats[key]
+
+    return {
+        "total_time": sum(profile["total_time"] for profile in profiles),
+        "peak_memory_mb": max(profile["peak_memory_mb"] for profile in profiles),
+        "methods": top_methods(methods, top),
+    }
+
+
+def describe_profile(profile, top=3):
+    """ Name the game methods where most of the time was spent, for the reflection prompt. """
+    if not profile or not profile["methods"]:
+        return ""
+
+    hot = [f"`{name}` ({stats['tottime']:.1f}s over {stats['calls']} calls)"
+           for name, stats in list(profile["methods"].items())[:top]]
+    return (f"Profiling the game showed most of the time was spent in {', '.join(hot)}"
+            f", with a peak memory usage of {profile['peak_memory_mb']:.0f}MB.")
@@ -0,0 +1,162 @@
+import os
+import json
+import time
+import asyncio
+import threading
+import contextvars
+from contextlib import contextmanager
+
+from tenacity.wait import wait_base
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows.
+    fcntl = None
+
+
+# Priority of the LLM calls: interactive ones (e.g. the winnability agent's steps) go before bulk ones (e.g. compliance votes).
+INTERACTIVE = "interactive"
+BULK = "bulk"
+
+# Share of each budget that bulk calls leave to interactive calls.
+INTERACTIVE_RESERVE = 0.1
+
+_priority = contextvars.ContextVar("llm_priority", default=BULK)
+
+
+@contextmanager
+def llm_priority(priority):
+    """ Make the LLM calls made within the context `INTERACTIVE` or `BULK`. """
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def retry_after(exception):
+    """ Seconds to wait before retrying, according to the Retry-After header of an API error, if any. """
+    response = getattr(exception, "response", None)
+    if response is None:
+        return None
+
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class wait_retry_after(wait_base):
+    """ Tenacity wait honouring the Retry-After header of the last error, `fallback` otherwise. """
+
+    def __init__(self, fallback):
+        self.fallback = fallback
+
+    def __call__(self, retry_state):
+        seconds = retry_after(retry_state.outcome.exception()) if retry_state.outcome.failed else None
+        return seconds if seconds is not None else self.fallback(retry_state)
+
+
+class RateLimiter():
+    """ Token buckets enforcing requests-per-minute and tokens-per-minute budgets for each model.
+
+    Calls wait until both budgets can pay for them. Bulk calls also leave
+    INTERACTIVE_RESERVE of each budget to interactive calls, so the latter go first
+    when the budgets run low. With a `state_file`, the budgets are shared by all the
+    processes using the same file (Unix only), otherwise by the threads and tasks of
+    the current process.
+    """
+
+    def __init__(self, rpm=None, tpm=None, state_file=None):
+        if state_file is not None and fcntl is None:
+            raise ValueError("Sharing rate limits between processes needs fcntl, which isn't available on this platform.")
+
+        self.limits = {"requests": rpm, "tokens": tpm}
+        self.state_file = state_file
+        self.state = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, model, num_tokens):
+        """ Wait until the budgets of `model` allow a request of `num_tokens` tokens, and pay for it. """
+        while True:
+            wait = self._try_acquire(model, num_tokens, _priority.get())
+            if wait <= 0:
+                return
+
+            time.sleep(wait)
+
+    async def aacquire(self, model, num_tokens):
+        """ Same as `acquire`, without blocking the event loop. """
+        while True:
+            wait = self._try_acquire(model, num_tokens, _priority.get())
+            if wait <= 0:
+                return
+
+            await asyncio.sleep(wait)
+
+    def pause(self, model, seconds):
+        """ Hold the requests to `model` for `seconds`, e.g. after being told to retry after that long. """
+        with self._locked_state() as state:
+            buckets = self._buckets(state, model, time.time())
+            buckets["paused_until"] = max(buckets["paused_until"], time.time() + seconds)
+
+    def _try_acquire(self, model, num_tokens, priority):
+        """ Pay for a request if the budgets allow it, returning 0, otherwise the seconds to wait before trying again. """
+        now = time.time()
+        with self._locked_state() as state:
+            buckets = self._buckets(state, model, now)
+            if buckets["paused_until"] > now:
+                return buckets["paused_until"] - now
+
+            costs = {"requests": 1, "tokens": num_tokens}
+            wait = 0
+            for name, limit in self.limits.items():
+                if limit is None:
+                    continue
+
+                reserve = INTERACTIVE_RESERVE * limit if priority == BULK else 0
+                # Requests costing more than a whole budget are let through once it is full.
+                needed = min(costs[name], limit - reserve) + reserve
+                wait = max(wait, (needed - buckets[name]) / (limit / 60))
+
+            if wait > 0:
+                return wait
+
+            for name, limit in self.limits.items():
+                if limit is not None:
+                    buckets[name] -= costs[name]
+
+            return 0
+
+    def _buckets(self, state, model, now):
+        """ Budgets left for `model`, refilled for the time elapsed since they were last updated. """
+        buckets = state.setdefault(model, {"requests": self.limits["requests"], "tokens": self.limits["tokens"],
+                                           "updated": now, "paused_until": 0})
+        elapsed = max(now - buckets["updated"], 0)
+        for name, limit in self.limits.items():
+            if limit is not None:
+                buckets[name] = min((buckets[name] if buckets[name] is not None else limit) + elapsed * limit / 60, limit)
+
+        buckets["updated"] = now
+        return buckets
+
+    @contextmanager
+    def _locked_state(self):
+        with self.lock:
+            if self.state_file is None:
+                yield self.state
+                return
+
+            with os.fdopen(os.open(self.state_file, os.O_RDWR | os.O_CREAT), "r+") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    content = f.read()
+                    state = json.loads(content) if content else {}
+                    yield state
+                    f.seek(0)
+                    f.truncate()
+                    json.dump(state, f)
+                    f.flush()  # Before releasing the lock.
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
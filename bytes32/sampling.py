@@ -0,0 +1,82 @@
+SAMPLE_STRATEGIES = ("action_even", "pos_neg_even", "pos_neg_proportional")
+
+
+class Reservoir():
+    """ Uniform random sample of at most `size` of the items added so far (reservoir sampling, algorithm R). """
+
+    def __init__(self, size, rng):
+        self.size = size
+        self.rng = rng
+        self.items = []
+        self.count = 0
+
+    def add(self, item):
+        self.count += 1
+        if len(self.items) < self.size:
+            self.items.append(item)
+            return
+
+        index = self.rng.randrange(self.count)
+        if index < self.size:
+            self.items[index] = item
+
+    def sample(self, k):
+        """ Uniform random sample of `k` of the items added, or of all of them if there are fewer. """
+        return self.rng.sample(self.items, min(k, len(self.items)))
+
+
+class StratifiedSampler():
+    """ Sample `num_samples` items from a stream, split into strata, without keeping the whole stream.
+
+    `action_even` takes the same number of items from each stratum, `pos_neg_even`
+    half from the "negative" and half from the "positive" stratum, and
+    `pos_neg_proportional` from those two in proportion to their size. If the
+    strata are too small, the sample is topped up with items drawn from the whole
+    stream, possibly picking the same item twice.
+    """
+
+    def __init__(self, strategy, num_samples, rng):
+        if strategy not in SAMPLE_STRATEGIES:
+            raise ValueError(f"Invalid SAMPLE_STRATEGY: {strategy}")
+
+        self.strategy = strategy
+        self.num_samples = num_samples
+        self.rng = rng
+        self.strata = {}
+        self.all = Reservoir(num_samples, rng)
+
+        # How many of a stratum's items may end up in the sample, at most.
+        self.stratum_size = num_samples // 2 if strategy == "pos_neg_even" else num_samples
+
+    def add(self, item, stratum):
+        if stratum not in self.strata:
+            self.strata[stratum] = Reservoir(self.stratum_size, self.rng)
+
+        self.strata[stratum].add(item)
+        self.all.add(item)
+
+    def sample(self):
+        if self.strategy == "pos_neg_even":
+            num_samples = {stratum: self.num_samples // 2 for stratum in ("negative", "positive")}
+
+        elif self.strategy == "pos_neg_proportional":
+            num_samples = {stratum: int(self._count(stratum) / max(self.all.count, 1) * self.num_samples)
+                           for stratum in ("negative", "positive")}
+
+        else:
+            num_samples = {stratum: self.num_samples // len(self.strata) for stratum in self.strata}
+
+        sampled = []
+        for stratum, k in num_samples.items():
+            if stratum in self.strata:
+                sampled.extend(self.strata[stratum].sample(k))
+
+        # Top up the sample if the strata were too small.
+        num_samples_added = len(sampled)
+        if num_samples_added < self.num_samples:
+            sampled.extend(self.all.sample(self.num_samples - num_samples_added))
+
+        return sampled
+
+    def _count(self, stratum):
+        return self.strata[stratum].count if stratum in self.strata else 0
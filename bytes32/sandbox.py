@@ -0,0 +1,370 @@
+import os
+import sys
+import copy
+import time
+import pickle
+import signal
+import importlib
+import traceback
+import multiprocessing
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Not available on Windows.
+    resource = None
+
+
+class GameError(Exception):
+    """ Exception raised by a game running in the sandbox. `frames` holds its formatted traceback. """
+
+    def __init__(self, message, frames=()):
+        super().__init__(message)
+        self.frames = list(frames)
+
+
+class GameTimeoutError(TimeoutError):
+    """ The sandboxed game went over its step deadline, CPU limit or time budget. """
+
+
+class GameTimeBudgetError(GameTimeoutError):
+    """ The sandboxed game went over its time budget. Being wall-clock time, a loaded machine can run out of it. """
+
+
+def _to_builtin(value):
+    """ Convert a value returned by the game into builtin types, so no game object leaves the sandbox. """
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, list):
+        return [_to_builtin(v) for v in value]
+    if isinstance(value, tuple):
+        return tuple(_to_builtin(v) for v in value)
+    if isinstance(value, dict):
+        return {_to_builtin(k): _to_builtin(v) for k, v in value.items()}
+
+    return repr(value)
+
+
+def _fork_game(game):
+    try:
+        return pickle.loads(pickle.dumps(game, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return copy.deepcopy(game)
+
+
+def _error_reply(e):
+    return ("error", (type(e).__name__, str(e), traceback.format_tb(e.__traceback__)))
+
+
+def _serve(conn, gamefile, max_memory, max_cpu_time):
+    """ Main loop of the sandbox process: host game instances and answer the parent's requests. """
+    if resource is not None:
+        if max_memory:
+            resource.setrlimit(resource.RLIMIT_AS, (max_memory, max_memory))
+        if max_cpu_time:
+            # SIGXCPU at the soft limit, SIGKILL one second later.
+            resource.setrlimit(resource.RLIMIT_CPU, (max_cpu_time, max_cpu_time + 1))
+
+    # Any call to input() fails right away instead of blocking.
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    sys.stdin = open(os.devnull)
+
+    try:
+        if os.path.dirname(gamefile) not in sys.path:
+            sys.path.append(os.path.dirname(gamefile))
+
+        TextGame = importlib.import_module(os.path.basename(gamefile)[:-3]).TextGame
+    except BaseException as e:
+        conn.send(_error_reply(e))
+        return
+
+    conn.send(("ok", None))
+
+    games = {}
+    next_handle = 0
+    coverage = None
+    profiler = None
+    while True:
+        try:
+            command, handle, name, args, kwargs, released = conn.recv()
+        except EOFError:
+            return
+
+        for released_handle in released:
+            games.pop(released_handle, None)
+
+        if command == "close":
+            return
+
+        try:
+            if command == "new":
+                games[next_handle] = TextGame(*args, **kwargs)
+                result = next_handle
+                next_handle += 1
+            elif command == "fork":
+                games[next_handle] = _fork_game(games[handle])
+                result = next_handle
+                next_handle += 1
+            elif command == "getattr":
+                value = getattr(games[handle], name)
+                result = (True, None) if callable(value) else (False, _to_builtin(value))
+            elif command == "fingerprint":
+                # Imported here since bytes32.fingerprint depends on this module.
+                from bytes32.fingerprint import game_fingerprint
+                result = game_fingerprint(games[handle])
+            elif command == "coverage":
+                from bytes32.coverage import LineCoverage
+                if name == "start":
+                    coverage = LineCoverage(gamefile)
+                    coverage.start()
+                    result = None
+                elif name == "poll":
+                    result = coverage.poll_new_targets()
+                elif name == "lines":
+                    result = sorted(coverage.lines)
+                else:  # stop
+                    coverage.stop()
+                    result = None
+            elif command == "profile":
+                from bytes32.profiling import GameProfiler
+                if name == "start":
+                    profiler = GameProfiler(gamefile, *args)
+                    profiler.start()
+                    # When a step times out, the parent asks for the profile before killing this process.
+                    signal.signal(signal.SIGUSR1, lambda signum, frame: conn.send(("profile", profiler.stop())))
+                    result = None
+                else:  # stop
+                    signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+                    result = profiler.stop()
+            elif command == "call":
+                result = _to_builtin(getattr(games[handle], name)(*args, **kwargs))
+            else:
+                raise ValueError(f"Unknown sandbox command: {command}")
+
+        except Exception as e:
+            conn.send(_error_reply(e))
+            continue
+
+        conn.send(("ok", result))
+
+
+class SandboxedGame():
+    """ Proxy to a game instance living in a `Sandbox` process.
+
+    Attributes are read from the remote game and methods are run remotely. Return
+    values are converted to builtin types (e.g. the values of the dictionary returned
+    by `generatePossibleActions()` become strings).
+    """
+
+    def __init__(self, sandbox, handle):
+        self.__dict__["_sandbox"] = sandbox
+        self.__dict__["_handle"] = handle
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+
+        is_method, value = self._sandbox._request("getattr", self._handle, name)
+        if not is_method:
+            return value
+
+        def _method(*args, **kwargs):
+            return self._sandbox._request("call", self._handle, name, args, kwargs)
+
+        return _method
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Sandboxed games are read-only.")
+
+    def fork(self):
+        """ Return a proxy to an independent copy of this game. """
+        return SandboxedGame(self._sandbox, self._sandbox._request("fork", self._handle))
+
+    def fingerprint(self):
+        """ Fingerprint of the game's world state, computed in the sandbox (see `game_fingerprint`). """
+        return self._sandbox._request("fingerprint", self._handle)
+
+    def __deepcopy__(self, memo):
+        return self.fork()
+
+    def __del__(self):
+        self._sandbox._release(self._handle)
+
+
+class Sandbox():
+    """ Run the TextGame of `gamefile` in a child process with hard resource limits.
+
+    The child has its address space limited to `max_memory` bytes, its CPU time to
+    `max_cpu_time` seconds, and no stdin. Each request must be answered within
+    `step_timeout` seconds, and the game may spend at most `game_timeout` seconds
+    answering requests overall. Going over a deadline kills the child and raises
+    `GameTimeoutError`. Exceptions raised by the game are re-raised as `GameError`.
+    """
+
+    def __init__(self, gamefile, max_memory=None, max_cpu_time=None, step_timeout=None, game_timeout=None):
+        self.gamefile = gamefile
+        self.step_timeout = step_timeout
+        self.remaining_time = game_timeout
+        self._released = []
+        self._dead = None
+        self.profiling = False
+        self.last_profile = None
+
+        method = "fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn"
+        ctx = multiprocessing.get_context(method)
+        self._conn, child_conn = ctx.Pipe()
+        self._process = ctx.Process(target=_serve, args=(child_conn, gamefile, max_memory, max_cpu_time), daemon=True)
+        self._process.start()
+        child_conn.close()
+
+        # Wait for the game module to be imported.
+        try:
+            self._receive()
+        except BaseException:
+            self.close()
+            raise
+
+    def TextGame(self, *args, **kwargs):
+        """ Create a new game instance in the sandbox, mirroring the game's constructor. """
+        return SandboxedGame(self, self._request("new", args=args, kwargs=kwargs))
+
+    def _release(self, handle):
+        # Sent along with the next request, since this may be called by the garbage collector.
+        self._released.append(handle)
+
+    def _request(self, command, handle=None, name=None, args=(), kwargs={}):
+        if self._dead:
+            raise self._dead
+
+        released, self._released = self._released, []
+        try:
+            self._conn.send((command, handle, name, args, kwargs, released))
+        except (BrokenPipeError, OSError):
+            self._receive()  # Report why the sandbox died.
+
+        return self._receive(command)
+
+    def _receive(self, command=None):
+        timeouts = [t for t in (self.step_timeout, self.remaining_time) if t is not None]
+        deadline = min(timeouts) if timeouts else None
+
+        start = time.time()
+        ready = self._conn.poll(deadline)
+        if self.remaining_time is not None:
+            self.remaining_time -= time.time() - start
+
+        if not ready:
+            self._salvage_profile()
+            if self.remaining_time is not None and self.remaining_time <= 0:
+                self._kill(GameTimeBudgetError("Game went over its time budget."))
+            else:
+                self._kill(GameTimeoutError(f"Game step took more than {self.step_timeout} seconds."))
+            raise self._dead
+
+        try:
+            status, payload = self._conn.recv()
+        except EOFError:
+            self._process.join()
+            if self._process.exitcode == -signal.SIGXCPU:
+                self._kill(GameTimeoutError("Game went over its CPU time limit."))
+            else:
+                self._kill(GameError(f"Game process died unexpectedly (exit code {self._process.exitcode})."))
+            raise self._dead
+
+        if status == "error":
+            error_type, message, frames = payload
+            if command == "getattr" and error_type == "AttributeError":
+                raise AttributeError(message)
+            if error_type == "MemoryError":
+                message = message or "Game went over its memory limit."
+            raise GameError(message, frames)
+
+        return payload
+
+    def _salvage_profile(self):
+        """ Ask the stuck game process for its profile, if it is being profiled, before it gets killed. """
+        if not self.profiling:
+            return
+
+        try:
+            os.kill(self._process.pid, signal.SIGUSR1)
+            # Skip the reply to the request that timed out, if it arrives meanwhile.
+            while self._conn.poll(2):
+                status, payload = self._conn.recv()
+                if status == "profile":
+                    self.last_profile = payload
+                    return
+        except (OSError, EOFError):
+            pass
+
+    def _kill(self, reason):
+        self._dead = reason
+        if self._process.is_alive():
+            self._process.kill()
+        self._process.join()
+        self._conn.close()
+
+    def close(self):
+        if getattr(self, "_dead", True):
+            return
+
+        try:
+            self._conn.send(("close", None, None, (), {}, []))
+        except (BrokenPipeError, OSError):
+            pass
+
+        self._process.join(1)
+        self._kill(GameError("Sandbox is closed."))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+def get_sandbox(TextGame):
+    """ Return the `Sandbox` running `TextGame`, or None if the game runs in-process. """
+    sandbox = getattr(TextGame, "__self__", None)
+    return sandbox if isinstance(sandbox, Sandbox) else None
+
+
+def get_sandbox_limits(args):
+    """ Return the sandbox limits requested on the command line, or None to run games in-process. """
+    if not args.sandbox:
+        return None
+
+    return {
+        "max_memory": args.sandbox_max_memory * 1024 * 1024,
+        "max_cpu_time": args.sandbox_max_cpu_time,
+        "step_timeout": args.sandbox_step_timeout,
+        "game_timeout": args.sandbox_game_timeout,
+    }
+
+
+@contextmanager
+def load_game(gamefile, sandbox_limits=None):
+    """ Yield the TextGame class of `gamefile`, run in a `Sandbox` when `sandbox_limits` are given. """
+    if sandbox_limits is None:
+        if os.path.dirname(gamefile) not in sys.path:
+            sys.path.append(os.path.dirname(gamefile))
+
+        yield importlib.import_module(os.path.basename(gamefile)[:-3]).TextGame
+        return
+
+    with Sandbox(gamefile, **sandbox_limits) as sandbox:
+        yield sandbox.TextGame
+
+
+def format_game_error(e, gamefile):
+    """ Format the game frames of the exception's traceback, followed by its message. """
+    frames = e.frames if isinstance(e, GameError) else traceback.format_tb(e.__traceback__)
+    stacktrace = [frame.replace(os.getcwd(), "").strip() for frame in frames if gamefile in frame]
+    return "\n".join(stacktrace) + "\n" + str(e)
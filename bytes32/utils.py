@@ -6,13 +6,55 @@ from httpx import ReadError, RemoteProtocolError
 from requests.exceptions import ChunkedEncodingError
 
 import openai
-import tiktoken
 
 from tqdm import tqdm
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
+from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception, retry_if_exception_type
 
+from bytes32.cache import make_response_key
+from bytes32.backends import OpenAIBackend
+from bytes32.ratelimit import retry_after, wait_retry_after
 
-client = openai.AzureOpenAI() if openai.api_type == "azure" else openai.OpenAI()
+
+# Where the chat completion requests are sent, created on first use, see `get_backend` and `set_backend`.
+backend = None
+
+# Sampling parameters of every call, making the responses (mostly) deterministic.
+SAMPLING_PARAMS = {"temperature": 0.0, "top_p": 1, "frequency_penalty": 0.0, "presence_penalty": 0.0}
+
+# Seconds between two refreshes of the streamed response shown by `stream_llm_gpt`
+STREAM_REFRESH_INTERVAL = 0.1
+
+# Number of times `stream_llm_gpt` resumes a broken stream, waiting twice as long after each failure
+STREAM_MAX_RETRIES = 10
+STREAM_RETRY_MIN_WAIT = 1
+STREAM_RETRY_MAX_WAIT = 60
+
+# Whether the backend accepts `stream_options`, asking for the usage of streamed responses. Older Azure
+# and OpenAI-compatible endpoints reject them, after which `stream_llm_gpt` streams without them.
+stream_usage_supported = True
+
+# Client errors that may not happen again when the request is sent again: timeout, conflict and rate limit.
+RETRYABLE_STATUS_CODES = (408, 409, 429)
+
+# Context window of the models, in tokens. Dated versions (e.g. "gpt-4-0613") use the entry of the longest
+# name they start with, and other models DEFAULT_CONTEXT_WINDOW.
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo": 4096,
+    "gpt-3.5-turbo-16k": 16385,
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+    "gpt-4-1106-preview": 128000,
+    "gpt-4-0125-preview": 128000,
+    "gpt-4-turbo": 128000,
+    "gpt-4o": 128000,
+}
+DEFAULT_CONTEXT_WINDOW = 4097
+
+# Optional `bytes32.ratelimit.RateLimiter` the requests wait for, see `set_rate_limiter`.
+rate_limiter = None
+
+# Optional `bytes32.cache.ResponseCache` answering the calls already made, see `set_response_cache`.
+response_cache = None
 
 
 if sys.version_info >= (3, 12):
@@ -31,8 +73,61 @@ else:
             yield batch
 
 
+def get_backend():
+    """ Backend the chat completion requests are sent to, an `OpenAIBackend` unless set otherwise. """
+    global backend
+    if backend is None:
+        # Created on first use, so that importing bytes32 needs no API key.
+        backend = OpenAIBackend()
+
+    return backend
+
+
+def set_backend(new_backend):
+    """ Send the chat completion requests to `new_backend` (see `bytes32.backends`). """
+    global backend
+    backend = new_backend
+
+
+def set_rate_limiter(limiter):
+    """ Make the requests wait for `limiter` before being sent. None disables rate limiting. """
+    global rate_limiter
+    rate_limiter = limiter
+
+
+def set_response_cache(cache):
+    """ Answer the LLM calls from `cache` when possible, and store the new responses in it. None disables caching. """
+    global response_cache
+    response_cache = cache
+
+
+def get_response_cache_stats():
+    """ Number of LLM calls answered from the response cache (hits) and sent to the API (misses) so far. """
+    if response_cache is None:
+        return {"hits": 0, "misses": 0}
+
+    return response_cache.stats()
+
+
+def _cached_response(model, messages, params):
+    """ Cache key of a call and its cached response, if any. """
+    if response_cache is None:
+        return None, None
+
+    key = make_response_key(model, messages, dict(SAMPLING_PARAMS, **params))
+    return key, response_cache.get(key)
+
+
+def _cache_response(key, model, response):
+    if key is not None:
+        response_cache.put(key, model, response)
+
+    return response
+
+
 @lru_cache()
 def get_tokenizer(model):
+    import tiktoken  # Slow to import, and only needed to count tokens.
     return tiktoken.encoding_for_model(model)
 
 
@@ -49,28 +144,58 @@ def count_tokens(text, model=None):
     return len(tokenizer.encode(text))
 
 
+def get_context_window(model):
+    """ Number of tokens the prompt and the response to it can add up to, for `model`. """
+    names = [name for name in MODEL_CONTEXT_WINDOWS if model == name or model.startswith(name + "-")]
+    return MODEL_CONTEXT_WINDOWS[max(names, key=len)] if names else DEFAULT_CONTEXT_WINDOW
+
+
+def estimate_tokens(model, kwargs):
+    """ Tokens a request counts for in the tokens-per-minute budget: its prompt, and what it may generate. """
+    prompt = "\n".join(str(message["content"]) for message in kwargs["messages"])
+    try:
+        num_tokens = count_tokens(prompt, model)
+    except KeyError:  # Model unknown to tiktoken
+        num_tokens = count_tokens(prompt)
+
+    return num_tokens + (kwargs.get("max_tokens") or 0) * (kwargs.get("n") or 1)
+
+
+def should_retry(error):
+    """ Whether a failed request is worth sending again: connection and server errors, but not client errors (4xx)
+    other than RETRYABLE_STATUS_CODES, which would fail the same way. """
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code >= 500 or error.status_code in RETRYABLE_STATUS_CODES
+
+    return isinstance(error, openai.APIError)
+
+
+def _pause_rate_limiter(model, error):
+    """ Hold all the requests to `model` if the API asked to retry later. """
+    seconds = retry_after(error)
+    if rate_limiter is not None and seconds is not None:
+        rate_limiter.pause(model, seconds)
+
+
 @retry(
     reraise=True,
     stop=stop_after_attempt(1000),
-    wait=wait_exponential(multiplier=1, min=4, max=10),
-    retry=(
-        retry_if_exception_type(openai.APIError)
-        | retry_if_exception_type(openai.APIConnectionError)
-        | retry_if_exception_type(openai.RateLimitError)
-    ),
+    wait=wait_retry_after(wait_exponential(multiplier=1, min=4, max=10)),
+    retry=retry_if_exception(should_retry),
 )
 def call_gpt(model, **kwargs):
-    kwargs["temperature"] = 0.0
-    kwargs["top_p"] = 1
-    kwargs["frequency_penalty"] = 0.0
-    kwargs["presence_penalty"] = 0.0
+    kwargs.update(SAMPLING_PARAMS)
     kwargs["timeout"] = 4*10*60  # 40 minutes
     kwargs["model"] = model
 
+    if rate_limiter is not None:
+        rate_limiter.acquire(model, estimate_tokens(model, kwargs))
+
     try:
-        response = client.chat.completions.create(**kwargs)
+        response = get_backend().create(**kwargs)
     except Exception as e:
         print(e)
+        _pause_rate_limiter(model, e)
         raise e
 
     return response
@@ -85,7 +210,12 @@ def call_gpt(model, **kwargs):
     ),
 )
 def llm_gpt(prompt, model="gpt-3.5-turbo", n=1, **kwargs):
-    response = call_gpt(model=model, messages=[{"role": "user", "content": prompt}], n=n, **kwargs)
+    messages = [{"role": "user", "content": prompt}]
+    key, output = _cached_response(model, messages, dict(kwargs, n=n))
+    if output is not None:
+        return output
+
+    response = call_gpt(model=model, messages=messages, n=n, **kwargs)
 
     if n == 1:
         choice = response.choices[0]
@@ -95,46 +225,147 @@ def llm_gpt(prompt, model="gpt-3.5-turbo", n=1, **kwargs):
         for choice in response.choices:
             output.append(choice.message.content.strip())
 
-    return output
+    return _cache_response(key, model, output)
+
+
+@retry(
+    reraise=True,
+    stop=stop_after_attempt(1000),
+    wait=wait_retry_after(wait_exponential(multiplier=1, min=4, max=10)),
+    retry=retry_if_exception(should_retry),
+)
+async def async_call_gpt(model, **kwargs):
+    """ Same as `call_gpt`, without blocking the event loop while waiting for the response. """
+    kwargs.update(SAMPLING_PARAMS)
+    kwargs["timeout"] = 4*10*60  # 40 minutes
+    kwargs["model"] = model
+
+    if rate_limiter is not None:
+        await rate_limiter.aacquire(model, estimate_tokens(model, kwargs))
+
+    try:
+        response = await get_backend().acreate(**kwargs)
+    except Exception as e:
+        print(e)
+        _pause_rate_limiter(model, e)
+        raise e
+
+    return response
+
+
+@retry(
+    reraise=True,
+    stop=stop_after_attempt(1000),
+    wait=wait_exponential(multiplier=1, min=4, max=10),
+    retry=(
+        retry_if_exception_type(openai.Timeout)
+    ),
+)
+async def async_llm_gpt(prompt, model="gpt-3.5-turbo", n=1, **kwargs):
+    """ Same as `llm_gpt`, to send many prompts concurrently from an event loop. """
+    messages = [{"role": "user", "content": prompt}]
+    key, output = _cached_response(model, messages, dict(kwargs, n=n))
+    if output is not None:
+        return output
+
+    response = await async_call_gpt(model=model, messages=messages, n=n, **kwargs)
+
+    if n == 1:
+        return _cache_response(key, model, response.choices[0].message.content.strip())
+
+    return _cache_response(key, model, [choice.message.content.strip() for choice in response.choices])
+
+
+@retry(
+    reraise=True,
+    stop=stop_after_attempt(1000),
+    wait=wait_exponential(multiplier=1, min=4, max=10),
+    retry=(
+        retry_if_exception_type(openai.Timeout)
+    ),
+)
+async def async_llm_logprobs(prompt, model="gpt-3.5-turbo", top_logprobs=5):
+    """ Log-probabilities of the most likely first tokens of the answer to a prompt, keyed by token. """
+    messages = [{"role": "user", "content": prompt}]
+    params = {"max_tokens": 1, "logprobs": True, "top_logprobs": top_logprobs}
+    key, output = _cached_response(model, messages, params)
+    if output is not None:
+        return output
+
+    response = await async_call_gpt(model=model, messages=messages, **params)
+
+    logprobs = response.choices[0].logprobs
+    if logprobs is None or not logprobs.content:
+        return {}
+
+    return _cache_response(key, model, {candidate.token: candidate.logprob for candidate in logprobs.content[0].top_logprobs})
 
 
 def stream_llm_gpt(prompt, model="gpt-3.5-turbo", **kwargs):
+    """ Stream the response to a prompt with a progress bar. If the connection breaks, the request is sent
+    again after an exponential backoff, asking to continue the response received so far. """
+    global stream_usage_supported
     messages = [{"role": "user", "content": prompt}]
+    key, response = _cached_response(model, messages, dict(kwargs, n=1))
+    if response is not None:
+        return response
 
     response = ""
+    num_failures = 0
+    pbar = tqdm(unit="token", total=kwargs.get("max_tokens", 8*1024), leave=False)
     while True:
+        pbar_start, response_start = pbar.n, len(response)
+        stream_options = {"stream_options": {"include_usage": True}} if stream_usage_supported else {}
         try:
-
-            stream = call_gpt(stream=True, model=model, messages=messages, **kwargs)
-            pbar = tqdm(stream, unit="token", total=kwargs.get("max_tokens", 8*1024), leave=False)
-            for chunk in pbar:
-                time.sleep(0.01)  # Should help with Errno 104: Connection reset by peer https://stackoverflow.com/questions/383738/104-connection-reset-by-peer-socket-error-or-when-does-closing-a-socket-resu
-                chunk_content = chunk.choices[0].delta.content
-
-                if chunk_content:
-                    response += chunk_content
+            stream = call_gpt(stream=True, model=model, messages=messages, **stream_options, **kwargs)
+            last_refresh = 0
+            for chunk in stream:
+                if chunk.usage is not None:
+                    # Exact count, sent with the last chunk, of the tokens generated by this request.
+                    pbar.n = pbar_start + chunk.usage.completion_tokens
+                    pbar.refresh()
+
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+
+                response += chunk.choices[0].delta.content
+                pbar.update(1)  # Chunks are usually one token each.
+                if time.time() - last_refresh > STREAM_REFRESH_INTERVAL:
                     pbar.set_postfix_str(f"...{response[-70:]!r}")
+                    last_refresh = time.time()
 
-                    nb_tokens = count_tokens(chunk_content)
-                    pbar.update(nb_tokens)
-            else:
-                pbar.close()
-                break
+            pbar.close()
+            break
+
+        except (openai.APIError, ChunkedEncodingError, ReadError, RemoteProtocolError) as e:
+            if isinstance(e, openai.BadRequestError) and stream_options and "stream_options" in str(e):
+                print(f"{e} Streaming without stream_options...")
+                stream_usage_supported = False
+                continue
 
-        except (openai.APITimeoutError, openai.APIError, ChunkedEncodingError, ReadError, RemoteProtocolError) as e:
-            if isinstance(e, openai.APIError):
+            # Connection resets and timeouts are APIConnectionErrors, other API errors may not be worth retrying.
+            if isinstance(e, openai.APIError) and not isinstance(e, openai.APIConnectionError):
                 print("*****", e.type)
                 if "An error occurred during streaming" not in e.message:
+                    pbar.close()
                     raise e
 
+            # Only count the failures in a row, without receiving anything in between.
+            num_failures = 1 if len(response) > response_start else num_failures + 1
+            if num_failures > STREAM_MAX_RETRIES:
+                pbar.close()
+                raise e
+
             # Append the response we received so far to messages.
             if len(messages) == 1:
                 messages.append({"role": "assistant", "content": response})
 
             messages[-1] = {"role": "assistant", "content": response}
-            print(e)
+            wait = min(STREAM_RETRY_MIN_WAIT * 2 ** (num_failures - 1), STREAM_RETRY_MAX_WAIT)
+            print(f"{e} Retrying in {wait}s...")
+            time.sleep(wait)
 
-    return response
+    return _cache_response(key, model, response)
 
 
 def load_program(filename):
@@ -171,6 +402,9 @@ def get_empty_metrics():
             "step": False, # has the member function step
             "calculateScore": False,
             "num_valid_actions": 0,
+            "num_states_explored": 0,
+            "num_unique_states": 0,
+            "coverage": 0.0,
             "error_msg": '',
         },
         "compliance": {
@@ -195,6 +429,13 @@ def get_empty_metrics():
         "alignment": {
             "score": 0,
             "error_msg": "",
+            "num_unique_states": 0,
+            "num_requests": 0,
+            "requests_saved": 0,
+            "num_unjudged": 0,
+            "num_deduplicated": 0,
+            "num_local_verdicts": 0,
+            "num_low_confidence": 0,
             "evaluations": [],
         },
     }
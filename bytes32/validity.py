@@ -1,20 +1,40 @@
 import os
 import sys
+import heapq
+import pickle
 import random
+import itertools
 import importlib
-import traceback
 
 import signal
 import random
-from contextlib import contextmanager
+import threading
+import multiprocessing
+from contextlib import contextmanager, ExitStack
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from bytes32.cache import TRANSIENT_ERROR
+from bytes32.sandbox import Sandbox, SandboxedGame, GameTimeoutError, GameTimeBudgetError, load_game, get_sandbox_limits, format_game_error
+from bytes32.fingerprint import game_fingerprint, TranspositionTable
+from bytes32.coverage import start_coverage
+from bytes32.profiling import start_profiler
 
 # Keep track of special errors
 timeoutErrors = []
 
 
+class EvaluationTimeout(TimeoutError):
+    """ The whole evaluation of a game went over the time set by `timeout`. """
+
+
 @contextmanager
 def timeout(time):
     # Ref: https://www.jujens.eu/posts/en/2018/Jun/02/python-timeout-function/
+    # Signals can only be handled on the main thread, elsewhere rely on the sandbox's deadlines.
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
     # Register a function to raise a TimeoutError on the signal.
     signal.signal(signal.SIGALRM, raise_timeout)
     # Schedule the signal to be sent after ``time``.
@@ -22,7 +42,7 @@ def timeout(time):
 
     try:
         yield
-    except (TimeoutError, KeyboardInterrupt):
+    except (EvaluationTimeout, KeyboardInterrupt):
         pass
     finally:
         # Unregister the signal so it won't be triggered
@@ -32,7 +52,7 @@ def timeout(time):
 
 def raise_timeout(signum, frame):
     print("Timeout")
-    raise TimeoutError
+    raise EvaluationTimeout
 
 
 def sample_actions(possible_actions, max_num_actions, random_seed):
@@ -56,6 +76,255 @@ def sample_actions(possible_actions, max_num_actions, random_seed):
     return possible_actions_out
 
 
+def snapshot_game(game):
+    """ Serialize the game state, or return None if the game can't be pickled. """
+    if isinstance(game, SandboxedGame):
+        return game.fork()
+
+    try:
+        return pickle.dumps(game, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        print(f"-> Can't checkpoint the game state ({e}), replaying actions instead.")
+        return None
+
+
+def restore_game(snapshot):
+    """ Rebuild an independent copy of a game from its snapshot. """
+    if isinstance(snapshot, SandboxedGame):
+        return snapshot.fork()
+
+    return pickle.loads(snapshot)
+
+
+def explore(TextGame, gamefile, first_actions, checks, args, should_stop=None, seen_states=None, coverage=None):
+    """ Depth-first search over the action sequences starting with `first_actions`.
+
+    Updates `checks` in place. Returns False as soon as the game fails (or
+    `should_stop()` becomes true), and True once the search space is exhausted.
+    When a `TranspositionTable` is given as `seen_states`, states already
+    expanded by another action sequence are not expanded again.
+
+    When a `LineCoverage` is given, the search is coverage-guided: states whose
+    last action ran new lines of `step` or `action*` methods are expanded first,
+    and actions whose verb wasn't tried yet are explored before the others.
+    """
+    # Stack ordered by priority, then last in first out. With no coverage, all
+    # priorities are 0 and this is a plain depth-first search.
+    action_stack = []
+    order = itertools.count()
+    tried_verbs = set()
+
+    def push(action_seq, parent, priority=0):
+        if coverage is not None and action_seq[-1].split()[0] not in tried_verbs:
+            priority += 1
+
+        heapq.heappush(action_stack, (-priority, -next(order), action_seq, parent))
+
+    # With checkpointing, each stack entry keeps a snapshot of its parent state
+    # so only the last action needs to be run. Otherwise, the whole action
+    # sequence is replayed from a freshly initialized game.
+    root = None
+    if args.validity_search == "checkpoint":
+        root = TextGame(randomSeed=args.random_seed)
+        root.generatePossibleActions()
+        root = snapshot_game(root)
+
+    if seen_states is not None:
+        # The initial state gets expanded by the first-level actions.
+        seen_states.visit(game_fingerprint(TextGame(randomSeed=args.random_seed)), args.max_steps)
+
+    for action in first_actions:
+        push([action], root)
+
+    while len(action_stack) > 0:
+        if should_stop is not None and should_stop():
+            return False
+
+        _, _, action_seq, parent = heapq.heappop(action_stack)
+        checks["num_states_explored"] += 1
+        #print(action_seq)
+        if parent is not None:
+            game = restore_game(parent)
+            actions_to_run = action_seq[-1:]
+        else:
+            game = TextGame(randomSeed=args.random_seed)
+            game.generatePossibleActions()
+            actions_to_run = action_seq
+
+        for action in actions_to_run:
+            try:
+                game.step(action)
+                checks["step"] = True
+            except (EvaluationTimeout, GameTimeBudgetError):
+                raise
+            except Exception as e:
+                checks["step"] = False
+                checks["error_msg"] = format_game_error(e, gamefile)
+                return False
+
+        novelty = 0
+        if coverage is not None:
+            tried_verbs.add(action_seq[-1].split()[0])
+            novelty = coverage.poll_new_targets()
+
+        try:
+            if not game.gameOver:
+                remaining_steps = args.max_steps - len(action_seq)
+                if remaining_steps > 0 and (seen_states is None or seen_states.visit(game_fingerprint(game), remaining_steps)):
+                    # Snapshot before generatePossibleActions() refreshes the game's
+                    # action dictionary, so children step exactly as a replay would.
+                    snapshot = snapshot_game(game) if parent is not None else None
+
+                    try:
+                        possible_actions = game.generatePossibleActions()
+                    except (EvaluationTimeout, GameTimeBudgetError):
+                        raise
+                    except Exception as e:
+                        checks["generatePossibleActions"] = False
+                        checks["error_msg"] = format_game_error(e, gamefile)
+                        return False
+
+                    # truncate possible actions if the num of possible actions is too large
+                    possible_actions = sample_actions(possible_actions, args.max_num_actions//10, args.random_seed)
+                    for possible_action in possible_actions:
+                        push(action_seq + [possible_action], snapshot, novelty)
+
+            elif game.gameWon:
+                checks['winnable'] = True
+        except (EvaluationTimeout, GameTimeBudgetError):
+            raise
+        except GameTimeoutError as e:
+            checks["error_msg"] = format_game_error(e, gamefile)
+            return False
+        except Exception:
+            return False
+
+    return True
+
+
+# Per-process state of the parallel validity workers.
+_worker = {}
+
+
+def _init_worker(gamefile, cutoff, sandbox_limits, trace_coverage):
+    # Import the game module once per worker process.
+    if sandbox_limits is not None:
+        _worker["sandbox"] = Sandbox(gamefile, **sandbox_limits)
+        _worker["TextGame"] = _worker["sandbox"].TextGame
+    else:
+        if os.path.dirname(gamefile) not in sys.path:
+            sys.path.append(os.path.dirname(gamefile))
+
+        _worker["TextGame"] = importlib.import_module(os.path.basename(gamefile)[:-3]).TextGame
+
+    _worker["cutoff"] = cutoff
+    _worker["coverage"] = start_coverage(_worker["TextGame"], gamefile) if trace_coverage else None
+
+
+def _explore_subtree(gamefile, rank, action, args):
+    cutoff = _worker["cutoff"]
+    checks = {"winnable": False, "step": False, "generatePossibleActions": True, "error_msg": "", "num_states_explored": 0}
+    seen_states = TranspositionTable() if args.prune_duplicate_states else None
+    coverage = _worker["coverage"]
+    profiler = start_profiler(_worker["TextGame"], gamefile) if args.profile_games else None
+    completed = explore(_worker["TextGame"], gamefile, [action], checks, args,
+                        should_stop=lambda: cutoff.value < rank, seen_states=seen_states, coverage=coverage)
+    checks["profile"] = profiler.stop() if profiler is not None else {}
+
+    # Send the fingerprints and covered lines back, so they are counted across subtrees.
+    checks["seen_states"] = list(seen_states.depths) if seen_states is not None else []
+    checks["coverage_lines"] = sorted(coverage.covered_lines()) if coverage is not None else []
+
+    if not completed:
+        # Let the workers exploring later subtrees know they can stop.
+        with cutoff.get_lock():
+            cutoff.value = min(cutoff.value, rank)
+
+    return rank, completed, checks
+
+
+def kill_workers(executor):
+    if hasattr(executor, "kill_workers"):  # Python 3.14+
+        executor.kill_workers()
+        return
+
+    for process in list((executor._processes or {}).values()):
+        process.kill()
+
+
+def explore_parallel(gamefile, first_actions, checks, args, coverage=None, profiler=None):
+    """ Same as `explore`, but the subtree of each first-level action runs in a worker process.
+
+    Subtrees are ranked in the order the serial DFS would visit them. Once a subtree
+    fails, the subtrees ranked after it are cancelled, and the results of the earlier
+    ones are merged into `checks` so the output matches the serial search. With a
+    `LineCoverage`, each worker guides its own search, and the lines they covered
+    are added to `coverage`. Likewise, subtrees are profiled separately and added
+    to `profiler`.
+    """
+    # Workers record their own coverage and profile.
+    if coverage is not None:
+        coverage.stop()
+    if profiler is not None:
+        profiler.stop()
+
+    # The serial DFS pops first-level actions from the end of its stack.
+    ranked_actions = list(reversed(first_actions))
+    cutoff = multiprocessing.Value("i", len(ranked_actions))
+
+    results = {}
+    executor = ProcessPoolExecutor(max_workers=args.validity_workers,
+                                   initializer=_init_worker, initargs=(gamefile, cutoff, get_sandbox_limits(args), coverage is not None))
+    try:
+        futures = {executor.submit(_explore_subtree, gamefile, rank, action, args): rank
+                   for rank, action in enumerate(ranked_actions)}
+
+        for future in as_completed(futures):
+            if future.cancelled():
+                continue
+
+            rank, completed, subtree_checks = future.result()
+            results[rank] = (completed, subtree_checks)
+            if not completed:
+                for other_future, other_rank in futures.items():
+                    if other_rank > cutoff.value:
+                        other_future.cancel()
+
+            # Stop as soon as every subtree up to the first failing one is done.
+            if all(rank in results for rank in range(min(cutoff.value + 1, len(ranked_actions)))):
+                break
+
+    except BaseException:
+        kill_workers(executor)
+        raise
+
+    finally:
+        cutoff.value = -1  # Stop any worker still exploring.
+        executor.shutdown(wait=True, cancel_futures=True)
+
+    seen_states = set()
+    for rank in range(len(ranked_actions)):
+        completed, subtree_checks = results[rank]
+        checks["winnable"] |= subtree_checks["winnable"]
+        checks["num_states_explored"] += subtree_checks["num_states_explored"]
+        seen_states.update(subtree_checks["seen_states"])
+        checks["num_unique_states"] = len(seen_states)
+        if coverage is not None:
+            coverage.update(subtree_checks["coverage_lines"])
+        if profiler is not None:
+            profiler.update(subtree_checks["profile"])
+
+        if not completed:
+            checks["step"] = subtree_checks["step"]
+            checks["generatePossibleActions"] = subtree_checks["generatePossibleActions"]
+            checks["error_msg"] = subtree_checks["error_msg"]
+            return False
+
+        checks["step"] |= subtree_checks["step"]
+
+    return True
+
+
 def check_validity(gamefile, args):
     """ Check the validty of a game: class, methods, scoring function, runnability."""
     checks = {
@@ -67,109 +336,108 @@ def check_validity(gamefile, args):
         "step": False, # has the member function step
         "calculateScore": False,
         "num_valid_actions": 0,
+        "num_states_explored": 0,
+        "num_unique_states": 0,
+        "coverage": 0.0,
         "error_msg": '',
     }
 
     timedOut = True
     timeoutDuration = 15 * 60   # 15 minutes
-    with timeout(timeoutDuration):
-        try:
-            if os.path.dirname(gamefile) not in sys.path:
-                sys.path.append(os.path.dirname(gamefile))
+    try:
+        with timeout(timeoutDuration), ExitStack() as stack:
+            try:
+                TextGame = stack.enter_context(load_game(gamefile, get_sandbox_limits(args)))
+                print(gamefile)
+            except TimeoutError:
+                raise
+            except Exception as e:
+                print(e)
+                checks["error_msg"] = str(e)
+                return checks
 
-            TextGame = importlib.import_module(os.path.basename(gamefile)[:-3]).TextGame
-            print(gamefile)
-        except Exception as e:
-            print(e)
-            checks["error_msg"] = str(e)
-            return checks
+            coverage = None
+            if args.validity_order == "coverage":
+                coverage = start_coverage(TextGame, gamefile)
+                stack.callback(lambda: checks.update(coverage=round(coverage.percent(), 2)))
+                stack.callback(coverage.stop)
 
-        try:
-            game = TextGame(randomSeed=args.random_seed)
-            checks['TextGame'] = True
-            print("-> Successfully initialized the game.")
-        except Exception as e:
-            print(e)
-            checks["error_msg"] = str(e)
-            return checks
+            profiler = None
+            if args.profile_games:
+                profiler = start_profiler(TextGame, gamefile)
+                stack.callback(lambda: checks.update(profile=profiler.stop()))
 
-        try:
-            task_desc = game.getTaskDescription()
-            checks["getTaskDescription"] = True
-            print(f"-> Task Description: {task_desc}")
-        except Exception as e:
-            print(e)
-            checks["error_msg"] = str(e)
-            return checks
+            try:
+                game = TextGame(randomSeed=args.random_seed)
+                checks['TextGame'] = True
+                print("-> Successfully initialized the game.")
+            except TimeoutError:
+                raise
+            except Exception as e:
+                print(e)
+                checks["error_msg"] = str(e)
+                return checks
 
-        try:
-            game.calculateScore()
-            checks["calculateScore"] = True
-            print("-> calculateScore() is implemented.")
-        except Exception as e:
-            print(e)
-            checks["error_msg"] = str(e)
-            return checks
+            try:
+                task_desc = game.getTaskDescription()
+                checks["getTaskDescription"] = True
+                print(f"-> Task Description: {task_desc}")
+            except TimeoutError:
+                raise
+            except Exception as e:
+                print(e)
+                checks["error_msg"] = str(e)
+                return checks
 
-        try:
-            possible_actions = game.generatePossibleActions()
-            num_first_step_possible_actions = len(possible_actions)
-            checks["num_valid_actions"] = num_first_step_possible_actions
-            checks["generatePossibleActions"] = True
-            print("-> generatePossibleActions() is implemented.")
-        except Exception as e:
-            print(e)
-            checks["error_msg"] = str(e)
-            return checks
-
-        # DFS search
-        action_stack = []
-
-        # truncate possible actions if the num of possible actions is too large
-        possible_actions = sample_actions(possible_actions, args.max_num_actions, args.random_seed)
-        for action in possible_actions:
-            action_stack.append([action])
-
-        while len(action_stack) > 0:
-            action_seq = action_stack.pop()
-            #print(action_seq)
-            game = TextGame(randomSeed=args.random_seed)
-            game.generatePossibleActions()
-            for action in action_seq:
-                try:
-                    game.step(action)
-                    checks["step"] = True
-                except Exception as e:
-                    stacktrace = [frame.replace(os.getcwd(), "").strip() for frame in traceback.format_tb(e.__traceback__) if gamefile in frame]
-                    checks["step"] = False
-                    checks["error_msg"] = "\n".join(stacktrace) + "\n" + str(e)
-                    return checks
+            try:
+                game.calculateScore()
+                checks["calculateScore"] = True
+                print("-> calculateScore() is implemented.")
+            except TimeoutError:
+                raise
+            except Exception as e:
+                print(e)
+                checks["error_msg"] = str(e)
+                return checks
 
             try:
-                if not game.gameOver:
-                    if len(action_seq) < args.max_steps:
-                        try:
-                            possible_actions = game.generatePossibleActions()
-                        except Exception as e:
-                            stacktrace = [frame.replace(os.getcwd(), "").strip() for frame in traceback.format_tb(e.__traceback__) if gamefile in frame]
-                            checks["generatePossibleActions"] = False
-                            checks["error_msg"] = "\n".join(stacktrace) + "\n" + str(e)
-                            return checks
-
-                        # truncate possible actions if the num of possible actions is too large
-                        possible_actions = sample_actions(possible_actions, args.max_num_actions//10, args.random_seed)
-                        for possible_action in possible_actions:
-                            action_stack.append(action_seq + [possible_action])
-
-                elif game.gameWon:
-                    checks['winnable'] = True
-            except:
+                possible_actions = game.generatePossibleActions()
+                num_first_step_possible_actions = len(possible_actions)
+                checks["num_valid_actions"] = num_first_step_possible_actions
+                checks["generatePossibleActions"] = True
+                print("-> generatePossibleActions() is implemented.")
+            except TimeoutError:
+                raise
+            except Exception as e:
+                print(e)
+                checks["error_msg"] = str(e)
                 return checks
-        timedOut = False
+
+            # DFS search
+            # truncate possible actions if the num of possible actions is too large
+            possible_actions = sample_actions(possible_actions, args.max_num_actions, args.random_seed)
+            if args.validity_workers > 1:
+                completed = explore_parallel(gamefile, possible_actions, checks, args, coverage=coverage, profiler=profiler)
+            else:
+                seen_states = TranspositionTable() if args.prune_duplicate_states else None
+                completed = explore(TextGame, gamefile, possible_actions, checks, args, seen_states=seen_states, coverage=coverage)
+                checks["num_unique_states"] = len(seen_states or [])
+
+            if not completed:
+                return checks
+
+            timedOut = False
+    except GameTimeoutError as e:
+        # A deadline of the sandbox, not the overall timeout above
+        print(e)
+        checks[TRANSIENT_ERROR] = isinstance(e, GameTimeBudgetError)
+        checks["error_msg"] = format_game_error(e, gamefile)
+        return checks
 
     # Check to see if the game timed out during evaluation
     if timedOut:
         print("Evaluation timed out after " + str(timeoutDuration) + " seconds.")
+        checks[TRANSIENT_ERROR] = True  # Wall-clock time, which depends on the load of the machine
         checks["error_msg"] = "Automatic evaluation timed out.  This could be due to an infinite loop in the code, waiting for user input outside the main() function, or some other issue or unusually-long-running procedure."
         # Record this timeout error
         timeoutErrors.append(gamefile)
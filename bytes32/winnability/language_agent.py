@@ -6,17 +6,22 @@ import logging
 import argparse
 import datetime
 
+from collections import deque
 from logging import INFO
 from os.path import join as pjoin
 
-import tiktoken
 from tqdm import tqdm
 from termcolor import colored
 
-from bytes32.utils import llm_gpt
+from bytes32.utils import llm_gpt, count_tokens, get_context_window
+from bytes32.ratelimit import llm_priority, INTERACTIVE
+from bytes32.sandbox import load_game
 
 EXAMPLE_FILE = pjoin(os.path.dirname(__file__), "example.txt")
 
+# Tokens of the context window left for the agent's next action.
+ACTION_TOKENS = 60
+
 
 def clean(s):
     clean_toks = ['\n', '\t']
@@ -30,6 +35,54 @@ def clean(s):
     return s
 
 
+class TurnHistory():
+    """ Text of a prompt split into turns, each starting with the '>' before an action, with the number of tokens
+    of each turn cached. The oldest turns are removed without counting the tokens of the whole text again. """
+
+    def __init__(self, text, model):
+        self.model = model
+        self.head = ""  # Text before the first turn
+        self.head_tokens = 0
+        self.turns = deque()  # [text, num_tokens] of each turn
+        self.num_tokens = 0  # Sum of the tokens of the head and the turns, counted separately.
+        self.append(text)
+
+    def append(self, text):
+        """ Add text to the last turn, starting a new turn at each '>'. """
+        pieces = text.split(">")
+        if self.turns:
+            self._extend_last_turn(pieces[0])
+        else:
+            self.head += pieces[0]
+            self.num_tokens -= self.head_tokens
+            self.head_tokens = self._count_tokens(self.head)
+            self.num_tokens += self.head_tokens
+
+        for piece in pieces[1:]:
+            self.turns.append([">", 0])
+            self._extend_last_turn(piece)
+
+    def remove_oldest_turn(self):
+        _, num_tokens = self.turns.popleft()
+        self.num_tokens -= num_tokens
+
+    def _extend_last_turn(self, text):
+        turn = self.turns[-1]
+        turn[0] += text
+        self.num_tokens -= turn[1]
+        turn[1] = self._count_tokens(turn[0])
+        self.num_tokens += turn[1]
+
+    def _count_tokens(self, text):
+        try:
+            return count_tokens(text, self.model)
+        except KeyError:  # Model unknown to tiktoken
+            return count_tokens(text)
+
+    def __str__(self):
+        return self.head + "".join(text for text, _ in self.turns)
+
+
 def llm_gpt_with_pbar(prompt, model, pbar=None, **kwargs):
     try:
         output = llm_gpt(prompt, model, pbar=pbar, **kwargs)
@@ -41,20 +94,20 @@ def llm_gpt_with_pbar(prompt, model, pbar=None, **kwargs):
     return output
 
 
-def check_winnability(gamefile, model_name, random_seed, env_step_limit, logger=None):
-    logger = logger or logging.getLogger()
+def check_winnability(gamefile, model_name, random_seed, env_step_limit, logger=None, sandbox_limits=None):
+    # Import environment, in a sandboxed process if limits are given.
+    # The agent's steps go before bulk LLM calls when rate limited.
+    with load_game(gamefile, sandbox_limits) as TextGame, llm_priority(INTERACTIVE):
+        return play_game(TextGame, model_name, random_seed, env_step_limit, logger)
 
-    # Import environment
-    #sys.path.append(os.path.dirname(gamefile))
-    TextGame = __import__(os.path.basename(gamefile[:-3])).TextGame
+
+def play_game(TextGame, model_name, random_seed, env_step_limit, logger=None):
+    logger = logger or logging.getLogger()
 
     # Load ICL example
     with open(EXAMPLE_FILE) as f:
         example = f.read()
 
-    # Load encoding tool to count token numbers
-    encoding = tiktoken.encoding_for_model(model_name)
-
     # Initialize environment
     env = TextGame(randomSeed=random_seed)
     task_description = env.getTaskDescription()
@@ -93,47 +146,36 @@ def check_winnability(gamefile, model_name, random_seed, env_step_limit, logger=
     logger.info("Prompt: " + colored(init_prompt, "cyan") + colored(prompt, "yellow"))
 
     # Different models have different maximun token numbers
-    if model_name == "gpt-3.5-turbo":
-        max_len = 4096
-    elif model_name == "gpt-4":
-        max_len = 8192
-    else:
-        max_len = 4097
+    max_len = get_context_window(model_name)
+    init_history = TurnHistory(init_prompt, model_name)
+    history = TurnHistory(prompt, model_name)
 
     pbar = tqdm(total=max_steps, desc="Steps", unit="step")
     while not done:
         pbar.update(1)
 
-        # Cut the prompt to make it shorter than maximun token numbers
-        while len(encoding.encode(init_prompt + prompt)) > max_len - 60:
-            index1 = init_prompt.find('>')
-
-            # If init prompt doesn't have actions, cut game prompt
-            if index1 == -1:
-                index1_prompt = prompt.find('>')
-                index2_prompt = prompt.find('>', index1_prompt+1)
-                prompt = prompt[:index1_prompt] + prompt[index2_prompt:]
-
-            # Cut initial prompt
+        # Cut the prompt to make it shorter than maximun token numbers,
+        # removing the turns of the example first, then the oldest turns of the game.
+        while init_history.num_tokens + history.num_tokens > max_len - ACTION_TOKENS:
+            if init_history.turns:
+                init_history.remove_oldest_turn()
+            elif len(history.turns) > 1:
+                history.remove_oldest_turn()
             else:
-                index2 = init_prompt.find('>', index1+1)
-                if index2 == -1:
-                    init_prompt = init_prompt[:index1]
-                else:
-                    init_prompt = init_prompt[:index1] + init_prompt[index2:]
+                break  # Only the task and the last turn are left.
 
-        action = llm_gpt(init_prompt + prompt, stop=['\n'], model=model_name, pbar=pbar).strip("> ")
+        action = llm_gpt(str(init_history) + str(history), stop=['\n'], model=model_name, pbar=pbar).strip("> ")
         pbar.set_postfix_str("")
         action = action.strip()
         recent_actions.append(action)
 
         # Don't need to actually do think/bug/done actions.
         if action == 'bug':
-            prompt += f' {action}\n'
+            history.append(f' {action}\n')
             logger.info(colored(f' {action}', 'green'))
             break
         elif action == 'done':
-            prompt += f' {action}\n'
+            history.append(f' {action}\n')
             logger.info(colored(f' {action}', 'green'))
             break
         elif action.startswith('think:'):
@@ -157,7 +199,7 @@ def check_winnability(gamefile, model_name, random_seed, env_step_limit, logger=
 
         # Add action and observaton to game prompt
         logger.info(colored(f' {action}', 'green') + f'\n{obs}')
-        prompt += f' {action}\n{obs}\n>'
+        history.append(f' {action}\n{obs}\n>')
 
         step += 1
         if (step >= max_steps) or done or game_won:
@@ -173,8 +215,8 @@ def check_winnability(gamefile, model_name, random_seed, env_step_limit, logger=
     stats["step"] = step
     stats["max_steps"] = max_steps
     stats["history"] = recent_actions
-    stats["transcript"] = prompt
-    stats["init_prompt"] = init_prompt
+    stats["transcript"] = str(history)
+    stats["init_prompt"] = str(init_history)
 
     logger.info("Run completed...")
 
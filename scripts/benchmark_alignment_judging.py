@@ -0,0 +1,58 @@
+import os
+import time
+import asyncio
+import argparse
+
+from termcolor import colored
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the alignment judging against a local fake LLM server.")
+    parser.add_argument("--num-paths", type=int, default=100)
+    parser.add_argument("--alignment-batch-size", type=int, default=1)
+    parser.add_argument("--alignment-token-budget", type=int)
+    parser.add_argument("--alignment-judge", choices=["justify", "logprob"], default="justify")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32],
+                        help="Concurrency limits to compare. Default: %(default)s")
+    parser.add_argument("--latency", type=float, default=0.2,
+                        help="Seconds the fake server waits before answering each request. Default: %(default)s")
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+
+    # The OpenAI clients need a key, even to talk to the fake server.
+    os.environ.setdefault("OPENAI_API_KEY", "fake")
+    import bytes32.utils
+    from bytes32.fake_llm import FakeLLMServer
+    from bytes32.backends import OpenAIBackend
+    from bytes32.alignment import judge_paths, judge_paths_logprobs
+
+    server = FakeLLMServer(latency=args.latency).start()
+    bytes32.utils.set_backend(OpenAIBackend(base_url=server.base_url))
+
+    playthroughs = [[{"action": "", "observation": "You are in the kitchen."},
+                     {"action": f"take item {i}", "observation": f"You take item {i}."}]
+                    for i in range(args.num_paths)]
+
+    for concurrency in args.concurrency:
+        judge_args = argparse.Namespace(alignment_model_name="gpt-4", alignment_batch_size=args.alignment_batch_size,
+                                        alignment_token_budget=args.alignment_token_budget, alignment_max_retries=2,
+                                        alignment_concurrency=concurrency, alignment_confidence=0.9)
+        judge = judge_paths_logprobs if args.alignment_judge == "logprob" else judge_paths
+        num_requests = server.num_requests
+        start = time.time()
+        evaluations = asyncio.run(judge(playthroughs, "Take the items.", judge_args))[0]
+        elapsed = time.time() - start
+
+        assert [evaluation["playthrough"][-1]["action"] for evaluation in evaluations] == [f"take item {i}" for i in range(args.num_paths)]
+        print(colored(f"Concurrency {concurrency}: {server.num_requests - num_requests} requests in {elapsed:.2f}s"
+                      f" ({len(playthroughs) / elapsed:.1f} playthroughs/s)", "yellow"))
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import os
+import re
+import sys
+import argparse
+import subprocess
+
+from termcolor import colored
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Dependencies of the LLM checks, which running the games shouldn't load.
+HEAVY_MODULES = ("openai", "tiktoken", "pandas", "httpx", "requests")
+
+IMPORTTIME_PATTERN = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Check that importing bytes32 stays fast and needs no API key, using `python -X importtime`.")
+    parser.add_argument("--statement", default="from bytes32 import check_validity",
+                        help="Import statement to time. Default: %(default)s")
+    parser.add_argument("--budget", type=float, default=100,
+                        help="Maximum import time, in milliseconds. Default: %(default)s")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="Number of runs, the fastest one being kept. Default: %(default)s")
+    parser.add_argument("--top", type=int, default=10,
+                        help="Number of slowest modules to show. Default: %(default)s")
+    args = parser.parse_args()
+    return args
+
+
+def importtime(statement):
+    """ Self and cumulative import times in microseconds, and indentation level, of the modules imported by a fresh
+    interpreter running `statement` without any OpenAI credentials. """
+    env = {name: value for name, value in os.environ.items() if not name.startswith(("OPENAI_", "AZURE_OPENAI_"))}
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [ROOT, env.get("PYTHONPATH")]))
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", statement], env=env, cwd=ROOT, capture_output=True, text=True)
+    if process.returncode != 0:
+        sys.exit(colored(f"'{statement}' failed:\n{process.stderr[-2000:]}", "red"))
+
+    modules = {}
+    for line in process.stderr.splitlines():
+        match = IMPORTTIME_PATTERN.match(line)
+        if match:
+            modules[match.group(4)] = (int(match.group(1)), int(match.group(2)), len(match.group(3)) // 2)
+
+    return modules
+
+
+def main():
+    args = parse_args()
+
+    # Modules imported by the interpreter itself aren't counted.
+    startup = set(importtime("pass"))
+
+    runs = []
+    for _ in range(args.repeat):
+        modules = {name: times for name, times in importtime(args.statement).items() if name not in startup}
+        runs.append((sum(cumulative for _, cumulative, level in modules.values() if level == 0) / 1000, modules))
+
+    elapsed, modules = min(runs, key=lambda run: run[0])
+    print(colored(f"'{args.statement}': {elapsed:.1f}ms, {len(modules)} modules (fastest of {args.repeat} runs)", "yellow"))
+    for name, (own, _, _) in sorted(modules.items(), key=lambda item: item[1][0], reverse=True)[:args.top]:
+        print(f"  {own / 1000:7.1f}ms  {name}")
+
+    heavy = sorted({name.split(".")[0] for name in modules} & set(HEAVY_MODULES))
+    if heavy:
+        sys.exit(colored(f"'{args.statement}' imports {', '.join(heavy)}.", "red"))
+
+    if elapsed > args.budget:
+        sys.exit(colored(f"'{args.statement}' takes {elapsed:.1f}ms to import, over the {args.budget:g}ms budget.", "red"))
+
+    print(colored(f"Within the {args.budget:g}ms budget.", "green"))
+
+
+if __name__ == "__main__":
+    main()
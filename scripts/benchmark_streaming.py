@@ -0,0 +1,86 @@
+import os
+import time
+import argparse
+
+from tqdm import tqdm
+from termcolor import colored
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the overhead of streaming a response against a local fake LLM server.")
+    parser.add_argument("--num-tokens", type=int, default=2000,
+                        help="Number of tokens of the streamed response. Default: %(default)s")
+    parser.add_argument("--model", default="gpt-4")
+    parser.add_argument("--skip-legacy", action="store_true",
+                        help="Don't time the previous streaming loop, which sleeps 10ms per token.")
+    args = parser.parse_args()
+    return args
+
+
+def legacy_stream_llm_gpt(prompt, model, **kwargs):
+    """ Previous streaming loop: sleeps, tokenizes and refreshes the progress bar for every chunk. """
+    from bytes32.utils import call_gpt, count_tokens
+
+    response = ""
+    stream = call_gpt(stream=True, model=model, messages=[{"role": "user", "content": prompt}], **kwargs)
+    pbar = tqdm(stream, unit="token", total=kwargs.get("max_tokens", 8*1024), leave=False)
+    for chunk in pbar:
+        time.sleep(0.01)
+        chunk_content = chunk.choices[0].delta.content
+        if chunk_content:
+            response += chunk_content
+            pbar.set_postfix_str(f"...{response[-70:]!r}")
+            pbar.update(count_tokens(chunk_content))
+
+    pbar.close()
+    return response
+
+
+def raw_stream(prompt, model, **kwargs):
+    """ Lower bound: only concatenate the chunks. """
+    from bytes32.utils import call_gpt
+
+    response = ""
+    for chunk in call_gpt(stream=True, model=model, messages=[{"role": "user", "content": prompt}], **kwargs):
+        if chunk.choices and chunk.choices[0].delta.content:
+            response += chunk.choices[0].delta.content
+
+    return response
+
+
+def main():
+    args = parse_args()
+
+    # The OpenAI clients need a key, even to talk to the fake server.
+    os.environ.setdefault("OPENAI_API_KEY", "fake")
+    import bytes32.utils
+    import bytes32.fake_llm
+    from bytes32.fake_llm import FakeLLMServer
+    from bytes32.backends import OpenAIBackend
+
+    expected = " ".join(f"token{i}" for i in range(args.num_tokens))
+    bytes32.fake_llm.fake_response = lambda prompt: expected
+
+    server = FakeLLMServer().start()
+    bytes32.utils.set_backend(OpenAIBackend(base_url=server.base_url))
+
+    streamers = {"raw": raw_stream, "stream_llm_gpt": bytes32.utils.stream_llm_gpt}
+    if not args.skip_legacy:
+        streamers["legacy"] = legacy_stream_llm_gpt
+
+    timings = {}
+    for name, stream in streamers.items():
+        start = time.time()
+        response = stream("Write a long program.", args.model, max_tokens=args.num_tokens)
+        timings[name] = time.time() - start
+        assert response == expected
+
+    for name, elapsed in timings.items():
+        print(colored(f"{name}: {elapsed:.2f}s for {args.num_tokens} tokens,"
+                      f" {(elapsed - timings['raw']) / args.num_tokens * 1000:.3f}ms overhead per token", "yellow"))
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+import os
+import argparse
+
+from termcolor import colored
+
+from bytes32.cache import ResultCache, CHECK_ARGS
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Inspect, evict and compact the cache of check results.")
+    parser.add_argument("cache_file", help="SQLite file caching the results of each check.")
+
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("stats", help="Show the number of cached results per check.")
+
+    evict_parser = subparsers.add_parser("evict", help="Remove cached results.")
+    evict_parser.add_argument("--older-than", type=float,
+                              help="Remove the results not used in that many days.")
+    evict_parser.add_argument("--max-entries", type=int,
+                              help="Keep at most that many results, removing the least recently used ones.")
+    evict_parser.add_argument("--check", choices=sorted(CHECK_ARGS),
+                              help="Only remove the results of that check.")
+    evict_parser.add_argument("--compact", action="store_true",
+                              help="Also compact the file afterwards.")
+
+    subparsers.add_parser("compact", help="Reclaim the space left by removed results.")
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+
+    if not os.path.exists(args.cache_file):
+        print(colored(f"No cache found at {args.cache_file}", "red"))
+        return
+
+    cache = ResultCache(args.cache_file)
+
+    if args.command == "evict":
+        older_than = args.older_than * 24 * 60 * 60 if args.older_than is not None else None
+        removed = cache.evict(older_than=older_than, check=args.check, max_entries=args.max_entries)
+        print(colored(f"Removed {removed} cached results.", "yellow"))
+
+    if args.command == "compact" or (args.command == "evict" and args.compact):
+        size = os.path.getsize(args.cache_file)
+        cache.compact()
+        print(colored(f"Compacted {args.cache_file}: {size / 1024**2:.1f}MB -> {os.path.getsize(args.cache_file) / 1024**2:.1f}MB", "yellow"))
+
+    for check, count in sorted(cache.stats().items()):
+        print(f"{check}: {count} results")
+
+    print(f"File size: {os.path.getsize(args.cache_file) / 1024**2:.1f}MB")
+    cache.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -14,34 +14,53 @@ from bytes32 import check_winnability
 from bytes32 import check_compliance
 from bytes32 import check_alignment
 from bytes32 import check_validity
-from bytes32.utils import get_empty_metrics
+from bytes32.backends import make_backend
+from bytes32.ratelimit import RateLimiter
+from bytes32.batch import batch_request, run_batch
+from bytes32.cache import ResultCache, ResponseCache, cached_check, make_key
+from bytes32.compliance import get_compliance_files, get_compliance_inputs, make_compliance_prompt, compliance_results
+from bytes32.prescreen import prescreen_games
+from bytes32.sandbox import get_sandbox_limits
+from bytes32.utils import get_empty_metrics, set_response_cache, get_response_cache_stats, set_backend, set_rate_limiter
 
 
-def automatic_evaluation(gamefile, args, metrics=None):
-    """ Automatically evaluate one game """
+def automatic_evaluation(gamefile, args, metrics=None, cache=None, prescreen=None, compliance=None):
+    """ Automatically evaluate one game, reusing the `compliance` results computed in batch, if any. """
 
     metrics = metrics or get_empty_metrics()
 
-    # Run validity check.
-    print(colored("Running validity check...", "yellow"))
-    metrics["validity"] = check_validity(gamefile, args)
+    # Games failing the static pre-screen can't be run, skip the checks running them.
+    prescreen_failed = prescreen is not None and not prescreen["passed"]
+    if prescreen_failed:
+        print(colored(f"Static pre-screen failed:\n{prescreen['checks']['error_msg']}", "red"))
+        metrics["validity"] = prescreen["checks"]
+    else:
+        if prescreen is not None and prescreen["warnings"]:
+            print(colored("Static pre-screen warnings:\n" + "\n".join(prescreen["warnings"]), "yellow"))
 
-    # Run GPT evaluation for compliance.
-    if not args.skip_check_compliance:
-        metrics["compliance"] = check_compliance(gamefile, args)
+        # Run validity check.
+        print(colored("Running validity check...", "yellow"))
+        metrics["validity"] = cached_check(cache, "validity", gamefile, args, lambda: check_validity(gamefile, args))
 
-    if metrics["validity"]["error_msg"] and not args.ignore_validity_errors:
+    # Run GPT evaluation for compliance, which only reads the code.
+    if not args.skip_check_compliance and (not prescreen_failed or prescreen["readable"]):
+        metrics["compliance"] = cached_check(cache, "compliance", gamefile, args, lambda: compliance or check_compliance(gamefile, args),
+                                             extra_files=get_compliance_files(gamefile, args), extra_inputs=get_compliance_inputs(gamefile))
+
+    if prescreen_failed or (metrics["validity"]["error_msg"] and not args.ignore_validity_errors):
         return metrics  # Can't run the program correctly.
 
     # Run GPT evaluation for alignment.
     if not args.skip_check_alignment:
-        metrics["alignment"] = check_alignment(gamefile, args)
+        metrics["alignment"] = cached_check(cache, "alignment", gamefile, args, lambda: check_alignment(gamefile, args))
 
     # Run GPT agent for winnability.
     if not args.skip_check_winnability:
         try:
             print(colored("Running winnability check...", "yellow"))
-            metrics["winnability"] = check_winnability(gamefile, args.agent_model_name, args.game_random_seed, args.env_step_limit)
+            metrics["winnability"] = cached_check(cache, "winnability", gamefile, args,
+                                                  lambda: check_winnability(gamefile, args.agent_model_name, args.game_random_seed, args.env_step_limit,
+                                                                            sandbox_limits=get_sandbox_limits(args)))
         except Exception as e:
             stacktrace = [frame.replace(os.getcwd(), "").strip() for frame in traceback.format_tb(e.__traceback__) if gamefile in frame or "language_agent.py" in frame]
             metrics["validity"]["error_msg"] = "\n".join(stacktrace) + "\n" + str(e)
@@ -49,6 +68,23 @@ def automatic_evaluation(gamefile, args, metrics=None):
     return metrics
 
 
+def batch_compliance(gamefiles, args, cache=None):
+    """ Compliance results of the games whose compliance isn't cached yet, from a single Batch API job. """
+    requests = {}
+    for gamefile in gamefiles:
+        key = make_key("compliance", gamefile, args, get_compliance_files(gamefile, args), get_compliance_inputs(gamefile))
+        if cache is not None and cache.get("compliance", key) is not None:
+            continue
+
+        requests[gamefile] = batch_request(os.path.basename(gamefile), make_compliance_prompt(gamefile, args),
+                                           args.compliance_model_name, n=args.compliance_majority_vote)
+
+    batch_file = args.batch_file or pjoin(os.path.dirname(args.results_file), "compliance_batch.jsonl")
+    outputs = run_batch(list(requests.values()), batch_file, poll_interval=args.batch_poll_interval)
+    return {gamefile: compliance_results(gamefile, outputs[request["custom_id"]], args)
+            for gamefile, request in requests.items() if request["custom_id"] in outputs}
+
+
 def parse_args():
     parser = argparse.ArgumentParser()
 
@@ -57,6 +93,35 @@ def parse_args():
     group.add_argument("--games", nargs="+")
 
     parser.add_argument("--results-file", type=str, default="eval_results.json")
+    parser.add_argument("--cache-file", type=str,
+                        help="SQLite file caching the results of each check. Default: checks_cache.sqlite next to the results file.")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Recompute every check, without reading or updating the cache.")
+    parser.add_argument("--llm-cache-file",
+                        help="SQLite file caching the LLM responses. Default: llm_cache.sqlite next to the results file.")
+    parser.add_argument("--llm-cache-mode", choices=["readwrite", "readonly", "refresh", "off"], default="readwrite",
+                        help="'readonly' doesn't store new responses, 'refresh' replaces the cached ones instead of using them,"
+                             " 'off' disables the cache. Default: %(default)s")
+    parser.add_argument("--llm-cache-max-size", type=float, default=1024,
+                        help="Size in MB above which the least recently used responses are removed. Default: %(default)s")
+    parser.add_argument("--llm-backend", choices=["openai", "record", "replay"], default="openai",
+                        help="'record' sends the requests to the API and logs them with their responses to --llm-log,"
+                             " 'replay' answers them from that log, offline. Default: %(default)s")
+    parser.add_argument("--llm-log",
+                        help="Log of LLM requests and responses written by the 'record' backend, and read by 'replay'.")
+    parser.add_argument("--llm-rpm", type=int,
+                        help="Requests per minute allowed for each model. Default: unlimited.")
+    parser.add_argument("--llm-tpm", type=int,
+                        help="Tokens per minute allowed for each model, counting the prompts and the max tokens to generate. Default: unlimited.")
+    parser.add_argument("--llm-rate-limit-file",
+                        help="File sharing the --llm-rpm and --llm-tpm budgets with other processes using it.")
+
+    parser.add_argument("--batch", action="store_true",
+                        help="Ask the compliance votes of all the games at once through the Batch API, before the other checks.")
+    parser.add_argument("--batch-file",
+                        help="JSONL file of the batched requests. Default: compliance_batch.jsonl next to the results file.")
+    parser.add_argument("--batch-poll-interval", type=float, default=60,
+                        help="Seconds between two checks of the status of the batch. Default: %(default)s")
 
     parser.add_argument("--skip-check-alignment", action="store_true")
     parser.add_argument("--skip-check-compliance", action="store_true")
@@ -64,10 +129,38 @@ def parse_args():
     parser.add_argument("--ignore-validity-errors", action="store_true",
                         help="Ignore validity errors and run alignment and winnability checks anyway.")
 
+    parser.add_argument("--prune-duplicate-states", action="store_true",
+                        help="Don't expand game states already reached through another action sequence, when checking validity and crawling paths.")
+    parser.add_argument("--profile-games", action="store_true",
+                        help="Record the time and calls spent in each game method, and the peak memory, when checking validity and crawling paths.")
+
     validity_group = parser.add_argument_group("Technical Validity")
     validity_group.add_argument("--max-steps", type=int, default=3)
     validity_group.add_argument("--random-seed", type=int, default=0)
     validity_group.add_argument("--max-num-actions", type=int, default=100)
+    validity_group.add_argument("--validity-search", choices=["replay", "checkpoint"], default="replay",
+                                help="Replay each action sequence from a fresh game, or branch from checkpointed game states. Default: %(default)s")
+    validity_group.add_argument("--validity-workers", type=int, default=1,
+                                help="Number of processes exploring the first-level actions in parallel. Default: %(default)s")
+    validity_group.add_argument("--validity-order", choices=["dfs", "coverage"], default="dfs",
+                                help="Explore actions depth-first, or first those running new lines of the game's step/action methods,"
+                                     " which also records the line coverage of the game. Default: %(default)s")
+    validity_group.add_argument("--skip-prescreen", action="store_true",
+                                help="Don't statically check the games (syntax, TextGame methods, code run on import, endless loops) before running them.")
+    validity_group.add_argument("--prescreen-workers", type=int,
+                                help="Number of processes running the static pre-screen. Default: number of CPUs.")
+
+    sandbox_group = parser.add_argument_group("Sandbox")
+    sandbox_group.add_argument("--sandbox", action="store_true",
+                               help="Run the games in a child process with hard resource limits.")
+    sandbox_group.add_argument("--sandbox-max-memory", type=int, default=4096,
+                               help="Address space limit of the game process, in MB. Default: %(default)s")
+    sandbox_group.add_argument("--sandbox-max-cpu-time", type=int, default=15*60,
+                               help="CPU time limit of the game process, in seconds. Default: %(default)s")
+    sandbox_group.add_argument("--sandbox-step-timeout", type=float, default=60,
+                               help="Deadline for each call into the game, in seconds. Default: %(default)s")
+    sandbox_group.add_argument("--sandbox-game-timeout", type=float, default=15*60,
+                               help="Total time a game may spend answering calls, in seconds. Default: %(default)s")
 
     compliance_group = parser.add_argument_group("Specification Compliance")
     compliance_group.add_argument("--compliance-model-name", default="gpt-4")
@@ -83,6 +176,25 @@ def parse_args():
     alignment_group.add_argument("--error-strategy", type=str, default="fail")
     alignment_group.add_argument("--num-samples-per-game", type=int, default=100)
     alignment_group.add_argument("--sample-strategy", type=str, default="action_even")
+    alignment_group.add_argument("--alignment-token-budget", type=int,
+                                 help="Pack as many playthroughs as fit in that many tokens in each alignment prompt,"
+                                      " instead of --alignment-batch-size playthroughs.")
+    alignment_group.add_argument("--dedup-playthroughs", action="store_true",
+                                 help="Only judge one of the sampled playthroughs differing by the objects they use, and give its verdict to the others.")
+    alignment_group.add_argument("--alignment-max-retries", type=int, default=2,
+                                 help="Number of times the playthroughs missing from an alignment response are sent again. Default: %(default)s")
+    alignment_group.add_argument("--alignment-concurrency", type=int, default=8,
+                                 help="Maximum number of alignment requests sent at the same time. Default: %(default)s")
+    alignment_group.add_argument("--alignment-judge", choices=["justify", "logprob"], default="justify",
+                                 help="'justify' asks for a justified evaluation of each playthrough, 'logprob' for a single-token"
+                                      " verdict whose probability is read from the logprobs. Default: %(default)s")
+    alignment_group.add_argument("--alignment-confidence", type=float, default=0.9,
+                                 help="With --alignment-judge logprob, playthroughs whose verdict is less likely than that"
+                                      " are judged again with justifications. Default: %(default)s")
+    alignment_group.add_argument("--crawl-workers", type=int, default=1,
+                                 help="Number of processes crawling the first-level actions in parallel. With more than one,"
+                                      " each subtree is shuffled with its own seed, so the paths differ from the serial crawl"
+                                      " but not with the number of workers. Default: %(default)s")
     alignment_group.add_argument("--alignment-batch-size", type=int, default=1)
 
     winnability_group = parser.add_argument_group("Winnability")
@@ -103,7 +215,34 @@ def main():
         with open(args.results_file) as f:
             results = json.load(f)
 
+    cache = None
+    if not args.no_cache:
+        cache = ResultCache(args.cache_file or pjoin(os.path.dirname(args.results_file), "checks_cache.sqlite"))
+
+    if args.llm_cache_mode != "off":
+        set_response_cache(ResponseCache(args.llm_cache_file or pjoin(os.path.dirname(args.results_file), "llm_cache.sqlite"),
+                                         args.llm_cache_mode, args.llm_cache_max_size * 1024**2))
+
+    if args.llm_backend != "openai":
+        set_backend(make_backend(args.llm_backend, args.llm_log))
+
+    if args.llm_rpm or args.llm_tpm:
+        set_rate_limiter(RateLimiter(args.llm_rpm, args.llm_tpm, args.llm_rate_limit_file))
+
     gamefiles = args.games or glob(pjoin(args.game_folder, "*.py"))
+
+    prescreens = {}
+    if not args.skip_prescreen:
+        print(colored("Running static pre-screen...", "yellow"))
+        prescreens = prescreen_games([gamefile for gamefile in gamefiles if os.path.basename(gamefile) not in results],
+                                     args.prescreen_workers)
+
+    compliance = {}
+    if args.batch and not args.skip_check_compliance:
+        print(colored("Running compliance check in batch...", "yellow"))
+        compliance = batch_compliance([gamefile for gamefile in sorted(gamefiles) if os.path.basename(gamefile) not in results
+                                       and prescreens.get(gamefile, {"readable": True})["readable"]], args, cache)
+
     pbar = tqdm(sorted(gamefiles))
     for gamefile in pbar:
         time.sleep(0.1)
@@ -115,7 +254,10 @@ def main():
         existing_metrics = results.get(os.path.basename(gamefile), {}).get("metrics")
         existing_reflection_prompt = results.get(os.path.basename(gamefile), {}).get("reflection_prompt", "")
         existing_reflection_response = results.get(os.path.basename(gamefile), {}).get("reflection_response", "")
-        new_metrics = automatic_evaluation(gamefile, args, metrics=existing_metrics)
+        llm_cache_stats = get_response_cache_stats()
+        new_metrics = automatic_evaluation(gamefile, args, metrics=existing_metrics, cache=cache,
+                                           prescreen=prescreens.get(gamefile), compliance=compliance.get(gamefile))
+        new_metrics["llm_cache"] = {name: count - llm_cache_stats[name] for name, count in get_response_cache_stats().items()}
         results[os.path.basename(gamefile)] = {
             "metrics": new_metrics,
             "reflection_prompt": existing_reflection_prompt,
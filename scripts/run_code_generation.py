@@ -8,32 +8,21 @@ from os.path import join as pjoin
 import pandas as pd
 from termcolor import colored
 
+from bytes32.backends import make_backend
+from bytes32.batch import batch_request, run_batch
+from bytes32.ratelimit import RateLimiter
+from bytes32.cache import ResponseCache
 from bytes32.utils import count_tokens, stream_llm_gpt, extract_python_code, load_program
+from bytes32.utils import set_response_cache, get_response_cache_stats, set_backend, set_rate_limiter
 
 
 MAX_CONTEXT_LENGTH = 32000
 MAX_PROGRAM_LENGTH = 16000
 
 
-def parse_args():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("experiment_file", help="CSV file")
-    parser.add_argument("--data", type=str, default="./data/")
-    parser.add_argument("--output-folder", type=str, default=f"./results/{datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S')}/generated_games/")
-    parser.add_argument("--model", type=str, default="gpt-4-32k")
-
-    parser.add_argument("--strip-comments", action="store_true")
-    parser.add_argument("--zero-shot", action="store_true", help="Perform zero-shot generation (no in-context example code).")
-
-    args = parser.parse_args()
-    return args
-
-
-def main():
-    args = parse_args()
-
-    os.makedirs(args.output_folder, exist_ok=True)
-
+def pending_generations(args):
+    """ Yield the output prefix, prompt and max new tokens of each game of the experiment file not generated yet,
+    writing the prompts to the output folder. """
     experiment_name = args.experiment_file.split("/")[-1].split(".csv")[0]
     experiment_df = pd.read_csv(args.experiment_file, header=None)
     for n, row in experiment_df.iterrows():
@@ -82,27 +71,104 @@ def main():
             with open(prompt_out_file, 'w') as f:
                 f.write(prompt)
 
-            print(colored(f"Prompting {args.model} for 1-shot generation...", "yellow"))
             context_length = count_tokens(prompt, args.model)
             print(colored(f"  Context length {context_length} tokens.", "yellow"))
 
             max_new_tokens = min(max(0, MAX_CONTEXT_LENGTH-context_length), MAX_PROGRAM_LENGTH)
+            yield fileout_prefix, prompt, max_new_tokens
+
+
+def save_generation(args, fileout_prefix, response):
+    """ Write the response, and the program extracted from it, to the output folder. """
+    print(colored(f"  Responded with {count_tokens(response, args.model)} tokens.", "yellow"))
+    programOut = extract_python_code(response)
+
+    generation_txt_file = pjoin(args.output_folder,f"{fileout_prefix}_generation.txt")
+    print (f"  Saving response to: {generation_txt_file}")
+    with open(generation_txt_file, 'w') as f:
+        f.write(response)
+
+    generation_py_file = pjoin(args.output_folder,f"{fileout_prefix}_generation.py")
+    print (f"  Saving postprocessed program to: {generation_py_file}")
+    with open(generation_py_file, 'w') as f:
+        f.write(programOut)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("experiment_file", help="CSV file")
+    parser.add_argument("--data", type=str, default="./data/")
+    parser.add_argument("--output-folder", type=str, default=f"./results/{datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S')}/generated_games/")
+    parser.add_argument("--model", type=str, default="gpt-4-32k")
+
+    parser.add_argument("--strip-comments", action="store_true")
+    parser.add_argument("--zero-shot", action="store_true", help="Perform zero-shot generation (no in-context example code).")
+
+    parser.add_argument("--batch", action="store_true",
+                        help="Generate all the games at once through the Batch API, instead of streaming them one by one.")
+    parser.add_argument("--batch-file",
+                        help="JSONL file of the batched requests. Default: generation_batch.jsonl in the output folder.")
+    parser.add_argument("--batch-poll-interval", type=float, default=60,
+                        help="Seconds between two checks of the status of the batch. Default: %(default)s")
+
+    parser.add_argument("--llm-cache-file",
+                        help="SQLite file caching the LLM responses. Default: llm_cache.sqlite in the output folder.")
+    parser.add_argument("--llm-cache-mode", choices=["readwrite", "readonly", "refresh", "off"], default="readwrite",
+                        help="'readonly' doesn't store new responses, 'refresh' replaces the cached ones instead of using them,"
+                             " 'off' disables the cache. Default: %(default)s")
+    parser.add_argument("--llm-cache-max-size", type=float, default=1024,
+                        help="Size in MB above which the least recently used responses are removed. Default: %(default)s")
+    parser.add_argument("--llm-backend", choices=["openai", "record", "replay"], default="openai",
+                        help="'record' sends the requests to the API and logs them with their responses to --llm-log,"
+                             " 'replay' answers them from that log, offline. Default: %(default)s")
+    parser.add_argument("--llm-log",
+                        help="Log of LLM requests and responses written by the 'record' backend, and read by 'replay'.")
+    parser.add_argument("--llm-rpm", type=int,
+                        help="Requests per minute allowed for each model. Default: unlimited.")
+    parser.add_argument("--llm-tpm", type=int,
+                        help="Tokens per minute allowed for each model, counting the prompts and the max tokens to generate. Default: unlimited.")
+    parser.add_argument("--llm-rate-limit-file",
+                        help="File sharing the --llm-rpm and --llm-tpm budgets with other processes using it.")
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+
+    os.makedirs(args.output_folder, exist_ok=True)
+
+    if args.llm_cache_mode != "off":
+        set_response_cache(ResponseCache(args.llm_cache_file or pjoin(args.output_folder, "llm_cache.sqlite"),
+                                         args.llm_cache_mode, args.llm_cache_max_size * 1024**2))
+
+    if args.llm_backend != "openai":
+        set_backend(make_backend(args.llm_backend, args.llm_log))
+
+    if args.llm_rpm or args.llm_tpm:
+        set_rate_limiter(RateLimiter(args.llm_rpm, args.llm_tpm, args.llm_rate_limit_file))
+
+    if args.batch:
+        generations = list(pending_generations(args))
+        requests = [batch_request(fileout_prefix, prompt, args.model, max_tokens=max_new_tokens)
+                    for fileout_prefix, prompt, max_new_tokens in generations]
+        print(colored(f"Prompting {args.model} for 1-shot generation of {len(requests)} games in batch...", "yellow"))
+        outputs = run_batch(requests, args.batch_file or pjoin(args.output_folder, "generation_batch.jsonl"),
+                            poll_interval=args.batch_poll_interval)
+        for fileout_prefix, _, _ in generations:
+            if fileout_prefix in outputs:
+                save_generation(args, fileout_prefix, outputs[fileout_prefix])
+    else:
+        for fileout_prefix, prompt, max_new_tokens in pending_generations(args):
+            print(colored(f"Prompting {args.model} for 1-shot generation...", "yellow"))
             start = time.time()
             response = stream_llm_gpt(prompt, args.model, max_tokens=max_new_tokens)
             print(colored(f"  Response time: {time.time()-start} secs.", "yellow"))
+            save_generation(args, fileout_prefix, response)
 
-            print(colored(f"  Responded with {count_tokens(response, args.model)} tokens.", "yellow"))
-            programOut = extract_python_code(response)
-
-            generation_txt_file = pjoin(args.output_folder,f"{fileout_prefix}_generation.txt")
-            print (f"  Saving response to: {generation_txt_file}")
-            with open(generation_txt_file, 'w') as f:
-                f.write(response)
-
-            generation_py_file = pjoin(args.output_folder,f"{fileout_prefix}_generation.py")
-            print (f"  Saving postprocessed program to: {generation_py_file}")
-            with open(generation_py_file, 'w') as f:
-                f.write(programOut)
+    llm_cache_stats = get_response_cache_stats()
+    print(colored(f"LLM response cache: {llm_cache_stats['hits']} hits, {llm_cache_stats['misses']} misses.", "yellow"))
 
 
 if __name__ == "__main__":
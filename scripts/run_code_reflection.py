@@ -17,10 +17,18 @@ from bytes32 import check_winnability
 from bytes32 import check_compliance
 from bytes32 import check_alignment
 from bytes32 import check_validity
+from bytes32.backends import make_backend
+from bytes32.ratelimit import RateLimiter
+from bytes32.cache import ResultCache, ResponseCache, cached_check
+from bytes32.compliance import get_compliance_files, get_compliance_inputs
+from bytes32.prescreen import prescreen_game
+from bytes32.profiling import describe_profile
+from bytes32.sandbox import get_sandbox_limits
 from bytes32.utils import stream_llm_gpt, count_tokens, extract_python_code, get_empty_metrics
+from bytes32.utils import set_response_cache, get_response_cache_stats, set_backend, set_rate_limiter
 
 
-def automatic_evaluation(gamefile, args):
+def automatic_evaluation(gamefile, args, cache=None):
     """ Automatically evaluate one game """
 
     metrics = get_empty_metrics()
@@ -45,21 +53,33 @@ def automatic_evaluation(gamefile, args):
             metrics["validity"]["error_msg"] = "STOP: Code has 50% less lines than previous iteration."
             return metrics
 
+    # Statically check the game before running it.
+    if not args.skip_prescreen:
+        prescreen = prescreen_game(gamefile)
+        if not prescreen["passed"]:
+            print(colored(f"Static pre-screen failed:\n{prescreen['checks']['error_msg']}", "red"))
+            metrics["validity"] = prescreen["checks"]
+            return metrics
+
+        if prescreen["warnings"]:
+            print(colored("Static pre-screen warnings:\n" + "\n".join(prescreen["warnings"]), "yellow"))
+
     # Run validity check.
     print(colored("Running validity check...", "yellow"))
-    metrics["validity"] = check_validity(gamefile, args)
+    metrics["validity"] = cached_check(cache, "validity", gamefile, args, lambda: check_validity(gamefile, args))
     if metrics["validity"]["error_msg"]:
         return metrics
 
     # Run GPT evaluation for compliance.
     if args.reflect_compliance:
-        metrics["compliance"] = check_compliance(gamefile, args)
+        metrics["compliance"] = cached_check(cache, "compliance", gamefile, args, lambda: check_compliance(gamefile, args),
+                                             extra_files=get_compliance_files(gamefile, args), extra_inputs=get_compliance_inputs(gamefile))
         if not metrics["compliance"]["passed"]:
             return metrics
 
     # Run GPT evaluation for alignment.
     if args.reflect_alignment:
-        metrics["alignment"] = check_alignment(gamefile, args)
+        metrics["alignment"] = cached_check(cache, "alignment", gamefile, args, lambda: check_alignment(gamefile, args))
         if not metrics["alignment"]["aligned"]:
             return metrics
 
@@ -67,7 +87,9 @@ def automatic_evaluation(gamefile, args):
     if args.reflect_winnability:
         try:
             print(colored("Running winnability check...", "yellow"))
-            metrics["winnability"] = check_winnability(gamefile, args.agent_model_name, args.game_random_seed, args.env_step_limit)
+            metrics["winnability"] = cached_check(cache, "winnability", gamefile, args,
+                                                  lambda: check_winnability(gamefile, args.agent_model_name, args.game_random_seed, args.env_step_limit,
+                                                                            sandbox_limits=get_sandbox_limits(args)))
         except Exception as e:
             stacktrace = [frame.replace(os.getcwd(), "").strip() for frame in traceback.format_tb(e.__traceback__) if gamefile in frame or "language_agent.py" in frame]
             metrics["validity"]["error_msg"] = "\n".join(stacktrace) + "\n" + str(e)
@@ -121,6 +143,10 @@ def reflect(gamefile, metrics, args):
         prompt_ = "Here is the error message from a Python interpretor.\n"
         prompt_ += metrics["validity"]["error_msg"]
         prompt_ += "\n"
+        if "timed out" in metrics["validity"]["error_msg"] and metrics["validity"].get("profile"):
+            # Point at the slow methods rather than just the timeout.
+            prompt_ += describe_profile(metrics["validity"]["profile"])
+            prompt_ += "\n"
     elif args.reflect_compliance and not metrics["compliance"]["passed"] and metrics["compliance"]["response_msg"]:
         prompt_ = f"While there were no errors from the Python interpretor, the game misses a required {metrics['compliance']['experiment']}. Here's the evaluation comments of the game:\n"
         prompt_ += "```"
@@ -193,14 +219,14 @@ def stop_reflection(metrics, args):
     )
 
 
-def perform_code_reflection(source, args):
+def perform_code_reflection(source, args, cache=None):
     game_name = os.path.basename(source)[:-3]
     last_revision, gamefile = find_latest_revision(source, args)
     if last_revision == 0:
         gamefile = pjoin(args.revision_folder, f"{game_name}_v0.py")
         shutil.copyfile(source, gamefile)
 
-    metrics = automatic_evaluation(gamefile, args)
+    metrics = automatic_evaluation(gamefile, args, cache=cache)
     yield gamefile, {"metrics": metrics, "reflection_prompt": "", "reflection_response": ""}
 
     # Prompt GPT for code revision until automatic evaluation yields success or we reach max reflection steps.
@@ -215,7 +241,7 @@ def perform_code_reflection(source, args):
         with open(gamefile, 'w') as f:
             f.write(reflection_game)
 
-        metrics = automatic_evaluation(gamefile, args)
+        metrics = automatic_evaluation(gamefile, args, cache=cache)
         yield gamefile, {"metrics": metrics, "reflection_prompt": reflection_prompt, "reflection_response": reflection_response}
 
 
@@ -227,6 +253,28 @@ def parse_args():
     group.add_argument("--games", nargs="+")
 
     parser.add_argument("--results-file", default="results.json")
+    parser.add_argument("--cache-file",
+                        help="SQLite file caching the results of each check. Default: checks_cache.sqlite next to the results file.")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Recompute every check, without reading or updating the cache.")
+    parser.add_argument("--llm-cache-file",
+                        help="SQLite file caching the LLM responses. Default: llm_cache.sqlite next to the results file.")
+    parser.add_argument("--llm-cache-mode", choices=["readwrite", "readonly", "refresh", "off"], default="readwrite",
+                        help="'readonly' doesn't store new responses, 'refresh' replaces the cached ones instead of using them,"
+                             " 'off' disables the cache. Default: %(default)s")
+    parser.add_argument("--llm-cache-max-size", type=float, default=1024,
+                        help="Size in MB above which the least recently used responses are removed. Default: %(default)s")
+    parser.add_argument("--llm-backend", choices=["openai", "record", "replay"], default="openai",
+                        help="'record' sends the requests to the API and logs them with their responses to --llm-log,"
+                             " 'replay' answers them from that log, offline. Default: %(default)s")
+    parser.add_argument("--llm-log",
+                        help="Log of LLM requests and responses written by the 'record' backend, and read by 'replay'.")
+    parser.add_argument("--llm-rpm", type=int,
+                        help="Requests per minute allowed for each model. Default: unlimited.")
+    parser.add_argument("--llm-tpm", type=int,
+                        help="Tokens per minute allowed for each model, counting the prompts and the max tokens to generate. Default: unlimited.")
+    parser.add_argument("--llm-rate-limit-file",
+                        help="File sharing the --llm-rpm and --llm-tpm budgets with other processes using it.")
     parser.add_argument("--revision-folder", default="revised_games/",
                         help="Where to save the revised games. Default: %(default)s")
     parser.add_argument("--final-folder", default="final_games/",
@@ -246,10 +294,36 @@ def parse_args():
     parser.add_argument("--reflect-winnability", action="store_true",
                         help="Also, reflect on game winnability.")
 
+    parser.add_argument("--prune-duplicate-states", action="store_true",
+                        help="Don't expand game states already reached through another action sequence, when checking validity and crawling paths.")
+    parser.add_argument("--profile-games", action="store_true",
+                        help="Record the time and calls spent in each game method, and the peak memory, when checking validity and crawling paths.")
+
     validity_group = parser.add_argument_group("Technical Validity")
     validity_group.add_argument("--max-steps", type=int, default=3)
     validity_group.add_argument("--random-seed", type=int, default=0)
     validity_group.add_argument("--max-num-actions", type=int, default=100)
+    validity_group.add_argument("--validity-search", choices=["replay", "checkpoint"], default="replay",
+                                help="Replay each action sequence from a fresh game, or branch from checkpointed game states. Default: %(default)s")
+    validity_group.add_argument("--validity-workers", type=int, default=1,
+                                help="Number of processes exploring the first-level actions in parallel. Default: %(default)s")
+    validity_group.add_argument("--validity-order", choices=["dfs", "coverage"], default="dfs",
+                                help="Explore actions depth-first, or first those running new lines of the game's step/action methods,"
+                                     " which also records the line coverage of the game. Default: %(default)s")
+    validity_group.add_argument("--skip-prescreen", action="store_true",
+                                help="Don't statically check the games (syntax, TextGame methods, code run on import, endless loops) before running them.")
+
+    sandbox_group = parser.add_argument_group("Sandbox")
+    sandbox_group.add_argument("--sandbox", action="store_true",
+                               help="Run the games in a child process with hard resource limits.")
+    sandbox_group.add_argument("--sandbox-max-memory", type=int, default=4096,
+                               help="Address space limit of the game process, in MB. Default: %(default)s")
+    sandbox_group.add_argument("--sandbox-max-cpu-time", type=int, default=15*60,
+                               help="CPU time limit of the game process, in seconds. Default: %(default)s")
+    sandbox_group.add_argument("--sandbox-step-timeout", type=float, default=60,
+                               help="Deadline for each call into the game, in seconds. Default: %(default)s")
+    sandbox_group.add_argument("--sandbox-game-timeout", type=float, default=15*60,
+                               help="Total time a game may spend answering calls, in seconds. Default: %(default)s")
 
     compliance_group = parser.add_argument_group("Specification Compliance")
     compliance_group.add_argument("--compliance-model-name", default="gpt-4")
@@ -264,6 +338,25 @@ def parse_args():
     alignment_group.add_argument("--error-strategy", type=str, default="fail")
     alignment_group.add_argument("--num-samples-per-game", type=int, default=100)
     alignment_group.add_argument("--sample-strategy", type=str, default="action_even")
+    alignment_group.add_argument("--alignment-token-budget", type=int,
+                                 help="Pack as many playthroughs as fit in that many tokens in each alignment prompt,"
+                                      " instead of --alignment-batch-size playthroughs.")
+    alignment_group.add_argument("--dedup-playthroughs", action="store_true",
+                                 help="Only judge one of the sampled playthroughs differing by the objects they use, and give its verdict to the others.")
+    alignment_group.add_argument("--alignment-max-retries", type=int, default=2,
+                                 help="Number of times the playthroughs missing from an alignment response are sent again. Default: %(default)s")
+    alignment_group.add_argument("--alignment-concurrency", type=int, default=8,
+                                 help="Maximum number of alignment requests sent at the same time. Default: %(default)s")
+    alignment_group.add_argument("--alignment-judge", choices=["justify", "logprob"], default="justify",
+                                 help="'justify' asks for a justified evaluation of each playthrough, 'logprob' for a single-token"
+                                      " verdict whose probability is read from the logprobs. Default: %(default)s")
+    alignment_group.add_argument("--alignment-confidence", type=float, default=0.9,
+                                 help="With --alignment-judge logprob, playthroughs whose verdict is less likely than that"
+                                      " are judged again with justifications. Default: %(default)s")
+    alignment_group.add_argument("--crawl-workers", type=int, default=1,
+                                 help="Number of processes crawling the first-level actions in parallel. With more than one,"
+                                      " each subtree is shuffled with its own seed, so the paths differ from the serial crawl"
+                                      " but not with the number of workers. Default: %(default)s")
 
     winnability_group = parser.add_argument_group("Game Winnability")
     winnability_group.add_argument("--agent-model-name", default="gpt-4")
@@ -287,6 +380,20 @@ def main():
         with open(args.results_file) as f:
             reflection_results = json.load(f)
 
+    cache = None
+    if not args.no_cache:
+        cache = ResultCache(args.cache_file or pjoin(os.path.dirname(args.results_file), "checks_cache.sqlite"))
+
+    if args.llm_cache_mode != "off":
+        set_response_cache(ResponseCache(args.llm_cache_file or pjoin(os.path.dirname(args.results_file), "llm_cache.sqlite"),
+                                         args.llm_cache_mode, args.llm_cache_max_size * 1024**2))
+
+    if args.llm_backend != "openai":
+        set_backend(make_backend(args.llm_backend, args.llm_log))
+
+    if args.llm_rpm or args.llm_tpm:
+        set_rate_limiter(RateLimiter(args.llm_rpm, args.llm_tpm, args.llm_rate_limit_file))
+
     gamefiles = args.games or glob(pjoin(args.game_folder, "*.py"))
     pbar = tqdm(sorted(gamefiles))
     for gamefile in pbar:
@@ -303,7 +410,10 @@ def main():
                 # The game has no error and is runnable, and the GPT agent has finished the game without reporting a bug.
                 continue
 
-        for revised_gamefile, stats in perform_code_reflection(gamefile, args):
+        llm_cache_stats = get_response_cache_stats()
+        for revised_gamefile, stats in perform_code_reflection(gamefile, args, cache=cache):
+            stats["metrics"]["llm_cache"] = {name: count - llm_cache_stats[name] for name, count in get_response_cache_stats().items()}
+            llm_cache_stats = get_response_cache_stats()
             reflection_results[os.path.basename(revised_gamefile)] = stats
             with open(args.results_file, 'w') as f:
                 json.dump(reflection_results, f, indent=2)
@@ -0,0 +1,31 @@
+import os
+
+import pytest
+
+from bytes32.fake_llm import FakeLLMServer
+
+# The OpenAI clients refuse to be created without an API key, even when talking to the stand-in server.
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+REFERENCE_GAME = os.path.join(os.path.dirname(__file__), "..", "data", "programs", "balance-scale-weigh.py")
+
+
+@pytest.fixture
+def fake_server():
+    server = FakeLLMServer().start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def word_tokens(monkeypatch):
+    """ Count tokens as words and punctuation marks, since tiktoken's encodings can't be downloaded offline. """
+    import re
+    import bytes32.utils
+
+    def count_tokens(text, model=None):
+        return len(re.findall(r"\w+|[^\w\s]", text))
+
+    monkeypatch.setattr(bytes32.utils, "count_tokens", count_tokens)
+    return count_tokens
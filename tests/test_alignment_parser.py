@@ -0,0 +1,40 @@
+from bytes32.alignment import parse_alignment_response
+
+
+def test_parses_one_evaluation_per_line():
+    response = '{"idx": 0, "evaluation": "yes"}\n{"idx": 1, "evaluation": "no", "reason": "Wrong weight."}'
+    assert parse_alignment_response(response, 2) == {0: {"evaluation": "yes"},
+                                                     1: {"evaluation": "no", "reason": "Wrong weight."}}
+
+
+def test_tolerates_formatting():
+    response = '```json\n[\n  {"idx": 0, "evaluation": "yes"},\n  {"idx": 1, "evaluation": "no"},\n]\n```'
+    assert parse_alignment_response(response, 2) == {0: {"evaluation": "yes"}, 1: {"evaluation": "no"}}
+
+
+def test_normalizes_verdicts():
+    response = '{"idx": 0, "evaluation": " Yes "}\n{"idx": 1, "evaluation": "ERROR"}'
+    assert parse_alignment_response(response, 2) == {0: {"evaluation": "yes"}, 1: {"evaluation": "error"}}
+
+
+def test_skips_invalid_verdicts():
+    response = ('{"idx": 0, "evaluation": "maybe"}\n{"idx": 1, "evaluation": ""}\n'
+                '{"idx": 2, "evaluation": null}\n{"idx": 3}')
+    assert parse_alignment_response(response, 4) == {}
+
+
+def test_skips_invalid_indices():
+    response = ('{"idx": "one", "evaluation": "yes"}\n{"evaluation": "yes"}\n{"idx": 5, "evaluation": "yes"}\n'
+                '{"idx": -1, "evaluation": "yes"}\n{"idx": "0", "evaluation": "no"}\n{"idx": 0, "evaluation": "yes"}')
+    assert parse_alignment_response(response, 2) == {0: {"evaluation": "no"}}
+
+
+def test_splits_objects_on_the_same_line():
+    response = '{"idx": 0, "evaluation": "yes"} {"idx": 1, "evaluation": "no"}, {"idx": 2, "evaluation": "yes"}'
+    assert parse_alignment_response(response, 3) == {0: {"evaluation": "yes"}, 1: {"evaluation": "no"},
+                                                     2: {"evaluation": "yes"}}
+
+
+def test_skips_malformed_lines():
+    response = 'Here are the evaluations:\n{"idx": 0, "evaluation": \n{"idx": 1, "evaluation": "no"}'
+    assert parse_alignment_response(response, 2) == {1: {"evaluation": "no"}}
@@ -0,0 +1,93 @@
+import asyncio
+
+import pytest
+
+from bytes32.backends import OpenAIBackend, RecordBackend, ReplayBackend, make_backend
+
+MESSAGES = [{"role": "user", "content": "Is this game winnable?"}]
+
+
+@pytest.fixture
+def log_file(tmp_path):
+    return str(tmp_path / "llm_log.jsonl")
+
+
+@pytest.fixture
+def record_backend(fake_server, log_file):
+    return RecordBackend(log_file, OpenAIBackend(base_url=fake_server.base_url, max_retries=0))
+
+
+def contents(response):
+    return [choice.message.content for choice in response.choices]
+
+
+def stream_contents(chunks):
+    texts = {}
+    for chunk in chunks:
+        for choice in chunk.choices:
+            texts[choice.index] = texts.get(choice.index, "") + (choice.delta.content or "")
+
+    return [texts[index] for index in sorted(texts)]
+
+
+async def astream(backend, **kwargs):
+    return [chunk async for chunk in await backend.acreate(**kwargs)]
+
+
+def test_completion_round_trip(record_backend, log_file, fake_server):
+    requests = [dict(model="gpt-4", messages=MESSAGES), dict(model="gpt-4", messages=MESSAGES, n=3, temperature=1)]
+    recorded = [record_backend.create(**kwargs) for kwargs in requests]
+    fake_server.shutdown()
+
+    replay_backend = ReplayBackend(log_file)
+    for kwargs, response in zip(requests, recorded):
+        replayed = replay_backend.create(**kwargs)
+        assert contents(replayed) == contents(response)
+        assert replayed.usage == response.usage
+
+    assert len(contents(replay_backend.create(**requests[1]))) == 3
+
+
+def test_stream_round_trip(record_backend, log_file):
+    kwargs = dict(model="gpt-4", messages=MESSAGES, stream=True, stream_options={"include_usage": True})
+    chunks = list(record_backend.create(**kwargs))
+
+    replayed = list(ReplayBackend(log_file).create(**kwargs))
+    assert stream_contents(replayed) == stream_contents(chunks)
+    assert replayed[-1].usage == chunks[-1].usage
+
+    # Without stream_options, the replayed stream doesn't report the usage.
+    del kwargs["stream_options"]
+    assert all(chunk.usage is None for chunk in ReplayBackend(log_file).create(**kwargs))
+
+
+def test_async_round_trip(record_backend, log_file):
+    kwargs = dict(model="gpt-4", messages=MESSAGES, logprobs=True, top_logprobs=2)
+    recorded = asyncio.run(record_backend.acreate(**kwargs))
+
+    replayed = asyncio.run(ReplayBackend(log_file).acreate(**kwargs))
+    assert contents(replayed) == contents(recorded)
+    assert replayed.choices[0].logprobs == recorded.choices[0].logprobs
+
+
+def test_async_stream_round_trip(record_backend, log_file):
+    kwargs = dict(model="gpt-4", messages=MESSAGES, stream=True, stream_options={"include_usage": True})
+    chunks = asyncio.run(astream(record_backend, **kwargs))
+    assert stream_contents(chunks) == stream_contents(record_backend.create(**kwargs))
+
+    replay_backend = ReplayBackend(log_file)
+    assert len(replay_backend.records) == 1
+    replayed = asyncio.run(astream(replay_backend, **kwargs))
+    assert stream_contents(replayed) == stream_contents(chunks)
+    assert replayed[-1].usage == chunks[-1].usage
+
+
+def test_replay_of_unknown_request(record_backend, log_file):
+    record_backend.create(model="gpt-4", messages=MESSAGES)
+    with pytest.raises(LookupError):
+        ReplayBackend(log_file).create(model="gpt-4", messages=MESSAGES, temperature=0.5)
+
+
+def test_make_backend_needs_log_file():
+    with pytest.raises(ValueError):
+        make_backend("replay")
@@ -0,0 +1,101 @@
+import os
+import shutil
+import argparse
+
+import pytest
+
+from bytes32.cache import ResultCache, make_key, cached_check, TRANSIENT_ERROR
+
+from conftest import REFERENCE_GAME
+
+
+def validity_args(**kwargs):
+    args = dict(max_steps=3, random_seed=0, max_num_actions=100, prune_duplicate_states=False, validity_order="dfs",
+                profile_games=False, sandbox=False, sandbox_max_memory=4096, sandbox_max_cpu_time=900,
+                sandbox_step_timeout=60, sandbox_game_timeout=900, validity_workers=1)
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+@pytest.fixture
+def gamefile(tmp_path):
+    filename = tmp_path / "game.py"
+    shutil.copy(REFERENCE_GAME, filename)
+    return str(filename)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = ResultCache(str(tmp_path / "results.db"))
+    yield cache
+    cache.close()
+
+
+class Check():
+    """ Stand-in for a check, counting its calls. """
+
+    def __init__(self, result):
+        self.result = result
+        self.num_calls = 0
+
+    def __call__(self):
+        self.num_calls += 1
+        return dict(self.result)
+
+
+def test_make_key_ignores_file_name(gamefile, tmp_path):
+    renamed = tmp_path / "renamed_game.py"
+    shutil.copy(gamefile, renamed)
+    assert make_key("validity", gamefile, validity_args()) == make_key("validity", str(renamed), validity_args())
+
+
+def test_make_key_depends_on_inputs(gamefile):
+    key = make_key("validity", gamefile, validity_args())
+    assert key != make_key("compliance", gamefile, argparse.Namespace())
+    assert key != make_key("validity", gamefile, validity_args(max_steps=4))
+    assert key != make_key("validity", gamefile, validity_args(), extra_inputs=["task"])
+
+    # Arguments that don't change the result are left out.
+    assert key == make_key("validity", gamefile, validity_args(validity_workers=8))
+
+    with open(gamefile, "a") as f:
+        f.write("\n# Changed\n")
+    assert key != make_key("validity", gamefile, validity_args())
+
+
+def test_cached_check_hit_and_miss(cache, gamefile):
+    check = Check({"runnable": True})
+    assert cached_check(cache, "validity", gamefile, validity_args(), check) == {"runnable": True}
+    assert cached_check(cache, "validity", gamefile, validity_args(), check) == {"runnable": True}
+    assert check.num_calls == 1
+
+    cached_check(cache, "validity", gamefile, validity_args(max_steps=4), check)
+    assert check.num_calls == 2
+
+
+def test_cached_check_skips_transient_errors(cache, gamefile):
+    check = Check({"runnable": False, TRANSIENT_ERROR: True})
+    assert cached_check(cache, "validity", gamefile, validity_args(), check) == {"runnable": False}
+    cached_check(cache, "validity", gamefile, validity_args(), check)
+    assert check.num_calls == 2
+
+    check = Check({"runnable": False, TRANSIENT_ERROR: False})
+    cached_check(cache, "validity", gamefile, validity_args(), check)
+    assert cached_check(cache, "validity", gamefile, validity_args(), check) == {"runnable": False}
+    assert check.num_calls == 1
+
+
+def test_cached_check_without_cache(gamefile):
+    check = Check({"runnable": False, TRANSIENT_ERROR: True})
+    assert cached_check(None, "validity", gamefile, validity_args(), check) == {"runnable": False}
+
+
+def test_cached_results_name_the_game_they_are_read_for(cache, gamefile, tmp_path):
+    path = os.path.abspath(gamefile)
+    check = Check({"error_msg": f'File "{path}", line 3\n{os.path.basename(gamefile)} is broken.'})
+    cached_check(cache, "validity", gamefile, validity_args(), check)
+
+    renamed = str(tmp_path / "renamed_game.py")
+    shutil.copy(gamefile, renamed)
+    result = cached_check(cache, "validity", renamed, validity_args(), Check({}))
+    assert result == {"error_msg": f'File "{os.path.abspath(renamed)}", line 3\nrenamed_game.py is broken.'}
@@ -0,0 +1,45 @@
+import random
+
+import pytest
+
+from bytes32.sampling import StratifiedSampler, SAMPLE_STRATEGIES
+
+
+def sample(strategy, seed, num_samples=10):
+    sampler = StratifiedSampler(strategy, num_samples, random.Random(seed))
+    for item in range(200):
+        stratum = ("negative", "positive")[item % 3 == 0] if strategy != "action_even" else f"action{item % 4}"
+        sampler.add(item, stratum)
+
+    return sampler.sample()
+
+
+@pytest.mark.parametrize("strategy", SAMPLE_STRATEGIES)
+def test_same_seed_same_sample(strategy):
+    assert sample(strategy, 42) == sample(strategy, 42)
+    assert sample(strategy, 42) != sample(strategy, 43)
+
+
+@pytest.mark.parametrize("strategy", SAMPLE_STRATEGIES)
+def test_sample_size(strategy):
+    assert len(sample(strategy, 0)) == 10
+
+
+def test_even_strata():
+    sampled = sample("pos_neg_even", 0)
+    assert sum(item % 3 == 0 for item in sampled) == 5
+
+
+def test_small_strata_are_topped_up():
+    sampler = StratifiedSampler("pos_neg_even", 10, random.Random(0))
+    for item in range(20):
+        sampler.add(item, "positive" if item == 0 else "negative")
+
+    sampled = sampler.sample()
+    assert len(sampled) == 10
+    assert sampled.count(0) >= 1
+
+
+def test_invalid_strategy():
+    with pytest.raises(ValueError):
+        StratifiedSampler("uniform", 10, random.Random(0))
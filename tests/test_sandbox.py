@@ -0,0 +1,129 @@
+import shutil
+import argparse
+
+import pytest
+
+from bytes32.sandbox import (load_game, format_game_error, SandboxedGame, GameError, GameTimeoutError,
+                             GameTimeBudgetError)
+from bytes32.validity import check_validity
+from bytes32.cache import TRANSIENT_ERROR
+
+from conftest import REFERENCE_GAME
+
+GAME_SOURCE = '''
+import os
+import time
+
+
+class TextGame():
+    def __init__(self, randomSeed=0):
+        self.numSteps = 0
+
+    def step(self, actionStr):
+        if actionStr == "sleep":
+            time.sleep(60)
+        elif actionStr == "spin":
+            while True:
+                pass
+        elif actionStr == "exit":
+            os._exit(3)
+        elif actionStr == "raise":
+            raise ValueError("Broken step.")
+        elif actionStr == "read":
+            return input()
+
+        self.numSteps += 1
+        return self.numSteps
+'''
+
+LIMITS = {"max_memory": None, "max_cpu_time": None, "step_timeout": None, "game_timeout": None}
+
+
+@pytest.fixture
+def gamefile(tmp_path):
+    filename = tmp_path / "sandbox_test_game.py"
+    filename.write_text(GAME_SOURCE)
+    return str(filename)
+
+
+def play(gamefile, actions, **limits):
+    with load_game(gamefile, {**LIMITS, **limits}) as TextGame:
+        game = TextGame()
+        return game, [game.step(action) for action in actions]
+
+
+def test_sandboxed_game_steps(gamefile):
+    game, observations = play(gamefile, ["look", "look"], step_timeout=5)
+    assert isinstance(game, SandboxedGame)
+    assert observations == [1, 2]
+
+
+def test_step_timeout(gamefile):
+    with load_game(gamefile, {**LIMITS, "step_timeout": 1}) as TextGame:
+        game = TextGame()
+        with pytest.raises(GameTimeoutError, match="Game step took more than 1 seconds."):
+            game.step("sleep")
+
+        # The sandbox was killed, so the game can't be played any further.
+        with pytest.raises(GameTimeoutError):
+            game.step("look")
+
+
+def test_time_budget(gamefile):
+    with pytest.raises(GameTimeBudgetError, match="time budget"):
+        play(gamefile, ["look", "sleep"], game_timeout=1)
+
+
+def test_cpu_time_limit(gamefile):
+    with pytest.raises(GameTimeoutError, match="CPU time limit"):
+        play(gamefile, ["spin"], max_cpu_time=1, step_timeout=30)
+
+
+def test_game_exception(gamefile):
+    with pytest.raises(GameError, match="Broken step.") as excinfo:
+        play(gamefile, ["raise"], step_timeout=5)
+
+    error_msg = format_game_error(excinfo.value, gamefile)
+    assert 'raise ValueError("Broken step.")' in error_msg
+    assert error_msg.endswith("\nBroken step.")
+
+
+def test_game_process_crash(gamefile):
+    with pytest.raises(GameError, match=r"died unexpectedly \(exit code 3\)"):
+        play(gamefile, ["exit"], step_timeout=5)
+
+
+def test_input_fails_right_away(gamefile):
+    with pytest.raises(GameError, match="EOF"):
+        play(gamefile, ["read"], step_timeout=5)
+
+
+def validity_args(**kwargs):
+    args = dict(max_steps=2, random_seed=0, max_num_actions=100, validity_search="replay", validity_workers=1,
+                prune_duplicate_states=False, sandbox=True, sandbox_max_memory=4096, sandbox_max_cpu_time=900,
+                sandbox_step_timeout=60, sandbox_game_timeout=900, validity_order="dfs", profile_games=False)
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+def test_check_validity_reports_step_timeout(tmp_path):
+    # The reference game, whose "look" action never returns.
+    source = open(REFERENCE_GAME).read().replace("    def step(self, actionStr):\n",
+                                                 "    def step(self, actionStr):\n"
+                                                 "        if actionStr.startswith('look'):\n"
+                                                 "            while True: pass\n", 1)
+    gamefile = tmp_path / "hanging_game.py"
+    gamefile.write_text(source)
+
+    checks = check_validity(str(gamefile), validity_args(sandbox_step_timeout=1))
+    assert checks["error_msg"].endswith("Game step took more than 1 seconds.")
+    assert not checks.get(TRANSIENT_ERROR)
+
+
+def test_check_validity_of_reference_game(tmp_path):
+    gamefile = tmp_path / "reference_game.py"
+    shutil.copy(REFERENCE_GAME, gamefile)
+
+    checks = check_validity(str(gamefile), validity_args())
+    assert checks["runnable"]
+    assert checks["error_msg"] == ""
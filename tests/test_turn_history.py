@@ -0,0 +1,48 @@
+import pytest
+
+import bytes32.winnability.language_agent as language_agent
+from bytes32.winnability.language_agent import TurnHistory
+
+
+@pytest.fixture(autouse=True)
+def tokens(monkeypatch, word_tokens):
+    monkeypatch.setattr(language_agent, "count_tokens", word_tokens)
+    return word_tokens
+
+
+def assert_counted(history, tokens):
+    assert history.num_tokens == tokens(str(history))
+    assert history.num_tokens == history.head_tokens + sum(tokens(text) for text, _ in history.turns)
+
+
+def test_append(tokens):
+    history = TurnHistory("You are playing a game.\n", "gpt-4")
+    assert_counted(history, tokens)
+
+    history.append("The room is dark.\n")  # Still before the first action
+    assert_counted(history, tokens)
+    assert not history.turns
+
+    for turn in range(5):
+        history.append(f">take cube {turn}\n")
+        assert_counted(history, tokens)
+        history.append("You take the cube.\n")
+        assert_counted(history, tokens)
+
+    history.append(">look\nYou see a scale.\n>inventory\nYou have 5 cubes.")
+    assert_counted(history, tokens)
+    assert len(history.turns) == 7
+
+
+def test_remove_oldest_turn(tokens):
+    text = "You are playing a game.\n" + "".join(f">take cube {turn}\nYou take the cube.\n" for turn in range(5))
+    history = TurnHistory(text, "gpt-4")
+    while history.turns:
+        history.remove_oldest_turn()
+        assert_counted(history, tokens)
+        history.append("")
+        assert_counted(history, tokens)
+
+    assert str(history) == "You are playing a game.\n"
+    history.append(">look\n")
+    assert_counted(history, tokens)